@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import xapktoapk
+
+
+# as written by apktool 2.9 for a base apk
+const_apktool_config = '''!!brut.androlib.meta.MetaInfo
+apkFileName: base.apk
+compressionType: false
+doNotCompress:
+- resources.arsc
+- png
+- assets/bin/Data/data.unity3d
+isFrameworkApk: false
+packageInfo:
+  forcedPackageId: 127
+  renameManifestPackage: null
+sdkInfo:
+  minSdkVersion: 24
+  targetSdkVersion: 34
+sharedLibrary: false
+sparseResources: true
+unknownFiles: {}
+usesFramework:
+  ids:
+  - 1
+  tag: null
+version: 2.9.3
+versionInfo:
+  versionCode: 100
+  versionName: 1.0.0
+'''
+
+const_apktool_config_merged = '''!!brut.androlib.meta.MetaInfo
+apkFileName: base.apk
+compressionType: false
+doNotCompress:
+- assets/bin/Data/data.unity3d
+- ogg
+- png
+- resources.arsc
+- so
+isFrameworkApk: false
+packageInfo:
+  forcedPackageId: 127
+  renameManifestPackage: null
+sdkInfo:
+  minSdkVersion: 24
+  targetSdkVersion: 34
+sharedLibrary: false
+sparseResources: true
+unknownFiles: {}
+usesFramework:
+  ids:
+  - 1
+  tag: null
+version: 2.9.3
+versionInfo:
+  versionCode: 100
+  versionName: 1.0.0
+'''
+
+# a split, the doNotCompress block is the last one and the file has no final newline
+const_apktool_config_split = '''!!brut.androlib.meta.MetaInfo
+apkFileName: config.arm64_v8a.apk
+version: 2.9.3
+doNotCompress:
+- so
+- resources.arsc
+- ogg'''
+
+
+class ApktoolConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path_dir = tempfile.mkdtemp()
+        self.path_dir_main = self.write_config('main', const_apktool_config)
+        self.path_dir_split = self.write_config('split', const_apktool_config_split)
+
+    def tearDown(self):
+        shutil.rmtree(self.path_dir)
+
+    def write_config(self, dir_name, data):
+        path_dir_apk = os.path.join(self.path_dir, dir_name)
+        os.makedirs(path_dir_apk)
+        with open(os.path.join(path_dir_apk, xapktoapk.const_apk_file_apktool_config), 'w') as file:
+            file.write(data)
+        return path_dir_apk
+
+    def read_config(self, path_dir_apk):
+        with open(os.path.join(path_dir_apk, xapktoapk.const_apk_file_apktool_config), 'r') as file:
+            return file.read()
+
+    def test_parse(self):
+        config = xapktoapk.load_apktool_config(self.path_dir_main)
+        self.assertEqual(config['do_not_compress'], set([ 'resources.arsc', 'png', 'assets/bin/Data/data.unity3d' ]))
+        self.assertEqual(config['lines_before'][-1], 'compressionType: false\n')
+        self.assertEqual(config['lines_after'][0], 'isFrameworkApk: false\n')
+        # list entries of later blocks are not part of doNotCompress
+        self.assertNotIn('1', config['do_not_compress'])
+
+    def test_parse_block_at_the_end(self):
+        config = xapktoapk.load_apktool_config(self.path_dir_split)
+        self.assertEqual(config['do_not_compress'], set([ 'so', 'resources.arsc', 'ogg' ]))
+        self.assertEqual(config['lines_before'][-1], 'version: 2.9.3\n')
+        self.assertEqual(config['lines_after'], list())
+
+    def test_round_trip(self):
+        config = xapktoapk.load_apktool_config(self.path_dir_main)
+        xapktoapk.update_apktool_config_do_not_compress(config, self.path_dir_split)
+        self.assertTrue(config['changed'])
+        xapktoapk.write_apktool_config(config)
+        self.assertEqual(self.read_config(self.path_dir_main), const_apktool_config_merged)
+        # the written file parses back to the same entries
+        self.assertEqual(xapktoapk.load_apktool_config(self.path_dir_main)['do_not_compress'], config['do_not_compress'])
+
+    def test_round_trip_block_at_the_end(self):
+        config = xapktoapk.load_apktool_config(self.path_dir_split)
+        xapktoapk.update_apktool_config_do_not_compress(config, self.path_dir_main)
+        xapktoapk.write_apktool_config(config)
+        self.assertEqual(self.read_config(self.path_dir_split), '\n'.join(const_apktool_config_split.split('\n')[:3] + [
+            'doNotCompress:',
+            '- assets/bin/Data/data.unity3d',
+            '- ogg',
+            '- png',
+            '- resources.arsc',
+            '- so',
+        ]) + '\n')
+
+    def test_unchanged_config_is_not_written(self):
+        config = xapktoapk.load_apktool_config(self.path_dir_main)
+        xapktoapk.update_apktool_config_do_not_compress(config, self.path_dir_main)
+        self.assertFalse(config['changed'])
+        xapktoapk.write_apktool_config(config)
+        self.assertEqual(self.read_config(self.path_dir_main), const_apktool_config)
+
+    def test_missing_block_is_appended(self):
+        path_dir_apk = self.write_config('no_block', 'apkFileName: base.apk\nversion: 2.9.3')
+        config = xapktoapk.load_apktool_config(path_dir_apk)
+        self.assertEqual(config['do_not_compress'], set())
+        xapktoapk.update_apktool_config_do_not_compress(config, self.path_dir_split)
+        xapktoapk.write_apktool_config(config)
+        self.assertEqual(self.read_config(path_dir_apk), 'apkFileName: base.apk\nversion: 2.9.3\ndoNotCompress:\n- ogg\n- resources.arsc\n- so\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import xapktoapk
+
+
+class DecodeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path_dir = tempfile.mkdtemp()
+        self.decode_cache = xapktoapk.create_decode_cache(os.path.join(self.path_dir, 'cache'), 1)
+        self.path_dir_entries = os.path.join(self.decode_cache['dir'], xapktoapk.const_decode_cache_dir_entries)
+
+    def tearDown(self):
+        shutil.rmtree(self.path_dir)
+
+    def write_apk_dir(self, dir_name, size):
+        path_dir_apk = os.path.join(self.path_dir, dir_name)
+        os.makedirs(os.path.join(path_dir_apk, 'res'))
+        with open(os.path.join(path_dir_apk, xapktoapk.const_apk_file_apktool_config), 'w') as file:
+            file.write('version: 2.9.3\n')
+        with open(os.path.join(path_dir_apk, 'res', 'data.bin'), 'wb') as file:
+            file.write(b'\0' * size)
+        return path_dir_apk
+
+    def store(self, key, size, last_used):
+        xapktoapk.decode_cache_store(self.decode_cache, key, self.write_apk_dir('apk_' + key, size))
+        path_meta = os.path.join(self.path_dir_entries, key, xapktoapk.const_decode_cache_file_meta)
+        os.utime(path_meta, (last_used, last_used))
+
+    def test_lookup(self):
+        self.store('a', 16, time.time())
+        path_dir_apk = os.path.join(self.path_dir, 'restored')
+        self.assertTrue(xapktoapk.decode_cache_lookup(self.decode_cache, 'a', path_dir_apk))
+        self.assertEqual(os.path.getsize(os.path.join(path_dir_apk, 'res', 'data.bin')), 16)
+        self.assertFalse(xapktoapk.decode_cache_lookup(self.decode_cache, 'b', os.path.join(self.path_dir, 'missing')))
+        self.assertFalse(os.path.exists(os.path.join(self.path_dir, 'missing')))
+
+    def test_least_recently_used_entries_are_evicted_first(self):
+        self.decode_cache['size_limit'] = 1000
+        time_now = time.time()
+        self.store('a', 400, time_now - 300)
+        self.store('b', 400, time_now - 200)
+        self.store('c', 400, time_now - 100)
+        # a is the oldest and is evicted by the store of c
+        self.assertEqual(sorted(os.listdir(self.path_dir_entries)), ['b', 'c'])
+
+    def test_lookup_marks_the_entry_as_used(self):
+        self.decode_cache['size_limit'] = 1000
+        time_now = time.time()
+        self.store('a', 400, time_now - 300)
+        self.store('b', 400, time_now - 200)
+        xapktoapk.decode_cache_lookup(self.decode_cache, 'a', os.path.join(self.path_dir, 'restored'))
+        self.store('c', 400, time_now - 100)
+        self.assertEqual(sorted(os.listdir(self.path_dir_entries)), ['a', 'c'])
+
+    def test_stored_entry_is_kept(self):
+        # the entry just stored is kept even when it is older than every other one and over the limit alone
+        self.decode_cache['size_limit'] = 100
+        self.store('a', 400, time.time())
+        xapktoapk.decode_cache_store(self.decode_cache, 'b', self.write_apk_dir('apk_b', 400))
+        self.assertEqual(os.listdir(self.path_dir_entries), ['b'])
+
+    def test_broken_entries_are_removed(self):
+        self.store('a', 16, time.time())
+        os.makedirs(os.path.join(self.path_dir_entries, 'no_meta', xapktoapk.const_decode_cache_dir_tree))
+        os.makedirs(os.path.join(self.path_dir_entries, 'bad_meta'))
+        with open(os.path.join(self.path_dir_entries, 'bad_meta', xapktoapk.const_decode_cache_file_meta), 'w') as file:
+            file.write('{')
+        self.store('b', 16, time.time())
+        self.assertEqual(sorted(os.listdir(self.path_dir_entries)), ['a', 'b'])
+
+    def test_concurrent_stores_of_the_same_key(self):
+        paths_dir_apk = [self.write_apk_dir('apk_%d' % index, 64) for index in range(4)]
+        threads = [threading.Thread(target=xapktoapk.decode_cache_store, args=(self.decode_cache, 'a', path_dir_apk)) for path_dir_apk in paths_dir_apk]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the first store wins, the others leave nothing behind
+        self.assertEqual(os.listdir(self.path_dir_entries), ['a'])
+        self.assertEqual(os.listdir(os.path.join(self.decode_cache['dir'], xapktoapk.const_decode_cache_dir_tmp)), list())
+        self.assertTrue(xapktoapk.decode_cache_lookup(self.decode_cache, 'a', os.path.join(self.path_dir, 'restored')))
+
+
+@unittest.skipIf(xapktoapk.fcntl is None, 'needs flock')
+class DecodeCacheLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path_dir)
+
+    def lock_in_thread(self, exclusive):
+        # returns an event set once the thread holds the lock, the lock is released right after
+        locked = threading.Event()
+        def lock():
+            xapktoapk.unlock_decode_cache(xapktoapk.lock_decode_cache(self.path_dir, exclusive))
+            locked.set()
+        thread = threading.Thread(target=lock)
+        thread.start()
+        return thread, locked
+
+    def test_shared_locks_do_not_block(self):
+        lock = xapktoapk.lock_decode_cache(self.path_dir, False)
+        try:
+            thread, locked = self.lock_in_thread(False)
+            self.assertTrue(locked.wait(5))
+        finally:
+            xapktoapk.unlock_decode_cache(lock)
+        thread.join()
+
+    def test_exclusive_lock_blocks(self):
+        for exclusive_held, exclusive_wanted in [(True, False), (True, True), (False, True)]:
+            lock = xapktoapk.lock_decode_cache(self.path_dir, exclusive_held)
+            try:
+                thread, locked = self.lock_in_thread(exclusive_wanted)
+                self.assertFalse(locked.wait(0.2), (exclusive_held, exclusive_wanted))
+            finally:
+                xapktoapk.unlock_decode_cache(lock)
+            self.assertTrue(locked.wait(5), (exclusive_held, exclusive_wanted))
+            thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import xapktoapk
+
+
+def plan_apk(apk_file_name):
+    return { 'apk_file_name': apk_file_name }
+
+
+class IncrementalMergeKeysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plan = { 'apk_main': plan_apk('base.apk'), 'apks_arch': list(), 'apks_dpi': [ plan_apk('config.xxhdpi.apk') ], 'apks_locale': [ plan_apk('config.en.apk') ] }
+        self.hashes = { 'base.apk': '1', 'config.xxhdpi.apk': '2', 'config.en.apk': '3' }
+
+    def test_a_changed_split_invalidates_the_steps_from_it_on(self):
+        keys = xapktoapk.get_incremental_merge_keys('plan', self.plan, self.hashes)
+        self.assertEqual(len(set(keys)), 3)
+        self.hashes['config.xxhdpi.apk'] = '4'
+        keys_changed = xapktoapk.get_incremental_merge_keys('plan', self.plan, self.hashes)
+        self.assertEqual(keys_changed[0], keys[0])
+        self.assertNotEqual(keys_changed[1], keys[1])
+        self.assertNotEqual(keys_changed[2], keys[2])
+
+    def test_the_plan_key_invalidates_every_step(self):
+        keys = xapktoapk.get_incremental_merge_keys('plan', self.plan, self.hashes)
+        keys_changed = xapktoapk.get_incremental_merge_keys('other plan', self.plan, self.hashes)
+        self.assertEqual([key_changed == key for key, key_changed in zip(keys, keys_changed)], [False] * 3)
+
+
+class IncrementalMergedTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path_dir = tempfile.mkdtemp()
+        self.path_dir_main = os.path.join(self.path_dir, 'main')
+        self.incremental_state = { 'dir': os.path.join(self.path_dir, 'state'), 'merge_keys': [ 'key 0', 'key 1', 'key 2' ], 'merged': list() }
+        self.apktool_config = { 'do_not_compress': set([ 'so' ]), 'changed': False }
+        self.native_libs = dict([(counter, 0) for counter in xapktoapk.const_incremental_native_libs_counters])
+
+    def tearDown(self):
+        shutil.rmtree(self.path_dir)
+
+    def write_file(self, path_dir, path_rel, data):
+        path_file = os.path.join(path_dir, path_rel)
+        os.makedirs(os.path.dirname(path_file), exist_ok=True)
+        # replaced, not written in place, like the merge does
+        xapktoapk.delete_file_if_exists(path_file)
+        with open(path_file, 'w') as file:
+            file.write(data)
+
+    def read_tree(self, path_dir):
+        tree = dict()
+        for root, dirs, files in os.walk(path_dir):
+            for file in files:
+                with open(os.path.join(root, file), 'r') as file_src:
+                    tree[os.path.relpath(os.path.join(root, file), path_dir)] = file_src.read()
+        return tree
+
+    def store_steps(self):
+        self.write_file(self.path_dir_main, 'apktool.yml', 'version: 1\n')
+        self.write_file(self.path_dir_main, 'res/values/strings.xml', 'main')
+        xapktoapk.store_incremental_merge_step(self.incremental_state, 0, self.path_dir_main, None, self.apktool_config, self.native_libs)
+        self.write_file(self.path_dir_main, 'res/drawable-xxhdpi/icon.png', 'xxhdpi')
+        self.write_file(self.path_dir_main, 'res/values/strings.xml', 'main + xxhdpi')
+        self.apktool_config['do_not_compress'].add('png')
+        xapktoapk.store_incremental_merge_step(self.incremental_state, 1, self.path_dir_main, [ 'res/drawable-xxhdpi/icon.png', 'res/values/strings.xml' ], self.apktool_config, self.native_libs)
+        self.write_file(self.path_dir_main, 'res/values/strings.xml', 'main + xxhdpi + en')
+        self.native_libs['conflicts'] = 1
+        xapktoapk.store_incremental_merge_step(self.incremental_state, 2, self.path_dir_main, [ 'res/values/strings.xml' ], self.apktool_config, self.native_libs)
+        return self.read_tree(self.path_dir_main)
+
+    def test_restore_of_every_prefix(self):
+        tree = self.store_steps()
+        path_dir_restored = os.path.join(self.path_dir, 'restored')
+        self.incremental_state['merged'] = [ 'base.apk', 'config.xxhdpi.apk' ]
+        meta = xapktoapk.restore_incremental_merged_tree(self.incremental_state, path_dir_restored)
+        self.assertEqual(self.read_tree(path_dir_restored), { 'apktool.yml': 'version: 1\n', 'res/values/strings.xml': 'main + xxhdpi', 'res/drawable-xxhdpi/icon.png': 'xxhdpi' })
+        self.assertEqual(meta['key'], 'key 1')
+        self.assertEqual(meta['do_not_compress'], [ 'png', 'so' ])
+        self.assertEqual(meta['native_libs']['conflicts'], 0)
+        shutil.rmtree(path_dir_restored)
+        self.incremental_state['merged'] = [ 'base.apk', 'config.xxhdpi.apk', 'config.en.apk' ]
+        meta = xapktoapk.restore_incremental_merged_tree(self.incremental_state, path_dir_restored)
+        self.assertEqual(self.read_tree(path_dir_restored), tree)
+        self.assertEqual(meta['native_libs']['conflicts'], 1)
+
+    def test_restored_trees_do_not_change_the_stored_steps(self):
+        self.store_steps()
+        path_dir_restored = os.path.join(self.path_dir, 'restored')
+        self.incremental_state['merged'] = [ 'base.apk', 'config.xxhdpi.apk', 'config.en.apk' ]
+        xapktoapk.restore_incremental_merged_tree(self.incremental_state, path_dir_restored)
+        with open(os.path.join(path_dir_restored, 'apktool.yml'), 'a') as file:
+            file.write('changed\n')
+        shutil.rmtree(path_dir_restored)
+        self.incremental_state['merged'] = [ 'base.apk' ]
+        xapktoapk.restore_incremental_merged_tree(self.incremental_state, path_dir_restored)
+        self.assertEqual(self.read_tree(path_dir_restored), { 'apktool.yml': 'version: 1\n', 'res/values/strings.xml': 'main' })
+
+
+if __name__ == '__main__':
+    unittest.main()
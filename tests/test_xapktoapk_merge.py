@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import xapktoapk
+
+
+def values_xml(entries):
+    return '<?xml version="1.0" encoding="utf-8"?>\n<resources>\n' + ''.join('    <string name="%s">%s</string>\n' % entry for entry in entries) + '</resources>\n'
+
+
+class MergeResourcesIndexedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path_dir = tempfile.mkdtemp()
+        self.path_dir_main = self.write_apk('main', {
+            'res/drawable/icon.png': 'main',
+            'res/values/strings.xml': values_xml([('a', 'main')]),
+            'res/values/public.xml': '<?xml version="1.0" encoding="utf-8"?>\n<resources>\n</resources>\n',
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.path_dir)
+
+    def write_apk(self, dir_name, files):
+        path_dir_apk = os.path.join(self.path_dir, dir_name)
+        for path_rel, data in files.items():
+            path_file = os.path.join(path_dir_apk, path_rel)
+            os.makedirs(os.path.dirname(path_file), exist_ok=True)
+            with open(path_file, 'w', encoding='utf-8') as file:
+                file.write(data)
+        return path_dir_apk
+
+    def read_file(self, path_dir_apk, path_rel):
+        with open(os.path.join(path_dir_apk, path_rel), 'r', encoding='utf-8') as file:
+            return file.read()
+
+    def read_strings(self, path_dir_apk, path_rel):
+        return [(element.get('name'), element.text) for element in ElementTree.parse(os.path.join(path_dir_apk, path_rel)).getroot()]
+
+    def test_files_of_the_main_apk_win(self):
+        path_dir_split = self.write_apk('config.xxhdpi', { 'res/drawable/icon.png': 'split', 'res/drawable-xxhdpi/icon.png': 'split' })
+        resources_merge = xapktoapk.create_resources_merge(self.path_dir_main)
+        self.assertEqual(xapktoapk.merge_apk_resources_indexed(resources_merge, path_dir_split), 1)
+        self.assertEqual(self.read_file(self.path_dir_main, 'res/drawable/icon.png'), 'main')
+        self.assertEqual(self.read_file(self.path_dir_main, 'res/drawable-xxhdpi/icon.png'), 'split')
+
+    def test_earlier_splits_win(self):
+        path_dir_split_1 = self.write_apk('config.xxhdpi', { 'res/drawable-xxhdpi/icon.png': 'split 1' })
+        path_dir_split_2 = self.write_apk('config.xhdpi', { 'res/drawable-xxhdpi/icon.png': 'split 2', 'res/drawable-xhdpi/icon.png': 'split 2' })
+        files_copied = xapktoapk.merge_apks_resources(self.path_dir_main, [path_dir_split_1, path_dir_split_2])
+        self.assertEqual(files_copied, { path_dir_split_1: 1, path_dir_split_2: 1 })
+        self.assertEqual(self.read_file(self.path_dir_main, 'res/drawable-xxhdpi/icon.png'), 'split 1')
+        self.assertEqual(self.read_file(self.path_dir_main, 'res/drawable-xhdpi/icon.png'), 'split 2')
+
+    def test_public_values_of_a_split_are_skipped(self):
+        shutil.rmtree(os.path.join(self.path_dir_main, 'res', 'values'))
+        path_dir_split = self.write_apk('config.en', { 'res/values/public.xml': '<?xml version="1.0" encoding="utf-8"?>\n<resources>\n</resources>\n' })
+        resources_merge = xapktoapk.create_resources_merge(self.path_dir_main)
+        self.assertEqual(xapktoapk.merge_apk_resources_indexed(resources_merge, path_dir_split), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.path_dir_main, 'res', 'values', 'public.xml')))
+
+    def test_values_are_merged_entry_by_entry(self):
+        path_dir_split_1 = self.write_apk('config.en', {
+            'res/values/strings.xml': values_xml([('a', 'split 1'), ('b', 'split 1')]),
+            'res/values-en/strings.xml': values_xml([('a', 'split 1')]),
+        })
+        path_dir_split_2 = self.write_apk('config.de', {
+            'res/values/strings.xml': values_xml([('b', 'split 2'), ('c', 'split 2')]),
+            'res/values-en/strings.xml': values_xml([('a', 'split 2'), ('d', 'split 2')]),
+        })
+        self.assertEqual(xapktoapk.merge_apks_resources(self.path_dir_main, [path_dir_split_1, path_dir_split_2]), { path_dir_split_1: 2, path_dir_split_2: 2 })
+        self.assertEqual(self.read_strings(self.path_dir_main, 'res/values/strings.xml'), [('a', 'main'), ('b', 'split 1'), ('c', 'split 2')])
+        self.assertEqual(self.read_strings(self.path_dir_main, 'res/values-en/strings.xml'), [('a', 'split 1'), ('d', 'split 2')])
+        # the file copied from the first split is replaced by the merge, not written through to the split tree
+        self.assertEqual(self.read_strings(path_dir_split_1, 'res/values-en/strings.xml'), [('a', 'split 1')])
+
+    def test_directories_are_created(self):
+        path_dir_split = self.write_apk('config.xxhdpi', { 'res/drawable-xxhdpi/nested/deeper/icon.png': 'split' })
+        resources_merge = xapktoapk.create_resources_merge(self.path_dir_main)
+        xapktoapk.merge_apk_resources_indexed(resources_merge, path_dir_split)
+        self.assertEqual(self.read_file(self.path_dir_main, 'res/drawable-xxhdpi/nested/deeper/icon.png'), 'split')
+        self.assertTrue(set([ 'drawable-xxhdpi', 'drawable-xxhdpi/nested', 'drawable-xxhdpi/nested/deeper' ]) <= resources_merge['dirs'])
+
+    def test_main_apk_without_resources(self):
+        shutil.rmtree(os.path.join(self.path_dir_main, 'res'))
+        path_dir_split = self.write_apk('config.xxhdpi', { 'res/drawable-xxhdpi/icon.png': 'split' })
+        resources_merge = xapktoapk.create_resources_merge(self.path_dir_main)
+        self.assertEqual(xapktoapk.merge_apk_resources_indexed(resources_merge, path_dir_split), 1)
+        self.assertEqual(self.read_file(self.path_dir_main, 'res/drawable-xxhdpi/icon.png'), 'split')
+
+    def test_files_written(self):
+        path_dir_split = self.write_apk('config.en', {
+            'res/drawable/icon.png': 'split',
+            'res/drawable-en/icon.png': 'split',
+            'res/values/strings.xml': values_xml([('a', 'split'), ('b', 'split')]),
+            'res/values/public.xml': '<?xml version="1.0" encoding="utf-8"?>\n<resources>\n</resources>\n',
+        })
+        files_written = list()
+        resources_merge = xapktoapk.create_resources_merge(self.path_dir_main)
+        xapktoapk.merge_apk_resources_indexed(resources_merge, path_dir_split, files_written)
+        # public.xml adds no entry, so it is not written
+        self.assertEqual(sorted(files_written), [ 'res/drawable-en/icon.png', 'res/values/strings.xml' ])
+
+
+if __name__ == '__main__':
+    unittest.main()
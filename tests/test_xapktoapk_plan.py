@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import xapktoapk
+
+
+def target_apk(apk_file_name, split_type, entry_names):
+    apk = dict()
+    apk['apk_file_name'] = apk_file_name
+    apk['apk_dir_name'] = apk_file_name[:-len(xapktoapk.const_ext_apk)]
+    apk['apk_split_type'] = split_type
+    apk['apk_entry_names'] = [ 'AndroidManifest.xml' ] + entry_names
+    return apk
+
+
+def target_apks(apks):
+    return dict([(apk['apk_file_name'], apk) for apk in apks])
+
+
+def file_names(apks):
+    return [apk['apk_file_name'] for apk in apks]
+
+
+class PlanMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.apk_main = target_apk('com.example.app.apk', xapktoapk.const_split_apk_type_main, [ 'classes.dex', 'resources.arsc', 'res/drawable/icon.png', 'lib/x86/libbase.so' ])
+
+    def test_entries_of_the_main_apk_win(self):
+        apk_x86 = target_apk('config.x86.apk', xapktoapk.const_split_apk_type_arch, [ 'lib/x86/libbase.so' ])
+        apk_arm = target_apk('config.arm64_v8a.apk', xapktoapk.const_split_apk_type_arch, [ 'lib/arm64-v8a/libbase.so', 'classes.dex' ])
+        plan = xapktoapk.plan_merge(target_apks([self.apk_main, apk_x86, apk_arm]), dict())
+        self.assertEqual(plan['entries'], { 'config.x86.apk': list(), 'config.arm64_v8a.apk': [ 'lib/arm64-v8a/libbase.so' ] })
+        self.assertEqual(file_names(plan['apks_arch_zip']), [ 'config.arm64_v8a.apk' ])
+        self.assertEqual(file_names(plan['apks_skipped']), [ 'config.x86.apk' ])
+
+    def test_higher_priority_dpi_split_wins(self):
+        apk_xxhdpi = target_apk('config.xxhdpi.apk', xapktoapk.const_split_apk_type_dpi, [ 'res/drawable-xxhdpi/icon.png', 'res/drawable-xxhdpi/logo.png' ])
+        apk_xhdpi = target_apk('config.xhdpi.apk', xapktoapk.const_split_apk_type_dpi, [ 'res/drawable-xxhdpi/icon.png' ])
+        apk_hdpi = target_apk('config.hdpi.apk', xapktoapk.const_split_apk_type_dpi, [ 'resources.arsc', 'res/drawable-xxhdpi/logo.png' ])
+        plan = xapktoapk.plan_merge(target_apks([self.apk_main, apk_hdpi, apk_xhdpi, apk_xxhdpi]), dict())
+        self.assertEqual(plan['entries']['config.xhdpi.apk'], list())
+        # a resources table is always merged, even when the files of the split are not
+        self.assertEqual(plan['entries']['config.hdpi.apk'], [ 'resources.arsc' ])
+        self.assertEqual(file_names(plan['apks_dpi']), [ 'config.xxhdpi.apk', 'config.hdpi.apk' ])
+        self.assertEqual(file_names(plan['apks_skipped']), [ 'config.xhdpi.apk' ])
+
+    def test_native_libs_of_other_abis_are_not_planned(self):
+        apk_arm = target_apk('config.arm64_v8a.apk', xapktoapk.const_split_apk_type_arch, [ 'lib/arm64-v8a/libgame.so', 'lib/armeabi-v7a/libgame.so' ])
+        plan = xapktoapk.plan_merge(target_apks([self.apk_main, apk_arm]), { xapktoapk.const_option_abi: 'arm64_v8a', xapktoapk.const_option_decode_arch: True })
+        self.assertEqual(plan['entries']['config.arm64_v8a.apk'], [ 'lib/arm64-v8a/libgame.so' ])
+        self.assertEqual(file_names(plan['apks_arch']), [ 'config.arm64_v8a.apk' ])
+
+    def test_split_without_merged_entries(self):
+        apk_en = target_apk('config.en.apk', xapktoapk.const_split_apk_type_locale, [ 'META-INF/MANIFEST.MF' ])
+        apk_de = target_apk('config.de.apk', xapktoapk.const_split_apk_type_locale, [ 'resources.arsc' ])
+        plan = xapktoapk.plan_merge(target_apks([self.apk_main, apk_en, apk_de]), dict())
+        self.assertEqual(file_names(plan['apks_locale']), [ 'config.de.apk' ])
+        self.assertEqual(file_names(plan['apks_skipped']), [ 'config.en.apk' ])
+
+    def test_variants_plan_every_entry_any_variant_needs(self):
+        apk_x86 = target_apk('config.x86.apk', xapktoapk.const_split_apk_type_arch, [ 'lib/x86/libgame.so' ])
+        apk_arm = target_apk('config.arm64_v8a.apk', xapktoapk.const_split_apk_type_arch, [ 'lib/arm64-v8a/libgame.so' ])
+        variants = xapktoapk.get_param_variants({ xapktoapk.const_option_variants: 'x86,arm64_v8a' })
+        plan = xapktoapk.plan_variants(target_apks([self.apk_main, apk_x86, apk_arm]), dict(), variants)
+        self.assertEqual(plan['entries'], { 'config.x86.apk': [ 'lib/x86/libgame.so' ], 'config.arm64_v8a.apk': [ 'lib/arm64-v8a/libgame.so' ] })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import xapktoapk
+
+
+class SubmitServiceJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path_dir = tempfile.mkdtemp()
+        self.path_xapk = os.path.join(self.path_dir, 'test.xapk')
+        with open(self.path_xapk, 'wb'):
+            pass
+        # requests that are rejected never reach the worker pool
+        self.service = { 'options': dict() }
+
+    def tearDown(self):
+        shutil.rmtree(self.path_dir)
+
+    def test_options_must_be_an_object(self):
+        for options in [None, 0, False, '', [], 'abi=x86', [['abi', 'x86']]]:
+            status, data = xapktoapk.submit_service_job(self.service, { 'file': self.path_xapk, 'options': options })
+            self.assertEqual(status, 400, options)
+            self.assertIn('options', data['error'])
+
+    def test_options_are_checked(self):
+        status, data = xapktoapk.submit_service_job(self.service, { 'file': self.path_xapk, 'options': { 'jobs': '4' } })
+        self.assertEqual(status, 400)
+        status, data = xapktoapk.submit_service_job(self.service, { 'file': self.path_xapk, 'options': { 'abi': 'unknown' } })
+        self.assertEqual(status, 400)
+
+    def test_file_is_checked(self):
+        for request in [[], { 'file': 1 }, { 'file': os.path.join(self.path_dir, 'missing.xapk') }, { 'file': self.path_dir }]:
+            status, data = xapktoapk.submit_service_job(self.service, request)
+            self.assertEqual(status, 400, request)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs unix sockets')
+class RunServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path_dir = tempfile.mkdtemp()
+        # the service only checks that apktool is in $PATH, no job is run
+        path_apktool = os.path.join(self.path_dir, 'apktool')
+        with open(path_apktool, 'w') as file:
+            file.write('#!/bin/sh\nexit 1\n')
+        os.chmod(path_apktool, 0o755)
+        self.environment = dict(os.environ)
+        self.environment['PATH'] = self.path_dir + os.pathsep + self.environment.get('PATH', '')
+
+    def tearDown(self):
+        shutil.rmtree(self.path_dir)
+
+    def test_sigterm_stops_the_service(self):
+        path_socket = os.path.join(self.path_dir, 'service.sock')
+        process = subprocess.Popen([sys.executable, os.path.abspath(xapktoapk.__file__), '--serve', 'unix:' + path_socket], cwd=self.path_dir, env=self.environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            time_limit = time.time() + 30
+            while not os.path.exists(path_socket) and process.poll() is None and time.time() < time_limit:
+                time.sleep(0.05)
+            self.assertTrue(os.path.exists(path_socket))
+            # the socket accepts connections before serve_forever() runs, an answer means the SIGTERM handler is installed
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(path_socket)
+                client.sendall(b'GET /status HTTP/1.0\r\n\r\n')
+                self.assertTrue(client.recv(1024).startswith(b'HTTP/1.0 200'))
+            process.send_signal(signal.SIGTERM)
+            output = process.communicate(timeout=30)[0].decode('utf-8')
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        self.assertEqual(process.returncode, 0, output)
+        self.assertIn('waiting for the running jobs', output)
+        self.assertFalse(os.path.exists(path_socket))
+
+
+if __name__ == '__main__':
+    unittest.main()
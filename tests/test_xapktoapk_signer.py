@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import xapktoapk
+import xapktoapk_signer
+
+
+const_dir_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+const_keystore_alias = 'testkey'
+const_keystore_store_password = 'storepass'
+const_keystore_jks_key_password = 'keypass'
+# modulus of the 1024 bit rsa key in both test keystores
+const_keystore_modulus = int('A108635FAF1313E0AE54F623E8FDCD07A40CCAD3CAE62E344E53D7212F4407DDC2179931A8CEF39E9EFE78A7508005C5'
+                             '136E72C457C29D31CD38ED1FC2F1E43D4E8028FF6FBE3CC638661BF0DD6DBE07FE3D4EAC50E65B788D3BCEF61B1543CB'
+                             '7F2762D93A9AEE45D6D54D39A83A1FAA1C59C46124ECB8C22A48A5E2E3006CD9', 16)
+
+
+def read_data_file(file_name):
+    with open(os.path.join(const_dir_data, file_name), 'rb') as file:
+        return file.read()
+
+
+def der(tag, value):
+    if len(value) < 0x80:
+        return bytes([tag, len(value)]) + value
+    length = len(value).to_bytes((len(value).bit_length() + 7) // 8, 'big')
+    return bytes([tag, 0x80 | len(length)]) + length + value
+
+
+def der_oid(oid):
+    parts = [int(part) for part in oid.split('.')]
+    data = bytes([parts[0] * 40 + parts[1]])
+    for part in parts[2:]:
+        encoded = [part & 0x7f]
+        part >>= 7
+        while part:
+            encoded.insert(0, 0x80 | (part & 0x7f))
+            part >>= 7
+        data += bytes(encoded)
+    return der(0x06, data)
+
+
+def der_pbes2_algorithm(salt, iterations, prf_oid, encryption_oid, iv):
+    pbkdf2_parameters = der(0x04, salt) + der(0x02, iterations.to_bytes(4, 'big').lstrip(b'\0') or b'\0')
+    if prf_oid is not None:
+        pbkdf2_parameters += der(0x30, der_oid(prf_oid) + b'\x05\x00')
+    key_derivation = der(0x30, der_oid(xapktoapk_signer.const_der_oid_pbkdf2) + der(0x30, pbkdf2_parameters))
+    encryption_scheme = der(0x30, der_oid(encryption_oid) + der(0x04, iv))
+    # contents of the AlgorithmIdentifier sequence, as pbes2_derive_key gets them
+    return der_oid(xapktoapk_signer.const_der_oid_pbes2) + der(0x30, key_derivation + encryption_scheme)
+
+
+def read_length_prefixed(data, offset):
+    size = struct.unpack_from('<I', data, offset)[0]
+    return data[offset + 4:offset + 4 + size], offset + 4 + size
+
+
+def read_length_prefixed_list(data):
+    values = list()
+    offset = 0
+    while offset < len(data):
+        value, offset = read_length_prefixed(data, offset)
+        values.append(value)
+    return values
+
+
+class AesTest(unittest.TestCase):
+
+    def test_decrypt_block_fips_197(self):
+        # FIPS-197 appendix C, the same plaintext encrypted with a 128, 192 and 256 bit key
+        plaintext = bytes.fromhex('00112233445566778899aabbccddeeff')
+        vectors = [
+            ('000102030405060708090a0b0c0d0e0f', '69c4e0d86a7b0430d8cdb78070b4c55a'),
+            ('000102030405060708090a0b0c0d0e0f1011121314151617', 'dda97ca4864cdfe06eaf70a0ec0d7191'),
+            ('000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f', '8ea2b7ca516745bfeafc49904b496089'),
+        ]
+        for key, ciphertext in vectors:
+            round_keys = xapktoapk_signer.aes_expand_key(bytes.fromhex(key))
+            self.assertEqual(xapktoapk_signer.aes_decrypt_block(round_keys, bytes.fromhex(ciphertext)), plaintext)
+
+    def test_cbc_decrypt_checks_padding(self):
+        # NIST SP 800-38A F.2.2, the plaintext is not padded, so it is taken for a wrong password
+        key = bytes.fromhex('2b7e151628aed2a6abf7158809cf4f3c')
+        iv = bytes.fromhex('000102030405060708090a0b0c0d0e0f')
+        ciphertext = bytes.fromhex('7649abac8119b246cee98e9b12e9197d')
+        round_keys = xapktoapk_signer.aes_expand_key(key)
+        plaintext = bytes(a ^ b for a, b in zip(xapktoapk_signer.aes_decrypt_block(round_keys, ciphertext), iv))
+        self.assertEqual(plaintext, bytes.fromhex('6bc1bee22e409f96e93d7e117393172a'))
+        with self.assertRaises(Exception):
+            xapktoapk_signer.aes_cbc_decrypt(key, iv, ciphertext)
+
+    def test_self_test_failure_disables_the_tables(self):
+        key, ciphertext, plaintext = xapktoapk_signer.const_aes_self_test_vector
+        xapktoapk_signer.aes_tables.clear()
+        try:
+            with mock.patch.object(xapktoapk_signer, 'const_aes_self_test_vector', (key, ciphertext, bytes(16).hex())):
+                with self.assertRaises(Exception):
+                    xapktoapk_signer.aes_get_tables()
+            self.assertEqual(len(xapktoapk_signer.aes_tables), 0)
+        finally:
+            xapktoapk_signer.aes_tables.clear()
+
+
+class BuiltinFallbackTest(unittest.TestCase):
+    # the keystore is decrypted and the apk signed the same way with and without the cryptography package
+
+    def load_sign_keys(self):
+        data = read_data_file('sign_key.jks')
+        sign_key = xapktoapk_signer.load_keystore(data, const_keystore_store_password, const_keystore_alias, const_keystore_jks_key_password)
+        with mock.patch.object(xapktoapk_signer, 'Cipher', None), mock.patch.object(xapktoapk_signer, 'rsa', None):
+            sign_key_builtin = xapktoapk_signer.load_keystore(data, const_keystore_store_password, const_keystore_alias, const_keystore_jks_key_password)
+        return sign_key, sign_key_builtin
+
+    def test_same_key(self):
+        sign_key, sign_key_builtin = self.load_sign_keys()
+        self.assertEqual(sign_key['private_key'], sign_key_builtin['private_key'])
+        data = read_data_file('sign_key.p12')
+        with mock.patch.object(xapktoapk_signer, 'Cipher', None):
+            sign_key_builtin = xapktoapk_signer.load_keystore(data, const_keystore_store_password, const_keystore_alias, const_keystore_store_password)
+        self.assertEqual(sign_key['private_key'], sign_key_builtin['private_key'])
+
+    def test_same_signature(self):
+        private_key = self.load_sign_keys()[0]['private_key']
+        signature = xapktoapk_signer.rsa_sign_sha256(private_key, b'data')
+        with mock.patch.object(xapktoapk_signer, 'rsa', None):
+            self.assertEqual(xapktoapk_signer.rsa_sign_sha256(private_key, b'data'), signature)
+
+
+class Pbes2Test(unittest.TestCase):
+
+    def test_derive_key_pbkdf2_hmac_sha256(self):
+        # RFC 7914 section 11, PBKDF2-HMAC-SHA256 with P = "passwd", S = "salt", c = 1
+        iv = bytes(range(16))
+        algorithm = der_pbes2_algorithm(b'salt', 1, '1.2.840.113549.2.9', '2.16.840.1.101.3.4.1.42', iv)
+        key, key_iv = xapktoapk_signer.pbes2_derive_key(algorithm, 'passwd')
+        self.assertEqual(key, bytes.fromhex('55ac046e56e3089fec1691c22544b605f94185216dde0465e68b9d57c20dacbc'))
+        self.assertEqual(key_iv, iv)
+
+    def test_derive_key_pbkdf2_default_prf(self):
+        # RFC 6070, PBKDF2-HMAC-SHA1 with P = "password", S = "salt", c = 2, the prf defaults to sha1 when it is not given
+        algorithm = der_pbes2_algorithm(b'salt', 2, None, '2.16.840.1.101.3.4.1.2', bytes(16))
+        key, key_iv = xapktoapk_signer.pbes2_derive_key(algorithm, 'password')
+        self.assertEqual(key, bytes.fromhex('ea6c014dc72d6f8ccd1ed92ace1d41f0'))
+
+
+class KeystoreTest(unittest.TestCase):
+
+    def check_sign_key(self, sign_key):
+        private_key = sign_key['private_key']
+        self.assertEqual(private_key['n'], const_keystore_modulus)
+        self.assertEqual(private_key['e'], 65537)
+        self.assertEqual(private_key['p'] * private_key['q'], private_key['n'])
+        self.assertEqual(pow(pow(12345, private_key['e'], private_key['n']), private_key['d'], private_key['n']), 12345)
+        self.assertEqual(len(sign_key['certificates']), 1)
+        self.assertIn(const_keystore_modulus.to_bytes(128, 'big'), sign_key['public_key'])
+
+    def test_load_pkcs12(self):
+        data = read_data_file('sign_key.p12')
+        self.check_sign_key(xapktoapk_signer.load_keystore(data, const_keystore_store_password, const_keystore_alias, const_keystore_store_password))
+
+    def test_load_jks(self):
+        data = read_data_file('sign_key.jks')
+        self.check_sign_key(xapktoapk_signer.load_keystore(data, const_keystore_store_password, const_keystore_alias, const_keystore_jks_key_password))
+
+    def test_wrong_passwords(self):
+        with self.assertRaises(Exception):
+            xapktoapk_signer.load_keystore(read_data_file('sign_key.p12'), 'wrong', const_keystore_alias, 'wrong')
+        with self.assertRaises(Exception):
+            xapktoapk_signer.load_keystore(read_data_file('sign_key.jks'), 'wrong', const_keystore_alias, const_keystore_jks_key_password)
+        with self.assertRaises(Exception):
+            xapktoapk_signer.load_keystore(read_data_file('sign_key.jks'), const_keystore_store_password, const_keystore_alias, 'wrong')
+
+    def test_missing_alias(self):
+        with self.assertRaises(Exception):
+            xapktoapk_signer.load_keystore(read_data_file('sign_key.jks'), const_keystore_store_password, 'missing', const_keystore_jks_key_password)
+
+
+class RsaSignTest(unittest.TestCase):
+
+    def setUp(self):
+        self.private_key = xapktoapk_signer.load_keystore(read_data_file('sign_key.p12'), const_keystore_store_password, const_keystore_alias, const_keystore_store_password)['private_key']
+
+    def test_signature(self):
+        signature = int.from_bytes(xapktoapk_signer.rsa_sign_sha256(self.private_key, b'data'), 'big')
+        digest_info = xapktoapk_signer.const_sign_digest_info_sha256 + hashlib.sha256(b'data').digest()
+        self.assertEqual(pow(signature, self.private_key['e'], self.private_key['n']).to_bytes(128, 'big'), b'\x00\x01' + b'\xff' * (128 - len(digest_info) - 3) + b'\x00' + digest_info)
+
+    def test_faulty_crt_half_is_not_returned(self):
+        # a wrong half of the crt computation, as a hardware fault would give
+        private_key = dict(self.private_key)
+        private_key['dp'] += 1
+        with self.assertRaises(Exception):
+            xapktoapk_signer.rsa_sign_sha256(private_key, b'data')
+        with mock.patch.object(xapktoapk_signer, 'rsa', None), self.assertRaises(Exception):
+            xapktoapk_signer.rsa_sign_sha256(private_key, b'data')
+
+
+class SignApkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path_dir = tempfile.mkdtemp()
+        self.path_apk = os.path.join(self.path_dir, 'test.apk')
+        with ZipFile(self.path_apk, 'w') as zip_file:
+            zip_file.writestr('AndroidManifest.xml', b'\0' * 100, compress_type=ZIP_STORED)
+            zip_file.writestr('classes.dex', os.urandom(3 * 1024 * 1024), compress_type=ZIP_STORED)
+            zip_file.writestr('res/values/strings.xml', b'<resources/>' * 100, compress_type=ZIP_DEFLATED)
+        self.sign_key = xapktoapk_signer.load_keystore(read_data_file('sign_key.p12'), const_keystore_store_password, const_keystore_alias, const_keystore_store_password)
+
+    def tearDown(self):
+        shutil.rmtree(self.path_dir)
+
+    def read_signing_block(self, data):
+        # returns the id value pairs of the block and its offset
+        eocd_offset = data.rfind(b'PK\x05\x06')
+        cd_offset = struct.unpack_from('<I', data, eocd_offset + 16)[0]
+        self.assertEqual(data[cd_offset - 16:cd_offset], xapktoapk_signer.const_sign_block_magic)
+        block_size = struct.unpack_from('<Q', data, cd_offset - 24)[0]
+        block_offset = cd_offset - block_size - 8
+        self.assertEqual(struct.unpack_from('<Q', data, block_offset)[0], block_size)
+        pairs = dict()
+        offset = block_offset + 8
+        while offset < cd_offset - 24:
+            size, block_id = struct.unpack_from('<QI', data, offset)
+            pairs[block_id] = data[offset + 12:offset + 8 + size]
+            offset += 8 + size
+        return pairs, block_offset
+
+    def compute_unsigned_content_digest(self, data, block_offset):
+        # the digest covers the apk as if the block was not there, with the central directory offset of the unsigned apk
+        eocd_offset = data.rfind(b'PK\x05\x06')
+        cd_offset = struct.unpack_from('<I', data, eocd_offset + 16)[0]
+        eocd = bytearray(data[eocd_offset:])
+        struct.pack_into('<I', eocd, 16, block_offset)
+        chunk_digests = list()
+        for section in [data[:block_offset], data[cd_offset:eocd_offset], bytes(eocd)]:
+            for offset in range(0, len(section), xapktoapk_signer.const_sign_chunk_size):
+                chunk = section[offset:offset + xapktoapk_signer.const_sign_chunk_size]
+                chunk_digests.append(hashlib.sha256(b'\xa5' + struct.pack('<I', len(chunk)) + chunk).digest())
+        return hashlib.sha256(b'\x5a' + struct.pack('<I', len(chunk_digests)) + b''.join(chunk_digests)).digest()
+
+    def check_signer(self, signer, content_digest, is_v3):
+        signed_data, offset = read_length_prefixed(signer, 0)
+        if is_v3:
+            min_sdk, max_sdk = struct.unpack_from('<II', signer, offset)
+            self.assertEqual((min_sdk, max_sdk), (xapktoapk_signer.const_sign_v3_min_sdk, xapktoapk_signer.const_sign_v3_max_sdk))
+            offset += 8
+        signatures, offset = read_length_prefixed(signer, offset)
+        public_key, offset = read_length_prefixed(signer, offset)
+        self.assertEqual(public_key, self.sign_key['public_key'])
+
+        digests, offset_signed = read_length_prefixed(signed_data, 0)
+        digest = read_length_prefixed_list(digests)[0]
+        self.assertEqual(struct.unpack_from('<I', digest, 0)[0], xapktoapk_signer.const_sign_algorithm_rsa_pkcs1_sha256)
+        self.assertEqual(read_length_prefixed(digest, 4)[0], content_digest)
+        certificates = read_length_prefixed(signed_data, offset_signed)[0]
+        self.assertEqual(read_length_prefixed_list(certificates), self.sign_key['certificates'])
+
+        signature = read_length_prefixed_list(signatures)[0]
+        self.assertEqual(struct.unpack_from('<I', signature, 0)[0], xapktoapk_signer.const_sign_algorithm_rsa_pkcs1_sha256)
+        signature_value = int.from_bytes(read_length_prefixed(signature, 4)[0], 'big')
+        private_key = self.sign_key['private_key']
+        message = pow(signature_value, private_key['e'], private_key['n']).to_bytes(128, 'big')
+        digest_info = xapktoapk_signer.const_sign_digest_info_sha256 + hashlib.sha256(signed_data).digest()
+        self.assertEqual(message, b'\x00\x01' + b'\xff' * (128 - len(digest_info) - 3) + b'\x00' + digest_info)
+
+    def test_signing_block(self):
+        with open(self.path_apk, 'rb') as file:
+            data_unsigned = file.read()
+        xapktoapk.sign_apk_in_process(self.path_apk, self.sign_key)
+        with open(self.path_apk, 'rb') as file:
+            data = file.read()
+        pairs, block_offset = self.read_signing_block(data)
+        self.assertEqual(data[:block_offset], data_unsigned[:block_offset])
+        content_digest = self.compute_unsigned_content_digest(data, block_offset)
+        for block_id, is_v3 in [(xapktoapk_signer.const_sign_block_id_v2, False), (xapktoapk_signer.const_sign_block_id_v3, True)]:
+            signers = read_length_prefixed_list(read_length_prefixed(pairs[block_id], 0)[0])
+            self.assertEqual(len(signers), 1)
+            self.check_signer(signers[0], content_digest, is_v3)
+        with ZipFile(self.path_apk, 'r') as zip_file:
+            self.assertIsNone(zip_file.testzip())
+
+    def test_signed_apk_is_not_signed_again(self):
+        xapktoapk.sign_apk_in_process(self.path_apk, self.sign_key)
+        with self.assertRaises(Exception):
+            xapktoapk.sign_apk_in_process(self.path_apk, self.sign_key)
+
+    @unittest.skipIf(shutil.which('apksigner') is None, 'apksigner is not installed')
+    def test_apksigner_verify(self):
+        xapktoapk.sign_apk_in_process(self.path_apk, self.sign_key)
+        result = subprocess.run(['apksigner', 'verify', '--verbose', self.path_apk], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertIn('Verified using v2 scheme (APK Signature Scheme v2): true', result.stdout)
+        self.assertIn('Verified using v3 scheme (APK Signature Scheme v3): true', result.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
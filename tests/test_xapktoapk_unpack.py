@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import xapktoapk
+
+
+const_apk_files = [ 'base.apk', 'config.xxhdpi.apk', 'config.xhdpi.apk', 'config.en.apk', 'config.de.apk' ]
+
+
+class IterateUnpackedApksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.started = list()
+        self.failing = set()
+
+    def unpack_apk(self, path_dir_tmp, apk_file, n, total, decode_cache, report, lazy_extract):
+        with self.lock:
+            self.started.append(apk_file)
+        # slow enough that the decodes that may run ahead do so before the caller checks
+        time.sleep(0.02)
+        if apk_file in self.failing:
+            raise Exception("failed to unpack %s" % apk_file)
+
+    def iterate(self, apk_files_to_decode, jobs, max_ahead):
+        with mock.patch.object(xapktoapk, 'unpack_apk', self.unpack_apk):
+            for apk_file in xapktoapk.iterate_unpacked_apks('tmp', const_apk_files, apk_files_to_decode, jobs, max_ahead=max_ahead):
+                time.sleep(0.05)
+                with self.lock:
+                    yield apk_file, list(self.started)
+
+    def test_decodes_are_not_bounded_by_default(self):
+        results = list(self.iterate(set(const_apk_files), len(const_apk_files), None))
+        self.assertEqual([apk_file for apk_file, started in results], const_apk_files)
+        self.assertEqual(len(results[0][1]), len(const_apk_files))
+
+    def test_decodes_ahead_of_the_merge_are_bounded(self):
+        for max_ahead in [1, 2]:
+            self.started = list()
+            results = list(self.iterate(set(const_apk_files), 4, max_ahead))
+            self.assertEqual([apk_file for apk_file, started in results], const_apk_files)
+            for index, (apk_file, started) in enumerate(results):
+                # the split being merged, plus at most max_ahead decoded or decoding ones
+                self.assertEqual(len(started), min(index + 1 + max_ahead, len(const_apk_files)))
+            self.assertEqual(self.started, const_apk_files)
+
+    def test_splits_that_are_not_decoded_do_not_count(self):
+        apk_files_to_decode = set(const_apk_files[2:])
+        results = list(self.iterate(apk_files_to_decode, 2, 1))
+        self.assertEqual([apk_file for apk_file, started in results], const_apk_files)
+        self.assertEqual([len(started) for apk_file, started in results], [1, 1, 2, 3, 3])
+
+    def test_failure_stops_the_decodes(self):
+        self.failing.add(const_apk_files[2])
+        with self.assertRaises(Exception) as context:
+            list(self.iterate(set(const_apk_files), 2, 1))
+        self.assertIn(const_apk_files[2], str(context.exception))
+        # the failed split was the one decoding ahead, nothing after it is started
+        self.assertEqual(self.started, const_apk_files[:3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import xapktoapk
+
+
+const_namespace_xliff = 'urn:oasis:names:tc:xliff:document:1.2'
+
+
+def values_xml(entries, root_attributes=''):
+    lines = [ '<?xml version="1.0" encoding="utf-8"?>', '<resources%s>' % root_attributes ]
+    lines += [ '    ' + entry for entry in entries ]
+    lines.append('</resources>')
+    return '\n'.join(lines) + '\n'
+
+
+def element_tree(element):
+    # (tag, attributes, text, children, tail) of an element, whitespace around it ignored
+    return (element.tag, dict(element.attrib), (element.text or '').strip(), [element_tree(child) for child in element], (element.tail or '').strip())
+
+
+class MergeValuesXmlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path_dir)
+
+    def write_file(self, file_name, data):
+        path_file = os.path.join(self.path_dir, file_name)
+        with open(path_file, 'w', encoding='utf-8') as file:
+            file.write(data)
+        return path_file
+
+    def read_entries(self, path_file):
+        return [(element.tag, element.get('name'), element.text) for element in ElementTree.parse(path_file).getroot()]
+
+    def test_destination_and_earlier_sources_win(self):
+        path_dst = self.write_file('strings.xml', values_xml([ '<string name="a">main</string>' ]))
+        path_src_1 = self.write_file('strings_1.xml', values_xml([ '<string name="a">split 1</string>', '<string name="b">split 1</string>' ]))
+        path_src_2 = self.write_file('strings_2.xml', values_xml([ '<string name="b">split 2</string>', '<item type="string" name="c">split 2</item>' ]))
+        self.assertEqual(xapktoapk.merge_values_xml(path_dst, [path_src_1, path_src_2]), [1, 1])
+        self.assertEqual(self.read_entries(path_dst), [('string', 'a', 'main'), ('string', 'b', 'split 1'), ('item', 'c', 'split 2')])
+
+    def test_array_aliases_are_one_key(self):
+        path_dst = self.write_file('arrays.xml', values_xml([ '<string-array name="a"><item>main</item></string-array>' ]))
+        path_src = self.write_file('arrays_1.xml', values_xml([ '<array name="a"><item>split</item></array>', '<integer-array name="b"><item>1</item></integer-array>' ]))
+        self.assertEqual(xapktoapk.merge_values_xml(path_dst, [path_src]), [1])
+        self.assertEqual([(tag, name) for tag, name, text in self.read_entries(path_dst)], [('string-array', 'a'), ('integer-array', 'b')])
+
+    def test_public_id_collision(self):
+        path_dst = self.write_file('public.xml', values_xml([ '<public type="string" name="a" id="0x7f010000" />' ]))
+        path_src = self.write_file('public_1.xml', values_xml([
+            '<public type="string" name="b" id="0x7f010000" />',
+            '<public type="string" name="c" id="0x7f010001" />',
+            '<public type="string" name="d" id="0x7f010001" />',
+        ]))
+        self.assertEqual(xapktoapk.merge_values_xml(path_dst, [path_src]), [1])
+        root = ElementTree.parse(path_dst).getroot()
+        self.assertEqual([(element.get('name'), element.get('id')) for element in root], [('a', '0x7f010000'), ('c', '0x7f010001')])
+
+    def test_empty_resources_element(self):
+        path_dst = self.write_file('strings.xml', '<?xml version="1.0" encoding="utf-8"?>\n<resources/>\n')
+        path_src = self.write_file('strings_1.xml', values_xml([ '<string name="a">split</string>' ]))
+        self.assertEqual(xapktoapk.merge_values_xml(path_dst, [path_src]), [1])
+        self.assertEqual(self.read_entries(path_dst), [('string', 'a', 'split')])
+
+    def test_closing_tag_before_the_tail(self):
+        # a trailing comment pushes </resources> out of the last window, the last case puts it across a window boundary
+        data = values_xml([ '<string name="a">main</string>' ])
+        comment_size = len('<!---->\n')
+        size_straddling = data.rfind('</resources>') + 6 + xapktoapk.const_values_xml_tail_size * 2
+        for padding_size in [xapktoapk.const_values_xml_tail_size, xapktoapk.const_values_xml_tail_size * 3, size_straddling - len(data) - comment_size]:
+            path_dst = self.write_file('strings.xml', data + '<!--' + ' ' * padding_size + '-->\n')
+            path_src = self.write_file('strings_1.xml', values_xml([ '<string name="b">split</string>' ]))
+            self.assertEqual(xapktoapk.merge_values_xml(path_dst, [path_src]), [1])
+            self.assertEqual(self.read_entries(path_dst), [('string', 'a', 'main'), ('string', 'b', 'split')])
+
+    def test_missing_closing_tag(self):
+        path_dst = self.write_file('strings.xml', '<?xml version="1.0" encoding="utf-8"?>\n<resources>\n')
+        with self.assertRaises(Exception):
+            xapktoapk.write_values_xml(path_dst, [ '<string name="a">split</string>' ])
+
+    def test_cdata_and_xliff_round_trip(self):
+        entries = [
+            '<string name="html"><![CDATA[<b>bold</b> & <i>italic</i>]]></string>',
+            '<string name="count">Found <xliff:g id="count" example="3">%d</xliff:g> items</string>',
+        ]
+        path_dst = self.write_file('strings.xml', values_xml([ '<string name="a">main</string>' ], ' xmlns:xliff="%s"' % const_namespace_xliff))
+        path_src = self.write_file('strings_1.xml', values_xml(entries, ' xmlns:xliff="%s"' % const_namespace_xliff))
+        self.assertEqual(xapktoapk.merge_values_xml(path_dst, [path_src]), [2])
+        merged = list(ElementTree.parse(path_dst).getroot())
+        self.assertEqual([element_tree(element) for element in merged[1:]], [element_tree(element) for element in ElementTree.parse(path_src).getroot()])
+        self.assertEqual(merged[1].text, '<b>bold</b> & <i>italic</i>')
+        self.assertEqual(merged[2][0].tag, '{%s}g' % const_namespace_xliff)
+        self.assertEqual(merged[2][0].tail, ' items')
+
+    def test_merged_file_mode(self):
+        path_dst = self.write_file('strings.xml', values_xml([ '<string name="a">main</string>' ]))
+        path_src = self.write_file('strings_1.xml', values_xml([ '<string name="b">split</string>' ]))
+        xapktoapk.merge_values_xml(path_dst, [path_src])
+        self.assertEqual(stat.S_IMODE(os.stat(path_dst).st_mode), 0o666 & ~xapktoapk.process_umask)
+        # no temp file is left behind
+        self.assertEqual(sorted(os.listdir(self.path_dir)), ['strings.xml', 'strings_1.xml'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import xapktoapk
+
+
+const_package_name = 'com.example.test'
+const_apk_dir_lib_prefix = 'lib/'
+
+
+def write_apk(entries):
+    # entries of (name, data, compress_type), returns the apk bytes
+    buffer = io.BytesIO()
+    with ZipFile(buffer, 'w') as zip_file:
+        for name, data, compress_type in entries:
+            zip_file.writestr(name, data, compress_type=compress_type)
+    return buffer.getvalue()
+
+
+def read_local_headers(data, zip_file):
+    # local header fields and data offset of every entry, by name
+    headers = dict()
+    for zip_info in zip_file.infolist():
+        fields = struct.unpack_from('<IHHHHHIIIHH', data, zip_info.header_offset)
+        offset_name = zip_info.header_offset + xapktoapk.const_zip_size_local_file_header
+        header = dict()
+        header['signature'], header['flags'], header['method'] = fields[0], fields[2], fields[3]
+        header['crc'], header['compress_size'], header['file_size'] = fields[6:9]
+        header['name'] = data[offset_name:offset_name + fields[9]]
+        header['data_offset'] = offset_name + fields[9] + fields[10]
+        headers[zip_info.filename] = header
+    return headers
+
+
+def read_manifest_elements(data):
+    # (element name, {attribute name: string value or raw value}) of every start element
+    strings = list()
+    resource_ids = list()
+    elements = list()
+    offset = struct.unpack_from('<H', data, 2)[0]
+    while offset < len(data):
+        chunk_type, header_size, chunk_size = struct.unpack_from('<HHI', data, offset)
+        chunk = data[offset:offset + chunk_size]
+        if chunk_type == xapktoapk.const_axml_chunk_type_string_pool:
+            strings = xapktoapk.axml_decode_string_pool(chunk)
+        elif chunk_type == xapktoapk.const_axml_chunk_type_resource_map:
+            resource_ids = list(struct.unpack_from('<%dI' % ((chunk_size - 8) // 4), chunk, 8))
+        elif chunk_type == xapktoapk.const_axml_chunk_type_start_element:
+            name_index, attribute_start, attribute_size, attribute_count = struct.unpack_from('<4xIHHH', chunk, header_size)
+            attributes = dict()
+            for attribute_index in range(attribute_count):
+                attribute_offset = header_size + attribute_start + attribute_index * attribute_size
+                attribute_name_index, raw_value, data_type, value_data = struct.unpack_from('<4xII3xBI', chunk, attribute_offset)
+                attribute_name = strings[attribute_name_index]
+                if attribute_name_index < len(resource_ids) and resource_ids[attribute_name_index] in xapktoapk.const_axml_attribute_ids.keys():
+                    attribute_name = xapktoapk.const_axml_attribute_ids[resource_ids[attribute_name_index]]
+                if data_type == xapktoapk.const_axml_value_type_string:
+                    string_value = strings[value_data]
+                    attributes[attribute_name] = string_value if raw_value == value_data else (strings[raw_value], string_value)
+                else:
+                    attributes[attribute_name] = value_data
+            elements.append((strings[name_index], attributes))
+        offset += chunk_size
+    return elements
+
+
+class ZipWriterTest(unittest.TestCase):
+
+    def check_written_apk(self, data, expected_entries):
+        with ZipFile(io.BytesIO(data), 'r') as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(sorted(zip_file.namelist()), sorted(expected_entries.keys()))
+            for name, (content, compress_type) in expected_entries.items():
+                self.assertEqual(zip_file.read(name), content)
+                self.assertEqual(zip_file.getinfo(name).compress_type, compress_type)
+            headers = read_local_headers(data, zip_file)
+            for zip_info in zip_file.infolist():
+                header = headers[zip_info.filename]
+                self.assertEqual(header['signature'], xapktoapk.const_zip_signature_local_file_header)
+                self.assertEqual(header['flags'] & xapktoapk.const_zip_flag_data_descriptor, 0)
+                self.assertEqual(header['method'], zip_info.compress_type)
+                self.assertEqual((header['crc'], header['compress_size'], header['file_size']), (zip_info.CRC, zip_info.compress_size, zip_info.file_size))
+                self.assertEqual(header['name'].decode('utf-8' if header['flags'] & xapktoapk.const_zip_flag_utf8 else 'cp437'), zip_info.filename)
+                if zip_info.compress_type == ZIP_STORED:
+                    alignment = 4096 if zip_info.filename.endswith('.so') else 4
+                    self.assertEqual(header['data_offset'] % alignment, 0, zip_info.filename)
+        return headers
+
+    def test_copy_and_write_entries(self):
+        entries_src = [
+            ('a', b'x' * 3, ZIP_STORED),
+            ('classes.dex', os.urandom(1001), ZIP_STORED),
+            ('lib/arm64-v8a/libfoo.so', os.urandom(5000), ZIP_STORED),
+            ('assets/text.txt', b'text ' * 300, ZIP_DEFLATED),
+            ('lib/x86/libbar.so', os.urandom(77), ZIP_STORED),
+            ('res/raw/odd_name_1.bin', os.urandom(13), ZIP_STORED),
+        ]
+        data_src = write_apk(entries_src)
+        file_dst = io.BytesIO()
+        cd_records = list()
+        with ZipFile(io.BytesIO(data_src), 'r') as zip_file_src:
+            file_src = zip_file_src.fp
+            for zip_info in sorted(zip_file_src.infolist(), key=lambda x: x.header_offset):
+                cd_records.append(xapktoapk.zip_copy_entry_raw(file_src, zip_info, file_dst))
+        written = dict()
+        for name, data, compress_type in [('resources.arsc', os.urandom(333), ZIP_STORED), ('res/values/ünï.xml', b'<resources/>' * 50, ZIP_DEFLATED), ('lib/armeabi-v7a/libbaz.so', os.urandom(10), ZIP_STORED)]:
+            zip_info = ZipInfo(name, date_time=(2020, 2, 29, 13, 37, 58))
+            zip_info.compress_type = compress_type
+            cd_records.append(xapktoapk.zip_write_entry_bytes(file_dst, zip_info, data))
+            written[name] = (data, compress_type)
+        xapktoapk.zip_write_central_directory(file_dst, cd_records)
+
+        expected_entries = dict([(name, (data, compress_type)) for name, data, compress_type in entries_src])
+        expected_entries.update(written)
+        headers = self.check_written_apk(file_dst.getvalue(), expected_entries)
+        self.assertTrue(headers['res/values/ünï.xml']['flags'] & xapktoapk.const_zip_flag_utf8)
+        with ZipFile(io.BytesIO(file_dst.getvalue()), 'r') as zip_file:
+            self.assertEqual(zip_file.getinfo('resources.arsc').date_time, (2020, 2, 29, 13, 37, 58))
+
+    def test_copy_entry_with_data_descriptor(self):
+        # zipfile writes a data descriptor when the output is not seekable, the copy must not keep the flag
+        class UnseekableBuffer(io.RawIOBase):
+            def __init__(self):
+                self.buffer = io.BytesIO()
+
+            def writable(self):
+                return True
+
+            def write(self, data):
+                return self.buffer.write(data)
+
+        buffer = UnseekableBuffer()
+        with ZipFile(buffer, 'w') as zip_file:
+            zip_file.writestr('assets/a.txt', b'abc' * 100, compress_type=ZIP_DEFLATED)
+            zip_file.writestr('lib/x86/liba.so', b'so' * 100, compress_type=ZIP_STORED)
+        data_src = buffer.buffer.getvalue()
+
+        file_dst = io.BytesIO()
+        file_dst.write(b'\0' * 7)
+        cd_records = list()
+        with ZipFile(io.BytesIO(data_src), 'r') as zip_file_src:
+            self.assertTrue(zip_file_src.getinfo('assets/a.txt').flag_bits & xapktoapk.const_zip_flag_data_descriptor)
+            for zip_info in zip_file_src.infolist():
+                cd_records.append(xapktoapk.zip_copy_entry_raw(zip_file_src.fp, zip_info, file_dst))
+        xapktoapk.zip_write_central_directory(file_dst, cd_records)
+        self.check_written_apk(file_dst.getvalue(), {'assets/a.txt': (b'abc' * 100, ZIP_DEFLATED), 'lib/x86/liba.so': (b'so' * 100, ZIP_STORED)})
+
+
+class RawMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path_dir = tempfile.mkdtemp()
+        self.path_xapk = os.path.join(self.path_dir, 'test.xapk')
+        self.manifest = xapktoapk.generate_binary_manifest(const_package_name, True)
+        self.dex = os.urandom(4321)
+        self.lib_arm = os.urandom(9999)
+        self.lib_x86 = os.urandom(1234)
+        base = write_apk([
+            ('AndroidManifest.xml', self.manifest, ZIP_DEFLATED),
+            ('classes.dex', self.dex, ZIP_STORED),
+            ('META-INF/CERT.RSA', b'signature', ZIP_DEFLATED),
+            ('META-INF/MANIFEST.MF', b'Manifest-Version: 1.0\r\n', ZIP_DEFLATED),
+        ])
+        arm = write_apk([('AndroidManifest.xml', b'split', ZIP_DEFLATED), ('lib/arm64-v8a/libnative.so', self.lib_arm, ZIP_STORED)])
+        x86 = write_apk([('AndroidManifest.xml', b'split', ZIP_DEFLATED), ('lib/x86/libnative.so', self.lib_x86, ZIP_STORED)])
+        with ZipFile(self.path_xapk, 'w') as zip_file:
+            zip_file.writestr('base.apk', base, compress_type=ZIP_STORED)
+            zip_file.writestr('config.arm64_v8a.apk', arm, compress_type=ZIP_DEFLATED)
+            zip_file.writestr('config.x86.apk', x86, compress_type=ZIP_STORED)
+        self.plan = dict()
+        self.plan['apk_main'] = {'apk_file_name': 'base.apk'}
+        self.plan['apks_arch'] = [{'apk_file_name': 'config.arm64_v8a.apk'}, {'apk_file_name': 'config.x86.apk'}]
+        self.plan['apks_arch_zip'] = list()
+        self.plan['apks_locale'] = list()
+
+    def tearDown(self):
+        shutil.rmtree(self.path_dir)
+
+    def write_raw_apk(self, abis):
+        native_libs = xapktoapk.create_native_libs_merge(abis)
+        file_dst = io.BytesIO()
+        xapktoapk.write_raw_apk(file_dst, self.path_xapk, self.plan, native_libs)
+        return file_dst.getvalue(), native_libs
+
+    def test_write_raw_apk(self):
+        data, native_libs = self.write_raw_apk(['arm64_v8a'])
+        with ZipFile(io.BytesIO(data), 'r') as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(sorted(zip_file.namelist()), ['AndroidManifest.xml', 'classes.dex', 'lib/arm64-v8a/libnative.so'])
+            self.assertEqual(zip_file.read('classes.dex'), self.dex)
+            self.assertEqual(zip_file.read('lib/arm64-v8a/libnative.so'), self.lib_arm)
+            headers = read_local_headers(data, zip_file)
+            self.assertEqual(headers['classes.dex']['data_offset'] % 4, 0)
+            self.assertEqual(headers['lib/arm64-v8a/libnative.so']['data_offset'] % 4096, 0)
+            manifest = zip_file.read('AndroidManifest.xml')
+        self.assertEqual(manifest, xapktoapk.patch_binary_manifest(self.manifest))
+        self.assertEqual((native_libs['stripped_files'], native_libs['conflicts']), (1, 0))
+
+    def test_write_raw_apk_all_abis(self):
+        data, native_libs = self.write_raw_apk(None)
+        with ZipFile(io.BytesIO(data), 'r') as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.read('lib/x86/libnative.so'), self.lib_x86)
+            headers = read_local_headers(data, zip_file)
+            for name in ['lib/arm64-v8a/libnative.so', 'lib/x86/libnative.so']:
+                self.assertEqual(headers[name]['data_offset'] % 4096, 0)
+        self.assertEqual(native_libs['stripped_files'], 0)
+
+
+@unittest.skipIf(xapktoapk.read_thread_io_counters() == (0, 0), 'per thread i/o counters are not available')
+class NestedApkReadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path_dir = tempfile.mkdtemp()
+        self.path_xapk = os.path.join(self.path_dir, 'test.xapk')
+        self.entries = [('lib/arm64-v8a/lib%d.so' % index, os.urandom(64 * 1024), ZIP_STORED) for index in range(32)]
+        self.entries.append(('assets/text.txt', b'text ' * 1000, ZIP_DEFLATED))
+        self.split = write_apk(self.entries)
+        with ZipFile(self.path_xapk, 'w') as zip_file:
+            zip_file.writestr('config.arm64_v8a.apk', self.split, compress_type=ZIP_STORED)
+            zip_file.writestr('config.deflated.apk', self.split, compress_type=ZIP_DEFLATED)
+
+    def tearDown(self):
+        shutil.rmtree(self.path_dir)
+
+    def copy_nested_entries(self, apk_file_name, prefixes):
+        # returns the copied apk and the bytes read from the xapk while its entries were listed and copied
+        file_dst = io.BytesIO()
+        cd_records = list()
+        with ZipFile(self.path_xapk, 'r') as xapk_zip_file:
+            read_start = xapktoapk.read_thread_io_counters()[0]
+            for apk_zip_file, file_apk, zip_info in xapktoapk.iterate_nested_apk_entries(xapk_zip_file, {'apk_file_name': apk_file_name}, prefixes, set()):
+                cd_records.append(xapktoapk.zip_copy_entry_raw(file_apk, zip_info, file_dst))
+            bytes_read = xapktoapk.read_thread_io_counters()[0] - read_start
+        xapktoapk.zip_write_central_directory(file_dst, cd_records)
+        return file_dst.getvalue(), bytes_read
+
+    def test_stored_split_is_read_once(self):
+        data, bytes_read = self.copy_nested_entries('config.arm64_v8a.apk', None)
+        with ZipFile(io.BytesIO(data), 'r') as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(len(zip_file.infolist()), len(self.entries))
+        self.assertLess(bytes_read, len(self.split) * 1.2)
+
+    def test_stored_split_listing_reads_central_directory(self):
+        data, bytes_read = self.copy_nested_entries('config.arm64_v8a.apk', ['missing/'])
+        self.assertLess(bytes_read, len(self.split) // 10)
+
+    def test_deflated_split(self):
+        data, bytes_read = self.copy_nested_entries('config.deflated.apk', [const_apk_dir_lib_prefix])
+        with ZipFile(io.BytesIO(data), 'r') as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(sorted(zip_file.namelist()), sorted([name for name, data, compress_type in self.entries if name.startswith(const_apk_dir_lib_prefix)]))
+
+
+class PatchBinaryManifestTest(unittest.TestCase):
+
+    def test_patch_split_markers(self):
+        data = xapktoapk.patch_binary_manifest(xapktoapk.generate_binary_manifest(const_package_name, True))
+        self.assertEqual(struct.unpack_from('<I', data, 4)[0], len(data))
+        elements = read_manifest_elements(data)
+        self.assertEqual([name for name, attributes in elements], ['manifest', 'application', 'meta-data'])
+        self.assertEqual(elements[0][1], {'package': const_package_name})
+        self.assertNotIn(xapktoapk.const_axml_attribute_split_required, elements[1][1])
+        self.assertEqual(elements[2][1], {'name': 'com.android.stamp.type', 'value': 'STAMP_TYPE_STANDALONE_APK'})
+
+    def test_patch_keeps_manifest_without_split_markers(self):
+        data = xapktoapk.generate_binary_manifest(const_package_name, False)
+        self.assertEqual(xapktoapk.patch_binary_manifest(data), data)
+
+    def test_patch_rejects_other_formats(self):
+        with self.assertRaises(Exception):
+            xapktoapk.patch_binary_manifest(b'<?xml version="1.0"?><manifest/>')
+
+    def test_patch_keeps_uses_sdk(self):
+        data = xapktoapk.patch_binary_manifest(xapktoapk.generate_binary_manifest(const_package_name, True, 21))
+        self.assertEqual(xapktoapk.read_binary_manifest_min_sdk_version(data), 21)
+
+
+class MinSdkVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path_dir = tempfile.mkdtemp()
+        self.path_xapk = os.path.join(self.path_dir, 'test.xapk')
+        base = write_apk([('AndroidManifest.xml', xapktoapk.generate_binary_manifest(const_package_name, True, 21), ZIP_DEFLATED)])
+        with ZipFile(self.path_xapk, 'w') as zip_file:
+            zip_file.writestr('base.apk', base, compress_type=ZIP_STORED)
+        self.sign_config = {xapktoapk.const_sign_property_engine: xapktoapk.const_sign_engine_python}
+
+    def tearDown(self):
+        shutil.rmtree(self.path_dir)
+
+    def test_read_binary_manifest(self):
+        self.assertEqual(xapktoapk.read_binary_manifest_min_sdk_version(xapktoapk.generate_binary_manifest(const_package_name, False, 24)), 24)
+        self.assertIsNone(xapktoapk.read_binary_manifest_min_sdk_version(xapktoapk.generate_binary_manifest(const_package_name, False)))
+
+    def test_xapk_manifest_first(self):
+        with ZipFile(self.path_xapk, 'r') as xapk_zip_file:
+            apk_main = {'apk_file_name': 'base.apk'}
+            self.assertEqual(xapktoapk.read_min_sdk_version(xapk_zip_file, {'min_sdk_version': '26'}, apk_main), 26)
+            self.assertEqual(xapktoapk.read_min_sdk_version(xapk_zip_file, dict(), apk_main), 21)
+            self.assertIsNone(xapktoapk.read_min_sdk_version(xapk_zip_file, dict(), {'apk_file_name': 'missing.apk'}))
+
+    def test_sign_engine(self):
+        self.assertEqual(xapktoapk.get_plan_sign_engine({'min_sdk_version': 24}, self.sign_config), xapktoapk.const_sign_engine_python)
+        self.assertEqual(xapktoapk.get_plan_sign_engine({'min_sdk_version': 23}, self.sign_config), xapktoapk.const_sign_engine_apksigner)
+        self.assertEqual(xapktoapk.get_plan_sign_engine({'min_sdk_version': None}, self.sign_config), xapktoapk.const_sign_engine_apksigner)
+        self.assertEqual(xapktoapk.get_plan_sign_engine({'min_sdk_version': 30}, dict()), xapktoapk.const_sign_engine_apksigner)
+
+    def test_sign_config_falls_back_to_apksigner(self):
+        self.assertIs(xapktoapk.get_plan_sign_config({'min_sdk_version': 24}, self.sign_config), self.sign_config)
+        with mock.patch.object(xapktoapk, 'check_if_executable_exists_in_path', return_value=True):
+            sign_config = xapktoapk.get_plan_sign_config({'min_sdk_version': 21}, self.sign_config)
+        self.assertEqual(sign_config[xapktoapk.const_sign_property_engine], xapktoapk.const_sign_engine_apksigner)
+        self.assertEqual(self.sign_config[xapktoapk.const_sign_property_engine], xapktoapk.const_sign_engine_python)
+        with mock.patch.object(xapktoapk, 'check_if_executable_exists_in_path', return_value=False):
+            with self.assertRaises(Exception):
+                xapktoapk.get_plan_sign_config({'min_sdk_version': 21}, self.sign_config)
+
+
+if __name__ == '__main__':
+    unittest.main()
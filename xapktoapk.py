@@ -1,34 +1,58 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import glob
+import hashlib
 import json
+import multiprocessing
+import multiprocessing.util
 import os
 import platform
 import shutil
+import signal
+import socketserver
+import struct
 import sys
-from distutils.spawn import find_executable
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
 from zipfile import ZipFile
 
-from subprocess import call, STDOUT
+from subprocess import Popen, PIPE, STDOUT
 try:
     from subprocess import DEVNULL
 except ImportError:
     import os
     DEVNULL = open(os.devnull, 'wb')
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+try:
+    import xapktoapk_signer
+except ImportError:
+    xapktoapk_signer = None
 
 
 const_dir_tmp = ".xapktoapk"
-const_file_target_file = "target"
 const_ext_apk = ".apk"
 const_ext_xapk = ".xapk"
-const_ext_zip = ".zip"
 
 const_file_xapk_manifest = "manifest.json"
 const_file_xapk_manifest_key_package_name = "package_name"
+const_file_xapk_manifest_key_min_sdk_version = "min_sdk_version"
 
 const_prefix_apk_split_type_config = "config"
 const_suffix_apk_split_type_dpi = "dpi"
-const_values_apk_split_type_arch = [ "arm64_v8a", "armeabi", "x86", "x86_64" ]
+const_values_apk_split_type_arch = [ "arm64_v8a", "armeabi", "armeabi_v7a", "x86", "x86_64", "mips", "mips64", "riscv64" ]
+const_values_apk_split_dpi_densities = { "ldpi": 120, "mdpi": 160, "tvdpi": 213, "hdpi": 240, "xhdpi": 320, "xxhdpi": 480, "xxxhdpi": 640 }
 
 const_split_apk_type_main = "main"
 const_split_apk_type_arch = "arch"
@@ -36,36 +60,388 @@ const_split_apk_type_dpi = "dpi"
 const_split_apk_type_locale = "locale"
 
 const_apk_file_apktool_config = 'apktool.yml'
+const_apktool_config_do_not_compress = 'doNotCompress:'
+const_apktool_config_list_prefix = '- '
+const_apk_file_resources_table = 'resources.arsc'
 const_apk_dir_lib = 'lib'
+const_apk_dir_res = 'res'
+const_apk_dir_asset_pack = 'assets/assetpack'
+
+const_merge_skip_suffix_public_values = 'values/public.xml'
+const_values_dir_prefix = 'values'
+const_values_file_public = 'public.xml'
+const_values_xml_root_close = b'</resources>'
+const_values_xml_tail_size = 4096
+const_values_xml_entry_indent = '    '
+const_values_xml_type_aliases = { 'string-array': 'array', 'integer-array': 'array' }
+const_merge_parallel_copy_min_files = 256
+const_ioctl_ficlone = 0x40049409
 
 const_sign_config_properties_file = 'xapktoapk.sign.properties'
+const_sign_property_engine = 'sign.engine'
+const_sign_engine_apksigner = 'apksigner'
+const_sign_engine_python = 'python'
+# apk signature scheme v2 is verified since android 7.0, older versions need the v1 signature that only apksigner writes
+const_sign_engine_python_min_sdk = 24
+
+const_extract_chunk_size = 1024 * 1024
+
+const_zip_signature_local_file_header = 0x04034b50
+const_zip_signature_central_directory = 0x02014b50
+const_zip_signature_end_of_central_directory = 0x06054b50
+const_zip_size_local_file_header = 30
+const_zip_size_end_of_central_directory = 22
+const_zip_max_value_u32 = 0xFFFFFFFF
+const_zip_max_value_u16 = 0xFFFF
+const_zip_flag_data_descriptor = 0x08
+const_zip_flag_utf8 = 0x800
+const_zip_alignment_default = 4
+const_zip_alignment_shared_library = 4096
+const_zip_compression_stored = 0
+const_zip_compression_deflated = 8
+const_zip_signature_file_extensions = [ '.SF', '.RSA', '.DSA', '.EC' ]
+const_zip_signature_manifest_file = 'META-INF/MANIFEST.MF'
+
+const_axml_chunk_type_string_pool = 0x0001
+const_axml_chunk_type_xml = 0x0003
+const_axml_chunk_type_resource_map = 0x0180
+const_axml_chunk_type_start_element = 0x0102
+const_axml_chunk_type_end_element = 0x0103
+const_axml_chunk_type_namespace_start = 0x0100
+const_axml_chunk_type_namespace_end = 0x0101
+const_axml_namespace_android = 'http://schemas.android.com/apk/res/android'
+const_axml_string_pool_flag_sorted = 0x01
+const_axml_string_pool_flag_utf8 = 0x100
+const_axml_value_type_string = 0x03
+const_axml_value_type_int_dec = 0x10
+const_axml_value_type_int_hex = 0x11
+const_axml_value_type_boolean = 0x12
+const_axml_no_index = 0xFFFFFFFF
+const_axml_attribute_ids = { 0x01010003: 'name', 0x01010024: 'value', 0x0101020c: 'minSdkVersion', 0x01010591: 'isSplitRequired' }
+const_axml_element_application = 'application'
+const_axml_element_uses_sdk = 'uses-sdk'
+const_axml_attribute_min_sdk_version = 'minSdkVersion'
+const_axml_element_meta_data = 'meta-data'
+const_axml_attribute_split_required = 'isSplitRequired'
+const_axml_meta_data_removed = [ 'com.android.vending.splits.required', 'com.android.vending.splits' ]
+const_axml_meta_data_replaced_values = { 'STAMP_TYPE_DISTRIBUTION_APK': 'STAMP_TYPE_STANDALONE_APK' }
+
+const_decode_cache_dir_entries = 'entries'
+const_decode_cache_dir_tmp = 'tmp'
+const_decode_cache_dir_tree = 'tree'
+const_decode_cache_file_lock = 'lock'
+const_decode_cache_file_meta = 'meta.json'
+const_decode_cache_size_default_mb = 10240
+# files that are rewritten in place during the merge and must never be hardlinked to the cache
+const_decode_cache_files_copied = [ 'apktool.yml', 'AndroidManifest.xml' ]
+
+# part of every key of the incremental state, bumped whenever the decode or the merge changes the trees they produce
+const_incremental_state_version = 2
+const_incremental_file_state = 'state.json'
+const_incremental_file_built_apk = 'built.apk'
+const_incremental_dir_splits = 'splits'
+const_incremental_dir_merged = 'merged'
+const_incremental_native_libs_counters = [ 'stripped_files', 'stripped_bytes', 'duplicate_files', 'duplicate_bytes', 'conflicts' ]
+
+const_variant_separator_dpi = ':'
+const_variant_separator_values = '+'
+const_variant_values_all = [ 'all', 'universal' ]
+const_variant_dir = 'variants'
+
+# rough upper bounds of the disk space a stage needs, relative to the uncompressed size of its input
+const_low_footprint_decode_factor = 2
+const_low_footprint_build_factor = 2
+
+const_command_inspect = 'inspect'
+const_inspect_version = 1
+# rough rates of a typical machine, used by inspect to estimate the cost of a conversion before it is started
+const_estimate_jvm_start_time = 1.5
+const_estimate_decode_rate_mb = 25.0
+const_estimate_build_rate_mb = 15.0
+const_estimate_copy_rate_mb = 150.0
+const_estimate_hash_rate_mb = 500.0
+const_file_xapk_manifest_key_expansions = 'expansions'
+const_file_xapk_manifest_key_expansion_file = 'file'
+const_file_xapk_manifest_key_expansion_install_path = 'install_path'
+const_ext_obb = '.obb'
+
+const_service_unix_prefix = 'unix:'
+const_service_default_host = '127.0.0.1'
+const_service_queue_size_default = 16
+const_service_finished_jobs_kept = 1000
+
+const_apktool_daemon_class_name = 'XapkToApkApktoolDaemon'
+const_apktool_daemon_java_options = [ '-Xmx1024M', '-Duser.language=en', '-Dfile.encoding=UTF8', '-Djdk.util.zip.disableZip64ExtraFieldValidation=true', '-Djdk.nio.zipfs.allowDotZipEntry=true' ]
+const_apktool_daemon_response_ready = 'READY'
+const_apktool_daemon_response_ok = 'OK'
+const_apktool_daemon_java_source = """
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+
+public class XapkToApkApktoolDaemon {
+    public static void main(String[] args) throws Exception {
+        PrintStream out = System.out;
+        PrintStream err = System.err;
+        PrintStream nullStream = new PrintStream(OutputStream.nullOutputStream());
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        Method apktoolMain = Class.forName("brut.apktool.Main").getMethod("main", String[].class);
+        out.println("READY");
+        out.flush();
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] command = line.split("\t", -1);
+            String result = "OK";
+            System.setOut(nullStream);
+            System.setErr(nullStream);
+            try {
+                apktoolMain.invoke(null, (Object) command);
+            } catch (InvocationTargetException e) {
+                result = "ERR " + String.valueOf(e.getCause()).replace('\n', ' ');
+            } catch (Throwable e) {
+                result = "ERR " + String.valueOf(e).replace('\n', ' ');
+            } finally {
+                System.setOut(out);
+                System.setErr(err);
+            }
+            out.println(result);
+            out.flush();
+        }
+    }
+}
+"""
+
+const_report_version = 1
+const_report_thread_io_file = '/proc/thread-self/io'
+const_report_block_size = 512
+
+const_option_prefix = '--'
+const_option_jobs = 'jobs'
+const_option_dpi = 'dpi'
+const_option_abi = 'abi'
+const_option_locale = 'locale'
+const_option_apktool_jar = 'apktool-jar'
+const_option_cache_dir = 'cache-dir'
+const_option_cache_size = 'cache-size'
+const_option_batch_jobs = 'batch-jobs'
+const_option_report_json = 'report-json'
+const_option_incremental_dir = 'incremental-dir'
+const_option_variants = 'variants'
+const_option_serve = 'serve'
+const_option_queue_size = 'queue-size'
+const_option_max_jvm = 'max-jvm'
+const_option_max_disk = 'max-disk'
+const_options_with_value = [ const_option_jobs, const_option_dpi, const_option_abi, const_option_locale, const_option_apktool_jar, const_option_cache_dir, const_option_cache_size, const_option_batch_jobs, const_option_report_json, const_option_incremental_dir, const_option_variants, const_option_serve, const_option_queue_size, const_option_max_jvm, const_option_max_disk ]
+const_option_decode_arch = 'decode-arch'
+const_option_apktool_daemon = 'apktool-daemon'
+const_option_raw_merge = 'raw-merge'
+const_option_profile = 'profile'
+const_option_low_footprint = 'low-footprint'
+const_options_flags = [ const_option_decode_arch, const_option_apktool_daemon, const_option_raw_merge, const_option_profile, const_option_low_footprint ]
+# options a client may set per job, everything else is fixed when the service starts
+const_service_job_options = [ const_option_dpi, const_option_abi, const_option_locale, const_option_variants, const_option_decode_arch, const_option_raw_merge, const_option_low_footprint ]
 
 
 def print_help():
     print("")
     print("XapkToApk is a tool that converts .xapk file into .apk file")
     print("Can be useful if you want to build a classic fat apk from splitted app bundle")
-    print("Usage: python xapktoapk.py PATH_TO_FILE.xapk")
+    print("Usage: python xapktoapk.py [OPTIONS] PATH_TO_FILE.xapk")
+    print("       python xapktoapk.py [OPTIONS] PATH_TO_FILE.xapk|PATH_TO_DIR [PATH_TO_FILE.xapk|PATH_TO_DIR ...]")
+    print("       python xapktoapk.py [OPTIONS] inspect PATH_TO_FILE.xapk|PATH_TO_DIR [...]   print the merge plan and the estimated cost as json, nothing is extracted")
+    print("")
+    print("Options:")
+    print("  --jobs N              decode up to N split apks in parallel (default: 1)")
+    print("  --batch-jobs N        convert up to N xapk files in parallel in batch mode (default: depends on cpu count)")
+    print("  --dpi DPI[,DPI...]    keep only the dpi splits that best match the target densities, e.g. xxhdpi")
+    print("  --abi ABI[,ABI...]    keep only the native libraries of these abis, e.g. arm64_v8a")
+    print("  --locale LANG[,...]   keep only the language splits of these locales, e.g. en,de")
+    print("  --variants SPEC,...   build one apk per variant from a single decode, SPEC is ABI[+ABI...][:DPI[+DPI...]] or universal")
+    print("  --decode-arch         decode abi splits with apktool instead of copying native libraries directly")
+    print("  --low-footprint       extract splits lazily, delete them once merged, check free space before every stage and write obb files straight to the output directory")
+    print("  --raw-merge           build the apk straight from the original zip entries when no resources have to be merged")
+    print("  --apktool-daemon      run apktool in long-lived jvms instead of starting a new jvm for every call")
+    print("  --apktool-jar PATH    path to apktool.jar used by --apktool-daemon (default: next to apktool in $PATH)")
+    print("  --serve ADDRESS       run as a service that converts xapk files submitted over http, ADDRESS is [HOST:]PORT or unix:PATH")
+    print("  --queue-size N        number of jobs the service accepts before it rejects new ones (default: %d)" % const_service_queue_size_default)
+    print("  --profile             print wall time, cpu time, peak memory and i/o of every conversion stage")
+    print("  --report-json PATH    write the per-stage and per-split measurements to a json report")
+    print("  --max-jvm N           run at most N apktool and apksigner processes at once, shared by all parallel conversions")
+    print("  --max-disk N          run at most N disk heavy stages (extract, merge, apk write) at once, shared by all parallel conversions")
+    print("  --cache-dir DIR       reuse decoded splits from a persistent cache directory shared between runs")
+    print("  --incremental-dir DIR keep the decoded splits and the built apk of every package, and only redo the splits that changed")
+    print("  --cache-size MB       size limit of the decode cache, least recently used entries are evicted (default: %d)" % const_decode_cache_size_default_mb)
     print("")
 
 
+def parse_sys_args():
+    options = dict()
+    positional_args = list()
+    args = sys.argv[1:]
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        index += 1
+        if not arg.startswith(const_option_prefix):
+            positional_args.append(arg)
+            continue
+        option_name = arg[len(const_option_prefix):]
+        option_value = None
+        if '=' in option_name:
+            option_name, option_value = option_name.split('=', 1)
+        if option_name in const_options_flags and option_value is None:
+            options[option_name] = True
+        elif option_name in const_options_with_value:
+            if option_value is None:
+                if index >= len(args):
+                    return None, None
+                option_value = args[index]
+                index += 1
+            options[option_name] = option_value
+        else:
+            return None, None
+    return options, positional_args
+
+
 def get_param_xapk_file_name():
-    return sys.argv[1]
+    return parse_sys_args()[1][0]
 
 
 def get_param_xapk_abs_path():
     return os.path.abspath(get_param_xapk_file_name())
 
 
+def get_param_jobs(options):
+    return int(options.get(const_option_jobs, 1))
+
+
+def get_param_variants(options):
+    if const_option_variants not in options.keys():
+        return None
+    variants = list()
+    for spec in get_param_list(options, const_option_variants):
+        abis, dpis = (spec.split(const_variant_separator_dpi, 1) + [None])[:2]
+        variant = dict()
+        variant['name'] = spec.replace(const_variant_separator_dpi, '-').replace(const_variant_separator_values, '-')
+        variant['abi'] = None if abis.lower() in const_variant_values_all else abis.replace(const_variant_separator_values, ',')
+        variant['dpi'] = None if dpis is None or dpis.lower() in const_variant_values_all else dpis.replace(const_variant_separator_values, ',')
+        variants.append(variant)
+    return variants
+
+
+def get_variant_options(options, variant):
+    variant_options = dict(options)
+    for option_name in [const_option_abi, const_option_dpi]:
+        variant_options.pop(option_name, None)
+        if variant[option_name] is not None:
+            variant_options[option_name] = variant[option_name]
+    return variant_options
+
+
+def get_param_list(options, option_name):
+    if option_name not in options.keys():
+        return None
+    values = list()
+    for value in options[option_name].split(','):
+        value = value.strip()
+        if value != '':
+            values.append(value)
+    return values
+
+
+def get_param_batch_jobs(options, files_count):
+    if const_option_batch_jobs in options.keys():
+        return int(options[const_option_batch_jobs])
+    if const_option_max_jvm in options.keys():
+        # the jvm slots bound the load, the extra conversions keep extracting, merging and writing while others wait for a slot
+        return max(1, min(files_count, 2 * int(options[const_option_max_jvm])))
+    # every conversion keeps at least one multithreaded jvm busy, leave a couple of cores to each of them
+    cpu_count = os.cpu_count() or 1
+    return max(1, min(files_count, cpu_count // (2 * get_param_jobs(options))))
+
+
+def is_inspect_command(positional_args):
+    return len(positional_args) > 0 and positional_args[0] == const_command_inspect
+
+
+def is_batch_mode(positional_args):
+    return len(positional_args) > 1 or os.path.isdir(positional_args[0])
+
+
+def collect_xapk_files(positional_args):
+    result = list()
+    for arg in positional_args:
+        path = os.path.abspath(arg)
+        if os.path.isdir(path):
+            for file in sorted(os.listdir(path)):
+                path_file = os.path.join(path, file)
+                if file.endswith(const_ext_xapk) and os.path.isfile(path_file):
+                    result.append(path_file)
+        elif path not in result:
+            result.append(path)
+    return result
+
+
+def is_valid_dpi_list(target_dpis):
+    return target_dpis is None or all([get_dpi_density(target_dpi.lower()) is not None for target_dpi in target_dpis])
+
+
+def is_valid_abi_list(target_abis):
+    return target_abis is None or (len(target_abis) > 0 and all([normalize_abi_name(abi) in const_values_apk_split_type_arch for abi in target_abis]))
+
+
+def find_invalid_option(options):
+    # returns the name of the first option with an invalid value, used for the command line and for the jobs of the service
+    for option_name, value_min in [(const_option_jobs, 1), (const_option_batch_jobs, 1), (const_option_cache_size, 0), (const_option_max_jvm, 1), (const_option_max_disk, 1)]:
+        try:
+            if int(options.get(option_name, value_min)) < value_min:
+                return option_name
+        except ValueError:
+            return option_name
+    if not is_valid_dpi_list(get_param_list(options, const_option_dpi)):
+        return const_option_dpi
+    if not is_valid_abi_list(get_param_list(options, const_option_abi)):
+        return const_option_abi
+    variants = get_param_variants(options)
+    if variants is not None:
+        if len(variants) == 0 or len(set([variant['name'] for variant in variants])) != len(variants):
+            return const_option_variants
+        for variant in variants:
+            variant_options = get_variant_options(dict(), variant)
+            if not is_valid_dpi_list(get_param_list(variant_options, const_option_dpi)) or not is_valid_abi_list(get_param_list(variant_options, const_option_abi)):
+                return const_option_variants
+    return None
+
+
 def check_sys_args():
-    if len(sys.argv) != 2:
+    options, positional_args = parse_sys_args()
+    if options is None:
         return False
-    xapk_file_name = get_param_xapk_file_name()
-    if not xapk_file_name.endswith(const_ext_xapk):
+    if const_option_serve in options.keys():
+        if len(positional_args) > 0 or parse_service_address(options[const_option_serve]) is None:
+            return False
+        try:
+            if int(options.get(const_option_queue_size, const_service_queue_size_default)) < 1:
+                return False
+        except ValueError:
+            return False
+    elif len(positional_args) < 1 or (is_inspect_command(positional_args) and len(positional_args) < 2):
         return False
-    abspath_to_xapk_file = os.path.abspath(xapk_file_name)
-    if not os.path.exists(abspath_to_xapk_file):
+    if find_invalid_option(options) is not None:
         return False
+    if is_inspect_command(positional_args):
+        positional_args = positional_args[1:]
+    for xapk_file_name in positional_args:
+        abspath_to_xapk_file = os.path.abspath(xapk_file_name)
+        if os.path.isdir(abspath_to_xapk_file):
+            continue
+        if not xapk_file_name.endswith(const_ext_xapk):
+            return False
+        if not os.path.exists(abspath_to_xapk_file):
+            return False
     return True
 
 
@@ -74,11 +450,313 @@ def execute_command_os_system(command):
     return rc
 
 
-def execute_command_subprocess(command_tokens_list):
-    rc = call(command_tokens_list, stdout=DEVNULL, stderr=STDOUT)
+def execute_command_subprocess(command_tokens_list, cwd=None):
+    time_start = time.time()
+    process = Popen(command_tokens_list, stdout=DEVNULL, stderr=STDOUT, cwd=cwd)
+    rusage = None
+    if hasattr(os, 'wait4'):
+        # wait4 gives the resource usage of this particular child, not of all children of the process
+        pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        rc = process.returncode
+    else:
+        rc = process.wait()
+    profile_record_child_process(command_tokens_list, time.time() - time_start, rusage)
     return rc
 
 
+def create_report(xapk_file_abs_path):
+    report = dict()
+    report['file'] = xapk_file_abs_path
+    report['package_name'] = None
+    report['status'] = None
+    report['error'] = None
+    report['wall_time'] = 0.0
+    report['bytes_written'] = dict()
+    report['native_libs'] = { 'stripped_files': 0, 'stripped_bytes': 0, 'duplicate_files': 0, 'duplicate_bytes': 0, 'conflicts': 0 }
+    report['stages'] = list()
+    report['skipped_stages'] = list()
+    return report
+
+
+def read_thread_io_counters():
+    try:
+        with open(const_report_thread_io_file, 'r') as file:
+            counters = dict()
+            for line in file:
+                key, value = line.split(':', 1)
+                counters[key.strip()] = int(value)
+        return counters['rchar'], counters['wchar']
+    except (IOError, OSError, KeyError, ValueError):
+        return 0, 0
+
+
+@contextmanager
+def profile_stage(report, name, split=None):
+    stage = dict()
+    stage['name'] = name
+    stage['split'] = split
+    stage['files'] = None
+    stage['children'] = list()
+    stages = getattr(profile_thread_state, 'stages', None)
+    if stages is None:
+        stages = list()
+        profile_thread_state.stages = stages
+    stages.append(stage)
+    wall_start = time.time()
+    cpu_start = time.thread_time()
+    read_start, write_start = read_thread_io_counters()
+    try:
+        yield stage
+    finally:
+        stages.pop()
+        read_end, write_end = read_thread_io_counters()
+        stage['wall_time'] = time.time() - wall_start
+        stage['cpu_time'] = time.thread_time() - cpu_start + sum([child.get('cpu_time', 0.0) for child in stage['children']])
+        stage['read_bytes'] = read_end - read_start + sum([child.get('read_bytes', 0) for child in stage['children']])
+        stage['write_bytes'] = write_end - write_start + sum([child.get('write_bytes', 0) for child in stage['children']])
+        stage['peak_rss_kb'] = max([child.get('peak_rss_kb', 0) for child in stage['children']] + [0])
+        if report is not None:
+            report['stages'].append(stage)
+
+
+def profile_record_child_process(command_tokens_list, wall_time, rusage, daemon=False):
+    stages = getattr(profile_thread_state, 'stages', None)
+    if not stages:
+        return
+    child = dict()
+    child['command'] = ' '.join([os.path.basename(token) for token in command_tokens_list[:2]])
+    child['daemon'] = daemon
+    child['wall_time'] = wall_time
+    if rusage is not None:
+        child['cpu_time'] = rusage.ru_utime + rusage.ru_stime
+        child['peak_rss_kb'] = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+        child['read_bytes'] = rusage.ru_inblock * const_report_block_size
+        child['write_bytes'] = rusage.ru_oublock * const_report_block_size
+    stages[-1]['children'].append(child)
+
+
+def count_files_in_dir(path_dir):
+    count = 0
+    for root, dirs, files in os.walk(path_dir):
+        count += len(files)
+    return count
+
+
+def print_profile_report(reports):
+    totals = dict()
+    names = list()
+    for report in reports:
+        for stage in report['stages']:
+            if stage['name'] not in totals.keys():
+                names.append(stage['name'])
+                totals[stage['name']] = { 'count': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss_kb': 0, 'read_bytes': 0, 'write_bytes': 0, 'files': 0 }
+            total = totals[stage['name']]
+            total['count'] += 1
+            total['wall_time'] += stage['wall_time']
+            total['cpu_time'] += stage['cpu_time']
+            total['peak_rss_kb'] = max(total['peak_rss_kb'], stage['peak_rss_kb'])
+            total['read_bytes'] += stage['read_bytes']
+            total['write_bytes'] += stage['write_bytes']
+            total['files'] += stage['files'] or 0
+    print('[*] profile:')
+    print('[*]   %-16s %6s %10s %10s %12s %10s %10s %8s' % ('stage', 'count', 'wall s', 'cpu s', 'peak rss MB', 'read MB', 'write MB', 'files'))
+    for name in names:
+        total = totals[name]
+        print('[*]   %-16s %6d %10.2f %10.2f %12.1f %10.1f %10.1f %8d' % (name, total['count'], total['wall_time'], total['cpu_time'], total['peak_rss_kb'] / 1024.0, total['read_bytes'] / 1024.0 / 1024.0, total['write_bytes'] / 1024.0 / 1024.0, total['files']))
+
+
+def write_report_json(path_report, reports):
+    data = dict()
+    data['version'] = const_report_version
+    data['created'] = time.time()
+    data['host'] = platform.node()
+    data['jobs'] = reports
+    with open(path_report, 'w') as file:
+        json.dump(data, file, indent=2)
+
+
+def get_process_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+print_lock = threading.Lock()
+profile_thread_state = threading.local()
+stage_slots = { 'jvm': None, 'disk': None }
+apktool_stats = { 'time': 0.0, 'calls': 0, 'daemon_calls': 0 }
+apktool_stats_lock = threading.Lock()
+apktool_daemon_pool = dict()
+apktool_identity = dict()
+apktool_daemon_pool_lock = threading.Lock()
+sign_keys = dict()
+sign_keys_lock = threading.Lock()
+# read once while only the main thread runs, the umask cannot be read without changing it
+process_umask = get_process_umask()
+
+
+def find_apktool_jar(path_apktool_jar=None):
+    if path_apktool_jar is not None:
+        return os.path.abspath(path_apktool_jar) if os.path.isfile(path_apktool_jar) else None
+    path_apktool = shutil.which('apktool')
+    if path_apktool is None:
+        return None
+    dir_apktool = os.path.dirname(os.path.realpath(path_apktool))
+    candidates = list()
+    candidates.extend(sorted(glob.glob(os.path.join(dir_apktool, 'apktool*.jar'))))
+    candidates.extend(sorted(glob.glob(os.path.join(dir_apktool, os.pardir, 'libexec', 'apktool*.jar'))))
+    candidates.append('/usr/share/java/apktool.jar')
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return os.path.abspath(candidate)
+    return None
+
+
+def start_apktool_daemon_pool(size, path_apktool_jar=None):
+    path_jar = find_apktool_jar(path_apktool_jar)
+    if path_jar is None or not check_if_executable_exists_in_path('java'):
+        print('[!] apktool.jar or java not found, apktool daemon is disabled')
+        return False
+    path_dir_daemon = tempfile.mkdtemp(prefix=const_dir_tmp)
+    path_source = os.path.join(path_dir_daemon, const_apktool_daemon_class_name + '.java')
+    with open(path_source, 'w') as file:
+        file.write(const_apktool_daemon_java_source)
+    with apktool_daemon_pool_lock:
+        apktool_daemon_pool['command'] = ['java'] + const_apktool_daemon_java_options + ['-cp', path_jar, path_source]
+        apktool_daemon_pool['dir'] = path_dir_daemon
+        apktool_daemon_pool['idle'] = [None] * size
+        apktool_daemon_pool['condition'] = threading.Condition(apktool_daemon_pool_lock)
+        apktool_daemon_pool['enabled'] = True
+    return True
+
+
+def stop_apktool_daemon_pool():
+    with apktool_daemon_pool_lock:
+        if not apktool_daemon_pool.get('enabled', False):
+            return
+        apktool_daemon_pool['enabled'] = False
+        daemons = [daemon for daemon in apktool_daemon_pool['idle'] if daemon is not None]
+        apktool_daemon_pool['idle'] = list()
+    for daemon in daemons:
+        stop_apktool_daemon(daemon)
+    shutil.rmtree(apktool_daemon_pool['dir'], ignore_errors=True)
+
+
+def start_apktool_daemon():
+    process = Popen(apktool_daemon_pool['command'], stdin=PIPE, stdout=PIPE, stderr=DEVNULL, universal_newlines=True, encoding='utf-8')
+    if process.stdout.readline().strip() != const_apktool_daemon_response_ready:
+        stop_apktool_daemon(process)
+        return None
+    return process
+
+
+def stop_apktool_daemon(daemon):
+    try:
+        daemon.stdin.close()
+    except (IOError, OSError):
+        pass
+    try:
+        daemon.wait(timeout=10)
+    except Exception:
+        daemon.kill()
+
+
+def acquire_apktool_daemon():
+    with apktool_daemon_pool_lock:
+        while apktool_daemon_pool.get('enabled', False) and len(apktool_daemon_pool['idle']) == 0:
+            apktool_daemon_pool['condition'].wait()
+        if not apktool_daemon_pool.get('enabled', False):
+            return False, None
+        daemon = apktool_daemon_pool['idle'].pop()
+    if daemon is None or daemon.poll() is not None:
+        daemon = start_apktool_daemon()
+        if daemon is None:
+            print_synchronized('[!] failed to start apktool daemon, falling back to apktool subprocesses')
+            with apktool_daemon_pool_lock:
+                apktool_daemon_pool['enabled'] = False
+                apktool_daemon_pool['condition'].notify_all()
+            return False, None
+    return True, daemon
+
+
+def release_apktool_daemon(daemon):
+    with apktool_daemon_pool_lock:
+        if not apktool_daemon_pool.get('enabled', False):
+            if daemon is not None:
+                stop_apktool_daemon(daemon)
+            return
+        apktool_daemon_pool['idle'].append(daemon)
+        apktool_daemon_pool['condition'].notify()
+
+
+def execute_apktool_daemon(daemon, command_args):
+    daemon.stdin.write('\t'.join(command_args) + '\n')
+    daemon.stdin.flush()
+    response = daemon.stdout.readline().strip()
+    if response != '':
+        return (0 if response == const_apktool_daemon_response_ok else 1), daemon
+    # apktool called System.exit(), its exit code is the result of the command
+    rc = daemon.wait()
+    return rc, None
+
+
+def execute_apktool(command_args, cwd=None):
+    # waiting for a jvm slot is not counted as apktool time
+    with acquire_stage_slot('jvm'):
+        time_start = time.time()
+        used_daemon = False
+        rc = None
+        if all(['\t' not in arg and '\n' not in arg for arg in command_args]):
+            used_daemon, daemon = acquire_apktool_daemon()
+            if used_daemon:
+                try:
+                    rc, daemon = execute_apktool_daemon(daemon, command_args)
+                    profile_record_child_process(['apktool'] + command_args, time.time() - time_start, None, daemon=True)
+                except (IOError, OSError):
+                    used_daemon = False
+                finally:
+                    release_apktool_daemon(daemon)
+        if rc is None:
+            rc = execute_command_subprocess(['apktool'] + command_args, cwd=cwd)
+        with apktool_stats_lock:
+            apktool_stats['time'] += time.time() - time_start
+            apktool_stats['calls'] += 1
+            if used_daemon:
+                apktool_stats['daemon_calls'] += 1
+        return rc
+
+
+def create_stage_slots(options):
+    # process shared semaphores, so the limits also hold for the worker processes of batch and service mode
+    slots = dict()
+    slots['jvm'] = multiprocessing.Semaphore(int(options[const_option_max_jvm])) if const_option_max_jvm in options.keys() else None
+    slots['disk'] = multiprocessing.Semaphore(int(options[const_option_max_disk])) if const_option_max_disk in options.keys() else None
+    return slots
+
+
+def set_stage_slots(slots):
+    stage_slots.update(slots)
+
+
+@contextmanager
+def acquire_stage_slot(kind):
+    semaphore = stage_slots[kind]
+    if semaphore is None:
+        yield
+        return
+    semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def print_synchronized(message):
+    with print_lock:
+        print(message)
+
+
 def is_windows():
     return platform.system() == "Windows"
 
@@ -87,25 +765,21 @@ def windows_hide_file(file_path):
     execute_command_subprocess(["attrib", "+h", file_path])
 
 
-def create_or_recreate_dir(dir_path):
-    if os.path.exists(dir_path):
-        if os.path.isdir(dir_path):
-            shutil.rmtree(dir_path)
-        else:
-            os.remove(dir_path)
-    os.mkdir(dir_path)
-    if is_windows():
-        windows_hide_file(dir_path)
+def set_default_file_mode(file_path):
+    # mkstemp creates files that only the owner can read, result files get the mode that open() would give them
+    os.chmod(file_path, 0o666 & ~process_umask)
 
 
 def check_if_executable_exists_in_path(executable):
-    path_to_cmd = find_executable(executable)
+    path_to_cmd = shutil.which(executable)
     return path_to_cmd is not None
 
 
 def create_tmp_dir(working_dir):
-    path_dir_tmp = os.path.abspath(os.path.join(working_dir, const_dir_tmp))
-    create_or_recreate_dir(path_dir_tmp)
+    # every conversion gets its own temp dir, so concurrent runs in the same directory do not collide
+    path_dir_tmp = os.path.abspath(tempfile.mkdtemp(prefix=const_dir_tmp + '-', dir=working_dir))
+    if is_windows():
+        windows_hide_file(path_dir_tmp)
     return path_dir_tmp
 
 
@@ -136,6 +810,462 @@ def determine_split_type_by_apk_file_name(apk_file_name, xapk_package_name):
     return apk_type
 
 
+def read_xapk_manifest(xapk_zip_file):
+    with xapk_zip_file.open(const_file_xapk_manifest, 'r') as file:
+        return json.loads(file.read().decode('utf-8'))
+
+
+def list_xapk_apk_file_names(xapk_zip_file):
+    result = list()
+    for entry in xapk_zip_file.infolist():
+        if entry.is_dir() or '/' in entry.filename:
+            continue
+        if entry.filename.endswith(const_ext_apk):
+            result.append(entry.filename)
+    return result
+
+
+def extract_zip_member(zip_file, member_name, path_dst):
+    with zip_file.open(member_name, 'r') as file_src:
+        with open(path_dst, 'wb') as file_dst:
+            shutil.copyfileobj(file_src, file_dst, const_extract_chunk_size)
+
+
+def check_free_space(path_dir, bytes_needed, stage_name):
+    bytes_free = shutil.disk_usage(path_dir).free
+    if bytes_needed > bytes_free:
+        raise Exception("not enough free space in %s for %s: about %.1f MB needed, %.1f MB available" % (path_dir, stage_name, bytes_needed / 1024.0 / 1024.0, bytes_free / 1024.0 / 1024.0))
+
+
+def list_xapk_expansion_files(xapk_zip_file, xapk_manifest_data):
+    # pairs of the entry name inside the xapk and the path on the device, relative to the external storage
+    expansions = list()
+    for expansion in xapk_manifest_data.get(const_file_xapk_manifest_key_expansions, list()):
+        if const_file_xapk_manifest_key_expansion_file in expansion.keys() and const_file_xapk_manifest_key_expansion_install_path in expansion.keys():
+            expansions.append((expansion[const_file_xapk_manifest_key_expansion_file], expansion[const_file_xapk_manifest_key_expansion_install_path]))
+    if len(expansions) == 0:
+        for entry in xapk_zip_file.infolist():
+            if not entry.is_dir() and entry.filename.endswith(const_ext_obb):
+                expansions.append((entry.filename, entry.filename))
+    return expansions
+
+
+def write_xapk_expansion_files(xapk_zip_file, xapk_manifest_data, path_dir_output, report):
+    # obb files are streamed from the xapk straight to their place next to the result apk, the temp dir is never used
+    for entry_name, install_path in list_xapk_expansion_files(xapk_zip_file, xapk_manifest_data):
+        install_path = os.path.normpath(install_path)
+        if os.path.isabs(install_path) or install_path.startswith(os.pardir):
+            raise Exception("invalid expansion file path %s" % install_path)
+        path_file_dst = os.path.join(path_dir_output, install_path)
+        if not os.path.exists(os.path.dirname(path_file_dst)):
+            os.makedirs(os.path.dirname(path_file_dst))
+        with profile_stage(report, 'obb', entry_name) as stage:
+            check_free_space(os.path.dirname(path_file_dst), xapk_zip_file.getinfo(entry_name).file_size, 'expansion file %s' % entry_name)
+            file_descriptor, path_file_tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path_file_dst) + '.', dir=os.path.dirname(path_file_dst))
+            os.close(file_descriptor)
+            try:
+                with acquire_stage_slot('disk'):
+                    extract_zip_member(xapk_zip_file, entry_name, path_file_tmp)
+                set_default_file_mode(path_file_tmp)
+                os.replace(path_file_tmp, path_file_dst)
+            except:
+                delete_file_if_exists(path_file_tmp)
+                raise
+            stage['files'] = 1
+        add_bytes_written(report, 'obb', os.path.getsize(path_file_dst))
+        print('[*] expansion file written to %s' % path_file_dst)
+
+
+def extract_xapk_apks(xapk_zip_file, apks, report):
+    for apk in apks:
+        with profile_stage(report, 'extract', apk['apk_file_name']) as stage:
+            with acquire_stage_slot('disk'):
+                extract_zip_member(xapk_zip_file, apk['apk_file_name'], apk['apk_file_path'])
+            stage['files'] = 1
+        add_bytes_written(report, 'extract', os.path.getsize(apk['apk_file_path']))
+
+
+def zip_read_end_of_central_directory(file):
+    file.seek(0, os.SEEK_END)
+    file_size = file.tell()
+    tail_size = min(file_size, const_zip_size_end_of_central_directory + const_zip_max_value_u16)
+    file.seek(file_size - tail_size)
+    tail = file.read(tail_size)
+    index = tail.rfind(struct.pack('<I', const_zip_signature_end_of_central_directory))
+    if index < 0 or len(tail) - index < const_zip_size_end_of_central_directory:
+        raise Exception("zip end of central directory not found")
+    fields = struct.unpack('<IHHHHIIH', tail[index:index + const_zip_size_end_of_central_directory])
+    eocd = dict()
+    eocd['entries_count'] = fields[4]
+    eocd['cd_size'] = fields[5]
+    eocd['cd_offset'] = fields[6]
+    eocd['comment'] = tail[index + const_zip_size_end_of_central_directory:index + const_zip_size_end_of_central_directory + fields[7]]
+    eocd['offset'] = file_size - tail_size + index
+    if eocd['entries_count'] == const_zip_max_value_u16 or eocd['cd_offset'] == const_zip_max_value_u32:
+        raise Exception("zip64 archives are not supported")
+    return eocd
+
+
+def zip_write_end_of_central_directory(file, entries_count, cd_offset, cd_size, comment=b''):
+    if entries_count > const_zip_max_value_u16 or cd_offset + cd_size > const_zip_max_value_u32:
+        raise Exception("zip64 archives are not supported")
+    file.write(struct.pack('<IHHHHIIH', const_zip_signature_end_of_central_directory, 0, 0, entries_count, entries_count, cd_size, cd_offset, len(comment)))
+    file.write(comment)
+
+
+def zip_get_entry_alignment(zip_info):
+    if zip_info.filename.endswith('.so'):
+        return const_zip_alignment_shared_library
+    return const_zip_alignment_default
+
+
+def zip_copy_entry_raw(file_src, zip_info, file_dst, alignment=None):
+    file_src.seek(zip_info.header_offset)
+    header = file_src.read(const_zip_size_local_file_header)
+    fields = struct.unpack('<IHHHHHIIIHH', header)
+    if fields[0] != const_zip_signature_local_file_header:
+        raise Exception("bad local file header of %s" % zip_info.filename)
+    version_needed, flags, method, mod_time, mod_date = fields[1:6]
+    name = file_src.read(fields[9])
+    file_src.seek(fields[10], os.SEEK_CUR)
+    flags = flags & ~const_zip_flag_data_descriptor
+
+    offset_dst = file_dst.tell()
+    if offset_dst > const_zip_max_value_u32 or zip_info.compress_size > const_zip_max_value_u32:
+        raise Exception("zip64 archives are not supported")
+    extra = b''
+    if method == 0:
+        if alignment is None:
+            alignment = zip_get_entry_alignment(zip_info)
+        offset_data = offset_dst + const_zip_size_local_file_header + len(name)
+        extra = b'\0' * ((alignment - offset_data % alignment) % alignment)
+
+    file_dst.write(struct.pack('<IHHHHHIIIHH', const_zip_signature_local_file_header, version_needed, flags, method, mod_time, mod_date, zip_info.CRC, zip_info.compress_size, zip_info.file_size, len(name), len(extra)))
+    file_dst.write(name)
+    file_dst.write(extra)
+    bytes_left = zip_info.compress_size
+    while bytes_left > 0:
+        chunk = file_src.read(min(bytes_left, const_extract_chunk_size))
+        if not chunk:
+            raise Exception("unexpected end of data of %s" % zip_info.filename)
+        file_dst.write(chunk)
+        bytes_left -= len(chunk)
+
+    comment = zip_info.comment or b''
+    cd_record = struct.pack('<IHHHHHHIIIHHHHHII', const_zip_signature_central_directory, (zip_info.create_system << 8) | zip_info.create_version, version_needed, flags, method, mod_time, mod_date, zip_info.CRC, zip_info.compress_size, zip_info.file_size, len(name), 0, len(comment), 0, zip_info.internal_attr, zip_info.external_attr, offset_dst)
+    return cd_record + name + comment
+
+
+def zip_get_dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((max(year, 1980) - 1980) << 9) | (month << 5) | day
+
+
+def zip_write_entry_bytes(file_dst, zip_info, data):
+    if zip_info.compress_type == const_zip_compression_stored:
+        method = const_zip_compression_stored
+        data_compressed = data
+    else:
+        method = const_zip_compression_deflated
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        data_compressed = compressor.compress(data) + compressor.flush()
+    try:
+        name = zip_info.filename.encode('ascii')
+        flags = 0
+    except UnicodeEncodeError:
+        name = zip_info.filename.encode('utf-8')
+        flags = const_zip_flag_utf8
+    mod_time, mod_date = zip_get_dos_date_time(zip_info.date_time)
+    crc = zlib.crc32(data) & const_zip_max_value_u32
+
+    offset_dst = file_dst.tell()
+    extra = b''
+    if method == const_zip_compression_stored:
+        alignment = zip_get_entry_alignment(zip_info)
+        offset_data = offset_dst + const_zip_size_local_file_header + len(name)
+        extra = b'\0' * ((alignment - offset_data % alignment) % alignment)
+    file_dst.write(struct.pack('<IHHHHHIIIHH', const_zip_signature_local_file_header, 20, flags, method, mod_time, mod_date, crc, len(data_compressed), len(data), len(name), len(extra)))
+    file_dst.write(name)
+    file_dst.write(extra)
+    file_dst.write(data_compressed)
+
+    cd_record = struct.pack('<IHHHHHHIIIHHHHHII', const_zip_signature_central_directory, 20, 20, flags, method, mod_time, mod_date, crc, len(data_compressed), len(data), len(name), 0, 0, 0, 0, zip_info.external_attr, offset_dst)
+    return cd_record + name
+
+
+def zip_write_central_directory(file_dst, cd_records):
+    cd_offset = file_dst.tell()
+    cd_data = b''.join(cd_records)
+    file_dst.write(cd_data)
+    zip_write_end_of_central_directory(file_dst, len(cd_records), cd_offset, len(cd_data))
+
+
+def zip_is_signature_file(entry_name):
+    if entry_name == const_zip_signature_manifest_file:
+        return True
+    if not entry_name.startswith('META-INF/') or '/' in entry_name[len('META-INF/'):]:
+        return False
+    return os.path.splitext(entry_name)[1].upper() in const_zip_signature_file_extensions
+
+
+def axml_decode_string_pool(chunk):
+    string_count, style_count, flags, strings_start = struct.unpack_from('<IIII', chunk, 8)
+    header_size = struct.unpack_from('<H', chunk, 2)[0]
+    is_utf8 = (flags & const_axml_string_pool_flag_utf8) != 0
+    strings = list()
+    for index in range(string_count):
+        offset = strings_start + struct.unpack_from('<I', chunk, header_size + index * 4)[0]
+        if is_utf8:
+            # utf-16 length first, then utf-8 length, both encoded in one or two bytes
+            for length_index in range(2):
+                length = chunk[offset]
+                offset += 1
+                if length & 0x80:
+                    length = ((length & 0x7F) << 8) | chunk[offset]
+                    offset += 1
+            strings.append(chunk[offset:offset + length].decode('utf-8', 'replace'))
+        else:
+            length = struct.unpack_from('<H', chunk, offset)[0]
+            offset += 2
+            if length & 0x8000:
+                length = ((length & 0x7FFF) << 16) | struct.unpack_from('<H', chunk, offset)[0]
+                offset += 2
+            strings.append(chunk[offset:offset + length * 2].decode('utf-16-le', 'replace'))
+    return strings
+
+
+def axml_encode_string(value, is_utf8):
+    if is_utf8:
+        data = value.encode('utf-8')
+        result = b''
+        for length in [len(value), len(data)]:
+            if length > 0x7F:
+                result += bytes([0x80 | (length >> 8), length & 0xFF])
+            else:
+                result += bytes([length])
+        return result + data + b'\0'
+    data = value.encode('utf-16-le')
+    length = len(data) // 2
+    if length > 0x7FFF:
+        result = struct.pack('<HH', 0x8000 | (length >> 16), length & 0xFFFF)
+    else:
+        result = struct.pack('<H', length)
+    return result + data + b'\0\0'
+
+
+def axml_append_string(chunk, value):
+    chunk_type, header_size, chunk_size = struct.unpack_from('<HHI', chunk, 0)
+    string_count, style_count, flags, strings_start, styles_start = struct.unpack_from('<IIIII', chunk, 8)
+    offsets_strings = chunk[header_size:header_size + string_count * 4]
+    offsets_styles = chunk[header_size + string_count * 4:header_size + (string_count + style_count) * 4]
+    strings_data = chunk[strings_start:styles_start if style_count > 0 else chunk_size]
+    styles_data = chunk[styles_start:chunk_size] if style_count > 0 else b''
+
+    offsets_strings += struct.pack('<I', len(strings_data))
+    strings_data += axml_encode_string(value, (flags & const_axml_string_pool_flag_utf8) != 0)
+    strings_data += b'\0' * ((4 - len(strings_data) % 4) % 4)
+
+    strings_start = header_size + len(offsets_strings) + len(offsets_styles)
+    styles_start = strings_start + len(strings_data) if style_count > 0 else 0
+    chunk_size = strings_start + len(strings_data) + len(styles_data)
+    flags = flags & ~const_axml_string_pool_flag_sorted
+    header = struct.pack('<HHIIIIII', chunk_type, header_size, chunk_size, string_count + 1, style_count, flags, strings_start, styles_start)
+    header += chunk[len(header):header_size]
+    return header + offsets_strings + offsets_styles + strings_data + styles_data, string_count
+
+
+def axml_read_chunks(data):
+    # returns the xml header size, the chunks, the index of the string pool chunk, the strings and the resource ids of the attribute names
+    xml_type, xml_header_size, xml_size = struct.unpack_from('<HHI', data, 0)
+    if xml_type != const_axml_chunk_type_xml:
+        raise Exception("unsupported binary manifest format")
+
+    chunks = list()
+    offset = xml_header_size
+    while offset < xml_size:
+        chunk_size = struct.unpack_from('<I', data, offset + 4)[0]
+        chunks.append(data[offset:offset + chunk_size])
+        offset += chunk_size
+
+    index_string_pool = None
+    strings = list()
+    resource_ids = list()
+    for index, chunk in enumerate(chunks):
+        chunk_type = struct.unpack_from('<H', chunk, 0)[0]
+        if chunk_type == const_axml_chunk_type_string_pool and index_string_pool is None:
+            index_string_pool = index
+            strings = axml_decode_string_pool(chunk)
+        elif chunk_type == const_axml_chunk_type_resource_map:
+            resource_ids = list(struct.unpack_from('<%dI' % ((len(chunk) - 8) // 4), chunk, 8))
+    if index_string_pool is None:
+        raise Exception("binary manifest has no string pool")
+    return xml_header_size, chunks, index_string_pool, strings, resource_ids
+
+
+def axml_get_attribute_name(strings, resource_ids, name_index):
+    if name_index < len(resource_ids) and resource_ids[name_index] in const_axml_attribute_ids.keys():
+        return const_axml_attribute_ids[resource_ids[name_index]]
+    return strings[name_index] if name_index < len(strings) else None
+
+
+def read_binary_manifest_min_sdk_version(data):
+    # None when the manifest has no uses-sdk element or a preview codename instead of a number
+    xml_header_size, chunks, index_string_pool, strings, resource_ids = axml_read_chunks(data)
+    for chunk in chunks:
+        if struct.unpack_from('<H', chunk, 0)[0] != const_axml_chunk_type_start_element:
+            continue
+        node_header_size = struct.unpack_from('<H', chunk, 2)[0]
+        element_name_index, attribute_start, attribute_size, attribute_count = struct.unpack_from('<4xIHHH', chunk, node_header_size)
+        if strings[element_name_index] != const_axml_element_uses_sdk:
+            continue
+        for attribute_index in range(attribute_count):
+            attribute_offset = node_header_size + attribute_start + attribute_index * attribute_size
+            name_index, data_type, value_data = struct.unpack_from('<4xI7xBI', chunk, attribute_offset)
+            if axml_get_attribute_name(strings, resource_ids, name_index) == const_axml_attribute_min_sdk_version and data_type in [const_axml_value_type_int_dec, const_axml_value_type_int_hex]:
+                return value_data
+    return None
+
+
+def patch_binary_manifest(data):
+    xml_header_size, chunks, index_string_pool, strings, resource_ids = axml_read_chunks(data)
+
+    def get_attribute_name(name_index):
+        return axml_get_attribute_name(strings, resource_ids, name_index)
+
+    def get_attribute_string_value(attribute):
+        raw_value, data_type, value_data = struct.unpack_from('<I3xBI', attribute, 8)
+        if data_type == const_axml_value_type_string and value_data < len(strings):
+            return strings[value_data]
+        if raw_value != const_axml_no_index and raw_value < len(strings):
+            return strings[raw_value]
+        return None
+
+    appended_strings = dict()
+    patched_chunks = list()
+    removed_depth = 0
+    for chunk in chunks:
+        chunk_type = struct.unpack_from('<H', chunk, 0)[0]
+        if removed_depth > 0:
+            if chunk_type == const_axml_chunk_type_start_element:
+                removed_depth += 1
+            elif chunk_type == const_axml_chunk_type_end_element:
+                removed_depth -= 1
+            continue
+        if chunk_type != const_axml_chunk_type_start_element:
+            patched_chunks.append(chunk)
+            continue
+
+        node_header_size = struct.unpack_from('<H', chunk, 2)[0]
+        element_name_index, attribute_start, attribute_size, attribute_count, id_index, class_index, style_index = struct.unpack_from('<4xIHHHHHH', chunk, node_header_size)
+        element_name = strings[element_name_index]
+        attributes_offset = node_header_size + attribute_start
+        attributes = list()
+        for attribute_index in range(attribute_count):
+            attribute_offset = attributes_offset + attribute_index * attribute_size
+            attributes.append(bytearray(chunk[attribute_offset:attribute_offset + attribute_size]))
+
+        remove_element = False
+        modified_element = False
+        kept_attributes = list()
+        kept_indices = list()
+        for attribute_index, attribute in enumerate(attributes):
+            attribute_name = get_attribute_name(struct.unpack_from('<I', attribute, 4)[0])
+            if element_name == const_axml_element_application and attribute_name == const_axml_attribute_split_required:
+                modified_element = True
+                continue
+            if element_name == const_axml_element_meta_data and attribute_name == 'name' and get_attribute_string_value(attribute) in const_axml_meta_data_removed:
+                remove_element = True
+            if element_name == const_axml_element_meta_data and attribute_name == 'value' and get_attribute_string_value(attribute) in const_axml_meta_data_replaced_values.keys():
+                replaced_value = const_axml_meta_data_replaced_values[get_attribute_string_value(attribute)]
+                if replaced_value in strings:
+                    replaced_value_index = strings.index(replaced_value)
+                elif replaced_value in appended_strings.keys():
+                    replaced_value_index = appended_strings[replaced_value]
+                else:
+                    chunks_string_pool, replaced_value_index = axml_append_string(patched_chunks[index_string_pool], replaced_value)
+                    patched_chunks[index_string_pool] = chunks_string_pool
+                    appended_strings[replaced_value] = replaced_value_index
+                struct.pack_into('<I', attribute, 8, replaced_value_index)
+                struct.pack_into('<I', attribute, 16, replaced_value_index)
+                modified_element = True
+            kept_attributes.append(bytes(attribute))
+            kept_indices.append(attribute_index + 1)
+
+        if remove_element:
+            removed_depth = 1
+            continue
+        if modified_element:
+            # id, class and style indices are 1-based positions in the attribute list
+            id_index, class_index, style_index = [kept_indices.index(value) + 1 if value in kept_indices else 0 for value in [id_index, class_index, style_index]]
+            chunk_header = bytearray(chunk[:attributes_offset])
+            struct.pack_into('<HHHH', chunk_header, node_header_size + 12, len(kept_attributes), id_index, class_index, style_index)
+            chunk = bytes(chunk_header) + b''.join(kept_attributes) + chunk[attributes_offset + attribute_count * attribute_size:]
+            chunk = chunk[:4] + struct.pack('<I', len(chunk)) + chunk[8:]
+        patched_chunks.append(chunk)
+
+    body = b''.join(patched_chunks)
+    return data[:4] + struct.pack('<I', xml_header_size + len(body)) + data[8:xml_header_size] + body
+
+
+def generate_binary_manifest(package_name, is_split_required, min_sdk_version=None):
+    # minimal binary AndroidManifest.xml with the split markers that patch_binary_manifest() strips, used by the tests and the bench
+    strings = [ 'name', 'value', 'isSplitRequired', 'minSdkVersion', 'uses-sdk', 'package', 'android', const_axml_namespace_android, 'manifest', 'application',
+                'meta-data', 'com.android.vending.splits.required', 'true', 'com.android.vending.splits', 'com.android.stamp.type',
+                'STAMP_TYPE_DISTRIBUTION_APK', package_name ]
+    resource_ids = [ 0x01010003, 0x01010024, 0x01010591, 0x0101020c ]
+    string_index = strings.index
+
+    string_data = b''
+    string_offsets = list()
+    for value in strings:
+        string_offsets.append(len(string_data))
+        string_data += axml_encode_string(value, False)
+    string_data += b'\0' * ((4 - len(string_data) % 4) % 4)
+    strings_start = 28 + 4 * len(strings)
+    string_pool = struct.pack('<HHIIIIII', const_axml_chunk_type_string_pool, 28, strings_start + len(string_data), len(strings), 0, 0, strings_start, 0)
+    string_pool += b''.join(struct.pack('<I', offset) for offset in string_offsets) + string_data
+    resource_map = struct.pack('<HHI', const_axml_chunk_type_resource_map, 8, 8 + 4 * len(resource_ids))
+    resource_map += b''.join(struct.pack('<I', resource_id) for resource_id in resource_ids)
+
+    def attribute(name, string_value=None, boolean_value=None, int_value=None, namespace=const_axml_namespace_android):
+        namespace_index = const_axml_no_index if namespace is None else string_index(namespace)
+        if string_value is not None:
+            return struct.pack('<IIIHBBI', namespace_index, string_index(name), string_index(string_value), 8, 0,
+                               const_axml_value_type_string, string_index(string_value))
+        if int_value is not None:
+            return struct.pack('<IIIHBBI', namespace_index, string_index(name), const_axml_no_index, 8, 0,
+                               const_axml_value_type_int_dec, int_value)
+        return struct.pack('<IIIHBBI', namespace_index, string_index(name), const_axml_no_index, 8, 0,
+                           const_axml_value_type_boolean, 0xFFFFFFFF if boolean_value else 0)
+
+    def start_element(name, attributes):
+        body = struct.pack('<IIHHHHHH', const_axml_no_index, string_index(name), 20, 20, len(attributes), 0, 0, 0) + b''.join(attributes)
+        return struct.pack('<HHIII', const_axml_chunk_type_start_element, 16, 16 + len(body), 1, const_axml_no_index) + body
+
+    def end_element(name):
+        return struct.pack('<HHIIIII', const_axml_chunk_type_end_element, 16, 24, 1, const_axml_no_index, const_axml_no_index, string_index(name))
+
+    def namespace(chunk_type):
+        return struct.pack('<HHIIIII', chunk_type, 16, 24, 1, const_axml_no_index, string_index('android'), string_index(const_axml_namespace_android))
+
+    def meta_data(name, value):
+        return start_element('meta-data', [attribute('name', name), attribute('value', value)]) + end_element('meta-data')
+
+    nodes = [ namespace(const_axml_chunk_type_namespace_start), start_element('manifest', [attribute('package', package_name, namespace=None)]) ]
+    if min_sdk_version is not None:
+        nodes += [ start_element('uses-sdk', [attribute('minSdkVersion', int_value=min_sdk_version)]), end_element('uses-sdk') ]
+    if is_split_required:
+        nodes.append(start_element('application', [attribute('isSplitRequired', boolean_value=True)]))
+        nodes.append(meta_data('com.android.vending.splits.required', 'true'))
+        nodes.append(meta_data('com.android.vending.splits', 'true'))
+        nodes.append(meta_data('com.android.stamp.type', 'STAMP_TYPE_DISTRIBUTION_APK'))
+    else:
+        nodes.append(start_element('application', []))
+    nodes += [ end_element('application'), end_element('manifest'), namespace(const_axml_chunk_type_namespace_end) ]
+    body = string_pool + resource_map + b''.join(nodes)
+    return struct.pack('<HHI', const_axml_chunk_type_xml, 8, 8 + len(body)) + body
+
+
 def get_apks_of_type(target_apks, type):
     result = list()
     for key in target_apks.keys():
@@ -149,216 +1279,1020 @@ def get_main_apk(target_apks):
     return get_apks_of_type(target_apks, const_split_apk_type_main)[0]
 
 
-def get_do_not_compress_lines(config_file_lines):
-    index_start = -1
-    index_end = -1
-    result = list()
-    start_block_literal = 'doNotCompress:'
-    prefix_target_line = '- '
-    opened = False
-    for index, line in enumerate(config_file_lines):
-        if not opened and line.startswith(start_block_literal):
-            opened = True
-            if index_end == -1 and index_start == -1:
-                index_start = index + 1
-        elif opened and line.startswith(prefix_target_line):
-            result.append(line)
-        elif opened and not line.startswith(prefix_target_line):
-            if index_start != -1 and index_end == -1:
-                index_end = index - 1
-            break
-    result.sort()
-    return result, index_start, index_end
+def get_apk_config_name(apk):
+    apk_dir_name_splitted = apk['apk_dir_name'].split('.')
+    if len(apk_dir_name_splitted) < 2 or apk_dir_name_splitted[0] != const_prefix_apk_split_type_config:
+        return None
+    return apk_dir_name_splitted[1]
+
+
+def normalize_abi_name(abi):
+    return abi.strip().lower().replace('-', '_')
+
+
+def get_dpi_density(dpi_name):
+    if dpi_name.isdigit():
+        return int(dpi_name)
+    return const_values_apk_split_dpi_densities.get(dpi_name)
+
+
+class ZipMemberReader(object):
+    # read-only window on a zip member stored without compression, a ZipFile opened on it reads only the end of central directory and the central directory
+    def __init__(self, file, offset, size):
+        self.file = file
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(0, min(offset, self.size))
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.size - self.position:
+            size = self.size - self.position
+        self.file.seek(self.offset + self.position)
+        data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+
+def zip_get_member_data_offset(file, zip_info):
+    file.seek(zip_info.header_offset)
+    fields = struct.unpack('<IHHHHHIIIHH', file.read(const_zip_size_local_file_header))
+    if fields[0] != const_zip_signature_local_file_header:
+        raise Exception("bad local file header of %s" % zip_info.filename)
+    return zip_info.header_offset + const_zip_size_local_file_header + fields[9] + fields[10]
+
+
+@contextmanager
+def open_nested_zip(zip_file, member_name):
+    # yields the file and the ZipFile of a zip member
+    zip_info = zip_file.getinfo(member_name)
+    if zip_info.compress_type == const_zip_compression_stored and zip_file.filename is not None:
+        # splits are stored uncompressed in the xapk, so they are read in place and every seek is free
+        with open(zip_file.filename, 'rb') as file:
+            file_member = ZipMemberReader(file, zip_get_member_data_offset(file, zip_info), zip_info.file_size)
+            with ZipFile(file_member, 'r') as nested_zip_file:
+                yield file_member, nested_zip_file
+        return
+    # a deflated member is decompressed again from its start on every backward seek, and zipfile needs a few of them to find the central directory
+    with zip_file.open(member_name, 'r') as file_member:
+        with ZipFile(file_member, 'r') as nested_zip_file:
+            yield file_member, nested_zip_file
 
 
-def parse_apktool_config(config_file_path):
-    config_file_lines = list()
-    with open(config_file_path, 'r') as file:
-        config_file_lines = file.readlines()
+def list_nested_zip_entries(zip_file, member_name):
+    with open_nested_zip(zip_file, member_name) as (file, nested_zip_file):
+        return nested_zip_file.infolist()
 
-    do_not_compress_lines, do_not_compress_index_start, do_not_compress_index_end = get_do_not_compress_lines(config_file_lines)
 
-    properties = dict()
-    properties['lines_all'] = config_file_lines
-    properties['lines_do_not_compress'] = do_not_compress_lines
-    properties['lines_do_not_compress_index_start'] = do_not_compress_index_start
-    properties['lines_do_not_compress_index_end'] = do_not_compress_index_end
+def read_min_sdk_version(xapk_zip_file, xapk_manifest_data, apk_main):
+    # the xapk manifest usually has it, otherwise it is read from the binary manifest of the base apk, None when unknown
+    min_sdk_version = str(xapk_manifest_data.get(const_file_xapk_manifest_key_min_sdk_version, ''))
+    if min_sdk_version.isdigit():
+        return int(min_sdk_version)
+    try:
+        with open_nested_zip(xapk_zip_file, apk_main['apk_file_name']) as (file, apk_zip_file):
+            return read_binary_manifest_min_sdk_version(apk_zip_file.read('AndroidManifest.xml'))
+    except Exception:
+        return None
 
-    return properties
 
+def get_apk_merge_prefixes(apk):
+    # the entries of a split that the merge takes over, everything else in it is thrown away
+    split_type = apk['apk_split_type']
+    if split_type == const_split_apk_type_arch:
+        return [ const_apk_dir_lib + '/' ]
+    if split_type == const_split_apk_type_dpi:
+        return [ const_apk_file_resources_table, const_apk_dir_res + '/' ]
+    return [ const_apk_file_resources_table, const_apk_dir_res + '/', const_apk_dir_asset_pack + '/' ]
+
+
+def plan_merge_entries(apk_main, apks, target_abis):
+    # the entries every split adds to the merged apk, the splits are given in merge order.
+    # the main apk and the splits merged first win, except for resources.arsc, whose values are merged entry by entry,
+    # so a split with a resources table always has work to do
+    native_libs = create_native_libs_merge(target_abis)
+    entries_claimed = set(apk_main['apk_entry_names'])
+    entries = dict()
+    for apk in apks:
+        prefixes = get_apk_merge_prefixes(apk)
+        apk_entries = list()
+        for entry_name in apk['apk_entry_names']:
+            if not any([entry_name.startswith(prefix) for prefix in prefixes]):
+                continue
+            if entry_name != const_apk_file_resources_table and entry_name in entries_claimed:
+                continue
+            if entry_name.startswith(const_apk_dir_lib + '/') and not is_native_lib_selected(native_libs, entry_name[len(const_apk_dir_lib) + 1:]):
+                continue
+            apk_entries.append(entry_name)
+        entries_claimed.update(apk_entries)
+        entries[apk['apk_file_name']] = apk_entries
+    return entries
 
-def insert_new_lines_do_not_compress(config_file_path, lines_to_insert):
-    file_apktool_config = parse_apktool_config(config_file_path)
-    do_not_compress_lines_original = file_apktool_config['lines_do_not_compress']
 
-    do_not_compress_lines_updated = set()
-    do_not_compress_lines_updated.update(do_not_compress_lines_original)
-    do_not_compress_lines_updated.update(lines_to_insert)
-    do_not_compress_lines_updated = list(do_not_compress_lines_updated)
-    do_not_compress_lines_updated.sort()
+def select_dpi_apks(apks_dpi, target_dpis):
+    if target_dpis is None:
+        return apks_dpi, list()
+    apks_with_density = list()
+    apks_without_density = list()
+    for apk in apks_dpi:
+        density = get_dpi_density(get_apk_config_name(apk))
+        if density is None:
+            apks_without_density.append(apk)
+        else:
+            apks_with_density.append((density, apk))
+    apks_with_density.sort(key=lambda x: x[0])
+
+    selected = list()
+    for target_dpi in target_dpis:
+        target_density = get_dpi_density(target_dpi.lower())
+        if target_density is None:
+            raise Exception("unknown dpi %s" % target_dpi)
+        candidates = [apk for density, apk in apks_with_density if density >= target_density]
+        if len(candidates) == 0:
+            candidates = [apk for density, apk in reversed(apks_with_density)]
+        if len(candidates) > 0 and candidates[0] not in selected:
+            selected.append(candidates[0])
+    selected.extend(apks_without_density)
+    skipped = [apk for apk in apks_dpi if apk not in selected]
+    return selected, skipped
+
+
+def select_arch_apks(apks_arch, target_abis):
+    if target_abis is None:
+        return apks_arch, list()
+    target_abis_normalized = [normalize_abi_name(abi) for abi in target_abis]
+    selected = [apk for apk in apks_arch if get_apk_config_name(apk) in target_abis_normalized]
+    skipped = [apk for apk in apks_arch if apk not in selected]
+    return selected, skipped
+
+
+def select_locale_apks(apks_locale, target_locales):
+    if target_locales is None:
+        return apks_locale, list()
+    target_languages = [locale.lower().replace('-', '_').split('_')[0] for locale in target_locales]
+    selected = list()
+    skipped = list()
+    for apk in apks_locale:
+        config_name = get_apk_config_name(apk)
+        if config_name is None or config_name.lower().split('_')[0] in target_languages:
+            selected.append(apk)
+        else:
+            skipped.append(apk)
+    return selected, skipped
 
-    config_file_lines_original = file_apktool_config['lines_all']
-    config_file_lines_index_start = file_apktool_config['lines_do_not_compress_index_start']
-    config_file_lines_index_end = file_apktool_config['lines_do_not_compress_index_end']
-    config_file_lines_updated = list()
-    for config_file_line in config_file_lines_original:
-        config_file_lines_updated.append(config_file_line)
-    config_file_lines_updated[config_file_lines_index_start:config_file_lines_index_end] = do_not_compress_lines_updated
 
-    with open(config_file_path, 'w') as file:
-        file.writelines(config_file_lines_updated)
+def get_target_abis(options):
+    target_abis = get_param_list(options, const_option_abi)
+    if target_abis is None:
+        return None
+    return set([normalize_abi_name(abi) for abi in target_abis])
+
+
+def plan_merge(target_apks, options):
+    apks_arch, apks_arch_skipped = select_arch_apks(get_apks_of_type(target_apks, const_split_apk_type_arch), get_param_list(options, const_option_abi))
+    apks_dpi, apks_dpi_skipped = select_dpi_apks(get_apks_of_type(target_apks, const_split_apk_type_dpi), get_param_list(options, const_option_dpi))
+    apks_locale, apks_locale_skipped = select_locale_apks(get_apks_of_type(target_apks, const_split_apk_type_locale), get_param_list(options, const_option_locale))
+
+    apks_dpi = prioritize_dpi_apk_list(apks_dpi)
+
+    plan = dict()
+    plan['apk_main'] = get_main_apk(target_apks)
+    plan['abis'] = get_target_abis(options)
+    # splits that add no entry, because they have none the merge takes or higher priority splits supply all of them, are never extracted or decoded
+    plan['entries'] = plan_merge_entries(plan['apk_main'], apks_arch + apks_dpi + apks_locale, plan['abis'])
+    plan['apks_arch'] = [apk for apk in apks_arch if len(plan['entries'][apk['apk_file_name']]) > 0]
+    plan['apks_arch_zip'] = list()
+    if not options.get(const_option_decode_arch, False):
+        plan['apks_arch_zip'] = plan['apks_arch']
+        plan['apks_arch'] = list()
+    plan['apks_dpi'] = [apk for apk in apks_dpi if len(plan['entries'][apk['apk_file_name']]) > 0]
+    plan['apks_locale'] = [apk for apk in apks_locale if len(plan['entries'][apk['apk_file_name']]) > 0]
+    plan['apks_skipped'] = apks_arch_skipped + apks_dpi_skipped + apks_locale_skipped
+    for apk in apks_arch + apks_dpi + apks_locale:
+        if len(plan['entries'][apk['apk_file_name']]) == 0:
+            plan['apks_skipped'].append(apk)
+    return plan
+
+
+def plan_variants(target_apks, options, variants):
+    # one plan per variant, plus a plan of everything that any variant needs, which is what gets extracted and decoded
+    plan = dict()
+    plan['variants'] = [(variant, plan_merge(target_apks, get_variant_options(options, variant))) for variant in variants]
+    for key in ['apks_arch', 'apks_arch_zip', 'apks_dpi']:
+        plan[key] = list()
+        for variant, variant_plan in plan['variants']:
+            plan[key] += [apk for apk in variant_plan[key] if apk not in plan[key]]
+    plan['apk_main'] = plan['variants'][0][1]['apk_main']
+    plan['abis'] = None
+    plan['apks_locale'] = plan['variants'][0][1]['apks_locale']
+    plan['entries'] = dict()
+    for variant, variant_plan in plan['variants']:
+        for apk_file_name, apk_entries in variant_plan['entries'].items():
+            plan['entries'][apk_file_name] = sorted(set(plan['entries'].get(apk_file_name, list())) | set(apk_entries))
+    apks_used = get_plan_apks(plan) + plan['apks_arch_zip']
+    plan['apks_skipped'] = [apk for apk in target_apks.values() if apk not in apks_used]
+    return plan
+
+
+def get_plan_apks(plan):
+    # abi splits merged on zip level are read straight from the xapk and never extracted
+    return [plan['apk_main']] + plan['apks_arch'] + plan['apks_dpi'] + plan['apks_locale']
+
+
+def parse_apktool_config_lines(config_file_lines):
+    # splits the file into the lines before and after the doNotCompress block and the entries of the block
+    index_start = None
+    index_end = None
+    entries = set()
+    for index, line in enumerate(config_file_lines):
+        if index_start is None:
+            if line.startswith(const_apktool_config_do_not_compress):
+                index_start = index
+        elif line.startswith(const_apktool_config_list_prefix):
+            entries.add(line[len(const_apktool_config_list_prefix):].rstrip('\r\n'))
+        else:
+            index_end = index
+            break
+    if index_start is None:
+        return config_file_lines, list(), entries
+    if index_end is None:
+        # the block is the last one in the file
+        index_end = len(config_file_lines)
+    return config_file_lines[:index_start], config_file_lines[index_end:], entries
 
 
-def merge_apk_arch(dir_apk_main, dir_apk_arch):
-    path_libs_src = os.path.join(dir_apk_arch, const_apk_dir_lib)
-    path_libs_dst = os.path.join(dir_apk_main, const_apk_dir_lib)
-    if not os.path.exists(path_libs_dst):
-        os.mkdir(path_libs_dst)
+def load_apktool_config(dir_apk):
+    config_file_path = os.path.join(dir_apk, const_apk_file_apktool_config)
+    with open(config_file_path, 'r') as file:
+        lines_before, lines_after, do_not_compress = parse_apktool_config_lines(file.readlines())
 
-    for dir in os.listdir(path_libs_src):
-        src = os.path.join(path_libs_src, dir)
-        dst = os.path.join(path_libs_dst, dir)
-        shutil.copytree(src, dst)
+    config = dict()
+    config['path'] = config_file_path
+    config['lines_before'] = lines_before
+    config['lines_after'] = lines_after
+    config['do_not_compress'] = do_not_compress
+    config['changed'] = False
+    return config
 
-    path_file_config_src = os.path.join(dir_apk_arch, const_apk_file_apktool_config)
-    path_file_config_dst = os.path.join(dir_apk_main, const_apk_file_apktool_config)
 
-    config_src = parse_apktool_config(path_file_config_src)
-    insert_new_lines_do_not_compress(path_file_config_dst, config_src['lines_do_not_compress'])
+def copy_apktool_config(config, dir_apk):
+    config_copy = dict(config)
+    config_copy['path'] = os.path.join(dir_apk, const_apk_file_apktool_config)
+    config_copy['do_not_compress'] = set(config['do_not_compress'])
+    return config_copy
 
 
-def merge_apk_resources(dir_apk_main, dir_apk_with_resources):
-    target_res_dir = os.path.join(dir_apk_main, 'res')
-    res_dir = os.path.join(dir_apk_with_resources, 'res')
+def update_apktool_config_do_not_compress(config, dir_apk_src):
+    entries_new = load_apktool_config(dir_apk_src)['do_not_compress'] - config['do_not_compress']
+    if len(entries_new) > 0:
+        config['do_not_compress'].update(entries_new)
+        config['changed'] = True
 
-    skip_suffix = 'values/public.xml'
 
-    files_to_copy = list()
-    for root, dirs, files in os.walk(res_dir):
-        for dir in dirs:
-            target_res_subdir = os.path.join(target_res_dir, dir)
-            if not os.path.exists(target_res_subdir):
-                os.mkdir(target_res_subdir)
-        for file in files:
-            res_file_path_abs = os.path.join(root, file)
-            if res_file_path_abs.endswith(skip_suffix):
-                continue
-            res_file_path_rel = res_file_path_abs[len(res_dir):].lstrip('/')
-            res_file_path_target = os.path.join(target_res_dir, res_file_path_rel)
-            files_to_copy.append((res_file_path_abs, res_file_path_rel, res_file_path_target))
+def write_apktool_config(config):
+    # all merges update the config in memory, it is written once right before the build
+    if not config['changed']:
+        return
+    lines = list(config['lines_before'])
+    if len(lines) > 0 and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    lines.append(const_apktool_config_do_not_compress + '\n')
+    lines += ['%s%s\n' % (const_apktool_config_list_prefix, entry) for entry in sorted(config['do_not_compress'])]
+    lines += config['lines_after']
+    with open(config['path'], 'w') as file:
+        file.writelines(lines)
+    config['changed'] = False
+
+
+def create_native_libs_merge(target_abis):
+    native_libs = dict()
+    native_libs['abis'] = target_abis
+    native_libs['entries'] = dict()
+    native_libs['stripped_files'] = 0
+    native_libs['stripped_bytes'] = 0
+    native_libs['duplicate_files'] = 0
+    native_libs['duplicate_bytes'] = 0
+    native_libs['conflicts'] = 0
+    return native_libs
+
+
+def is_native_lib_selected(native_libs, path_rel_lib):
+    # the path is relative to the lib dir, so its first part is the abi
+    return native_libs['abis'] is None or normalize_abi_name(path_rel_lib.split('/')[0]) in native_libs['abis']
+
+
+def record_native_lib_stripped(native_libs, bytes_count):
+    native_libs['stripped_files'] += 1
+    native_libs['stripped_bytes'] += bytes_count
+
+
+def record_native_lib_duplicate(native_libs, entry_name, is_same_content, bytes_count):
+    if is_same_content:
+        native_libs['duplicate_files'] += 1
+        native_libs['duplicate_bytes'] += bytes_count
+    else:
+        native_libs['conflicts'] += 1
+        print_synchronized('[!] %s differs between splits, the one merged first is kept' % entry_name)
+
+
+def is_same_file_content(path_file_a, path_file_b):
+    if os.path.getsize(path_file_a) != os.path.getsize(path_file_b):
+        return False
+    return os.path.samefile(path_file_a, path_file_b) or get_file_sha256(path_file_a) == get_file_sha256(path_file_b)
 
-    for path_src, path_rel, path_dst in files_to_copy:
-        if os.path.exists(path_dst):
-            if path_rel.startswith('drawable'):
-                continue
-            # todo handle merge xmls ?
-            # print("DEBUG: skipping file %s - already exists (right now trying to copy from %s)" % (path_rel, res_dir))
+
+def strip_native_libs(dir_apk, native_libs):
+    # the decoded tree is a private copy, so hardlinked cache files only lose a link
+    path_libs = os.path.join(dir_apk, const_apk_dir_lib)
+    if native_libs['abis'] is None or not os.path.isdir(path_libs):
+        return
+    for abi in sorted(os.listdir(path_libs)):
+        if is_native_lib_selected(native_libs, abi):
             continue
+        path_abi = os.path.join(path_libs, abi)
+        if os.path.isdir(path_abi):
+            dirs, files = index_dir_tree(path_abi)
+            for path_file in files.values():
+                record_native_lib_stripped(native_libs, os.path.getsize(path_file))
+            shutil.rmtree(path_abi)
+        else:
+            record_native_lib_stripped(native_libs, os.path.getsize(path_abi))
+            os.remove(path_abi)
 
-        target_subdir_abspath = os.path.abspath(os.path.dirname(path_dst))
-        if not os.path.exists(target_subdir_abspath):
-            os.mkdir(target_subdir_abspath)
 
-        shutil.copy(path_src, path_dst)
+def merge_apk_arch(dir_apk_main, dir_apk_arch, apktool_config, native_libs, files_written=None):
+    path_libs_src = os.path.join(dir_apk_arch, const_apk_dir_lib)
+    path_libs_dst = os.path.join(dir_apk_main, const_apk_dir_lib)
+    if not os.path.isdir(path_libs_src):
+        return 0
+
+    dirs_dst, files_dst = index_dir_tree(path_libs_dst)
+    dirs_src, files_src = index_dir_tree(path_libs_src)
+    files_copied = 0
+    for path_rel in sorted(files_src.keys()):
+        path_file_src = files_src[path_rel]
+        if not is_native_lib_selected(native_libs, path_rel):
+            record_native_lib_stripped(native_libs, os.path.getsize(path_file_src))
+            continue
+        if path_rel in files_dst:
+            record_native_lib_duplicate(native_libs, const_apk_dir_lib + '/' + path_rel, is_same_file_content(path_file_src, files_dst[path_rel]), os.path.getsize(path_file_src))
+            continue
+        path_file_dst = os.path.join(path_libs_dst, path_rel)
+        os.makedirs(os.path.dirname(path_file_dst), exist_ok=True)
+        copy_file_fast(path_file_src, path_file_dst)
+        files_copied += 1
+        if files_written is not None:
+            files_written.append(const_apk_dir_lib + '/' + path_rel)
+
+    update_apktool_config_do_not_compress(apktool_config, dir_apk_arch)
+    return files_copied
+
+
+def iterate_nested_apk_entries(xapk_zip_file, apk, prefixes, existing_entry_names, entries_skipped=None):
+    # yields entries in file order, so once the central directory is read every split is read front to back only once
+    with open_nested_zip(xapk_zip_file, apk['apk_file_name']) as (file_apk, apk_zip_file):
+        entries = list()
+        for zip_info in apk_zip_file.infolist():
+            if zip_info.is_dir():
+                continue
+            if prefixes is not None and not any([zip_info.filename.startswith(prefix) for prefix in prefixes]):
+                continue
+            if zip_info.filename in existing_entry_names:
+                if entries_skipped is not None:
+                    entries_skipped.append(zip_info)
+                continue
+            existing_entry_names.add(zip_info.filename)
+            entries.append(zip_info)
+        entries.sort(key=lambda x: x.header_offset)
+        for zip_info in entries:
+            yield apk_zip_file, file_apk, zip_info
+
+
+def index_dir_tree(path_dir):
+    # one scandir pass over the tree, paths are relative and always use '/'
+    dirs = set()
+    files = dict()
+    if not os.path.isdir(path_dir):
+        return dirs, files
+    pending = [('', path_dir)]
+    while len(pending) > 0:
+        path_rel_dir, path_abs_dir = pending.pop()
+        for entry in os.scandir(path_abs_dir):
+            path_rel = path_rel_dir + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                dirs.add(path_rel)
+                pending.append((path_rel + '/', entry.path))
+            else:
+                files[path_rel] = entry.path
+    return dirs, files
+
 
+def clone_file(path_file_src, path_file_dst):
+    # reflink, the new file shares the data blocks of the source until one of them is modified (btrfs, xfs)
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        with open(path_file_src, 'rb') as file_src, open(path_file_dst, 'wb') as file_dst:
+            fcntl.ioctl(file_dst.fileno(), const_ioctl_ficlone, file_src.fileno())
+        return True
+    except (IOError, OSError):
+        return False
 
-def merge_apk_assets(dir_apk_main, dir_apk_with_asset_pack):
-    target_assets_dir = os.path.join(dir_apk_main, 'assets')
-    target_asset_pack_dir = os.path.join(target_assets_dir, 'assetpack')
-    assets_dir = os.path.join(dir_apk_with_asset_pack, 'assets')
-    asset_pack_dir = os.path.join(assets_dir, 'assetpack')
 
-    if not os.path.exists(asset_pack_dir):
+def copy_file_fast(path_file_src, path_file_dst):
+    try:
+        os.link(path_file_src, path_file_dst)
         return
-    if not os.path.exists(target_assets_dir):
-        os.mkdir(target_assets_dir)
-    if not os.path.exists(target_asset_pack_dir):
-        os.mkdir(target_asset_pack_dir)
-
-    files_to_copy = list()
-    for root, dirs, files in os.walk(asset_pack_dir):
-        for dir in dirs:
-            target_res_subdir = os.path.join(target_asset_pack_dir, dir)
-            if not os.path.exists(target_res_subdir):
-                os.mkdir(target_res_subdir)
-        for file in files:
-            asset_pack_file_path_abs = os.path.join(root, file)
-            asset_pack_file_path_rel = asset_pack_file_path_abs[len(asset_pack_dir):].lstrip('/')
-            asset_pack_file_path_target = os.path.join(target_asset_pack_dir, asset_pack_file_path_rel)
-            files_to_copy.append((asset_pack_file_path_abs, asset_pack_file_path_rel, asset_pack_file_path_target))
+    except OSError:
+        pass
+    if clone_file(path_file_src, path_file_dst):
+        return
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(path_file_src, 'rb') as file_src, open(path_file_dst, 'wb') as file_dst:
+                bytes_left = os.fstat(file_src.fileno()).st_size
+                while bytes_left > 0:
+                    bytes_copied = os.copy_file_range(file_src.fileno(), file_dst.fileno(), bytes_left)
+                    if bytes_copied == 0:
+                        break
+                    bytes_left -= bytes_copied
+            if bytes_left == 0:
+                return
+        except OSError:
+            pass
+    shutil.copyfile(path_file_src, path_file_dst)
+
+
+def move_file_fast(path_file_src, path_file_dst):
+    try:
+        os.rename(path_file_src, path_file_dst)
+        return
+    except OSError:
+        pass
+    copy_file_fast(path_file_src, path_file_dst)
+    os.remove(path_file_src)
+
 
-    for path_src, path_rel, path_dst in files_to_copy:
-        if os.path.exists(path_dst):
+def copy_files_batch(files_to_copy, jobs):
+    if jobs <= 1 or len(files_to_copy) < const_merge_parallel_copy_min_files:
+        for path_src, path_dst in files_to_copy:
+            copy_file_fast(path_src, path_dst)
+        return
+    chunks = [files_to_copy[i::jobs] for i in range(jobs)]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for future in [executor.submit(copy_files_batch, chunk, 1) for chunk in chunks]:
+            future.result()
+
+
+def is_values_xml(path_rel):
+    return path_rel.startswith(const_values_dir_prefix) and path_rel.endswith('.xml') and path_rel.count('/') == 1
+
+
+def iterate_values_xml_elements(path_file):
+    # yields the direct children of <resources> one by one and drops them afterwards, so a file is never kept in memory
+    depth = 0
+    root = None
+    for event, item in ElementTree.iterparse(path_file, events=('start-ns', 'start', 'end')):
+        if event == 'start-ns':
+            try:
+                ElementTree.register_namespace(item[0], item[1])
+            except ValueError:
+                pass
+        elif event == 'start':
+            if depth == 0:
+                root = item
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                yield item
+                root.clear()
+
+
+def get_values_xml_key(element):
+    resource_type = element.get('type', element.tag)
+    return const_values_xml_type_aliases.get(resource_type, resource_type), element.get('name')
+
+
+def find_values_xml_root_close(file_src, size):
+    # searched backwards window by window, the closing tag is almost always in the last one
+    window_end = size
+    while window_end > 0:
+        window_start = max(0, window_end - const_values_xml_tail_size)
+        file_src.seek(window_start)
+        # the windows overlap by the tag length, so a tag that spans two windows is found too
+        index = file_src.read(window_end - window_start + len(const_values_xml_root_close) - 1).rfind(const_values_xml_root_close)
+        if index >= 0:
+            return window_start + index
+        window_end = window_start
+    return -1
+
+
+def write_values_xml(path_file_dst, entries):
+    # the destination may be hardlinked into the decode cache, so it is replaced, never modified in place
+    size = os.path.getsize(path_file_dst)
+    with open(path_file_dst, 'rb') as file_src:
+        head_size = find_values_xml_root_close(file_src, size)
+        opening = b''
+        if head_size < 0:
+            file_src.seek(max(0, size - const_values_xml_tail_size))
+            tail_offset = file_src.tell()
+            tail = file_src.read().rstrip()
+            if not tail.endswith(b'/>'):
+                raise Exception("failed to merge %s: no closing resources tag" % path_file_dst)
+            # empty <resources/> element
+            head_size = tail_offset + len(tail) - 2
+            opening = b'>\n'
+
+        file_descriptor, path_file_tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path_file_dst), dir=os.path.dirname(path_file_dst))
+        try:
+            # the merged file replaces one that apktool wrote, so it keeps the same mode
+            set_default_file_mode(path_file_tmp)
+            with os.fdopen(file_descriptor, 'wb') as file_dst:
+                file_src.seek(0)
+                bytes_left = head_size
+                while bytes_left > 0:
+                    chunk = file_src.read(min(const_extract_chunk_size, bytes_left))
+                    if not chunk:
+                        break
+                    file_dst.write(chunk)
+                    bytes_left -= len(chunk)
+                file_dst.write(opening)
+                for entry in entries:
+                    file_dst.write((const_values_xml_entry_indent + entry + '\n').encode('utf-8'))
+                file_dst.write(const_values_xml_root_close + b'\n')
+        except:
+            delete_file_if_exists(path_file_tmp)
+            raise
+    os.replace(path_file_tmp, path_file_dst)
+
+
+def merge_values_xml(path_file_dst, paths_file_src):
+    # entries are matched by resource type and name, the destination and earlier sources win.
+    # public.xml entries are only added if their id is not taken yet, so every id keeps a single owner
+    is_public = os.path.basename(path_file_dst) == const_values_file_public
+    keys = set()
+    ids = set()
+    for element in iterate_values_xml_elements(path_file_dst):
+        keys.add(get_values_xml_key(element))
+        if is_public:
+            ids.add(element.get('id'))
+
+    entries = list()
+    entries_by_source = list()
+    for path_file_src in paths_file_src:
+        entries_count = len(entries)
+        for element in iterate_values_xml_elements(path_file_src):
+            key = get_values_xml_key(element)
+            if key in keys:
+                continue
+            if is_public:
+                if element.get('id') in ids:
+                    continue
+                ids.add(element.get('id'))
+            keys.add(key)
+            element.tail = None
+            entries.append(ElementTree.tostring(element, encoding='unicode'))
+        entries_by_source.append(len(entries) - entries_count)
+    if len(entries) > 0:
+        write_values_xml(path_file_dst, entries)
+    return entries_by_source
+
+
+def create_resources_merge(dir_apk_main, jobs=1):
+    # the index of the merged res tree is kept between the splits, so every split only walks its own tree
+    resources_merge = dict()
+    resources_merge['res_dir'] = os.path.join(dir_apk_main, const_apk_dir_res)
+    resources_merge['dirs'], resources_merge['files'] = index_dir_tree(resources_merge['res_dir'])
+    resources_merge['jobs'] = jobs
+    if not os.path.exists(resources_merge['res_dir']):
+        os.mkdir(resources_merge['res_dir'])
+    return resources_merge
+
+
+def merge_apk_resources_indexed(resources_merge, dir_apk_with_resources, files_written=None):
+    # files already in the merged tree win, values xml files that exist there already are merged entry by entry
+    target_res_dir = resources_merge['res_dir']
+    winners = dict()
+    values_merges = list()
+    dirs, files = index_dir_tree(os.path.join(dir_apk_with_resources, const_apk_dir_res))
+    for path_rel, path_src in files.items():
+        if path_rel in resources_merge['files']:
+            if is_values_xml(path_rel):
+                values_merges.append((path_rel, path_src))
             continue
-        target_subdir_abspath = os.path.abspath(os.path.dirname(path_dst))
-        if not os.path.exists(target_subdir_abspath):
-            os.mkdir(target_subdir_abspath)
-        shutil.copy(path_src, path_dst)
+        if path_rel.endswith(const_merge_skip_suffix_public_values):
+            continue
+        winners[path_rel] = path_src
+
+    dirs_to_create = set()
+    for path_rel in winners.keys():
+        path_rel_dir = os.path.dirname(path_rel)
+        while path_rel_dir != '' and path_rel_dir not in resources_merge['dirs'] and path_rel_dir not in dirs_to_create:
+            dirs_to_create.add(path_rel_dir)
+            path_rel_dir = os.path.dirname(path_rel_dir)
+    for path_rel_dir in sorted(dirs_to_create):
+        os.mkdir(os.path.join(target_res_dir, path_rel_dir))
+    resources_merge['dirs'].update(dirs_to_create)
+
+    copy_files_batch([(path_src, os.path.join(target_res_dir, path_rel)) for path_rel, path_src in winners.items()], resources_merge['jobs'])
+    for path_rel in winners.keys():
+        resources_merge['files'][path_rel] = os.path.join(target_res_dir, path_rel)
+
+    files_copied = len(winners)
+    values_merged = list()
+    for path_rel, path_src in values_merges:
+        if merge_values_xml(os.path.join(target_res_dir, path_rel), [path_src])[0] > 0:
+            files_copied += 1
+            values_merged.append(path_rel)
+    if files_written is not None:
+        files_written.extend([const_apk_dir_res + '/' + path_rel for path_rel in list(winners.keys()) + values_merged])
+    return files_copied
+
+
+def merge_apks_resources(dir_apk_main, dirs_apk_with_resources, jobs=1):
+    # the main apk wins over every split, earlier splits win over later ones
+    resources_merge = create_resources_merge(dir_apk_main, jobs)
+    files_copied = dict()
+    for dir_apk_with_resources in dirs_apk_with_resources:
+        files_copied[dir_apk_with_resources] = merge_apk_resources_indexed(resources_merge, dir_apk_with_resources)
+    return files_copied
+
+
+def merge_apk_assets(dir_apk_main, dir_apk_with_asset_pack, apktool_config, files_written=None):
+    # the split tree is thrown away after the merge, so its files are moved instead of copied
+    target_asset_pack_dir = os.path.join(dir_apk_main, const_apk_dir_asset_pack)
+    asset_pack_dir = os.path.join(dir_apk_with_asset_pack, const_apk_dir_asset_pack)
 
-    path_file_config_src = os.path.join(dir_apk_with_asset_pack, const_apk_file_apktool_config)
-    path_file_config_dst = os.path.join(dir_apk_main, const_apk_file_apktool_config)
-    config_src = parse_apktool_config(path_file_config_src)
-    insert_new_lines_do_not_compress(path_file_config_dst, config_src['lines_do_not_compress'])
+    if not os.path.exists(asset_pack_dir):
+        return 0
+    if not os.path.exists(target_asset_pack_dir):
+        os.makedirs(target_asset_pack_dir)
 
+    existing_dirs, existing_files = index_dir_tree(target_asset_pack_dir)
+    dirs, files = index_dir_tree(asset_pack_dir)
+    for path_rel_dir in sorted(dirs):
+        if path_rel_dir not in existing_dirs:
+            os.mkdir(os.path.join(target_asset_pack_dir, path_rel_dir))
 
-def unpack_apk(path_dir_tmp, apk_file, number_current, number_total):
-    print('[*] unpacking %d of %d' % (number_current, number_total))
-    os.chdir(path_dir_tmp)
-    rc = execute_command_subprocess(['apktool', 'd', '-s', apk_file])
-    if rc != 0:
-        raise Exception("failed to unpack %s" % apk_file)
-    os.remove(os.path.join(path_dir_tmp, apk_file))
+    files_moved = 0
+    for path_rel, path_src in files.items():
+        if path_rel in existing_files:
+            continue
+        move_file_fast(path_src, os.path.join(target_asset_pack_dir, path_rel))
+        files_moved += 1
+        if files_written is not None:
+            files_written.append(const_apk_dir_asset_pack + '/' + path_rel)
+
+    update_apktool_config_do_not_compress(apktool_config, dir_apk_with_asset_pack)
+    return files_moved
+
+
+def get_file_sha256(path_file):
+    digest = hashlib.sha256()
+    with open(path_file, 'rb') as file:
+        while True:
+            chunk = file.read(const_extract_chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_apktool_identity():
+    if 'identity' not in apktool_identity.keys():
+        parts = list()
+        for path in [shutil.which('apktool'), find_apktool_jar()]:
+            if path is None:
+                continue
+            path = os.path.realpath(path)
+            stat = os.stat(path)
+            parts.append('%s:%d:%d' % (path, stat.st_size, int(stat.st_mtime)))
+        apktool_identity['identity'] = '|'.join(parts)
+    return apktool_identity['identity']
+
+
+def link_tree(path_dir_src, path_dir_dst, files_copied=None):
+    size_total = 0
+    for root, dirs, files in os.walk(path_dir_src):
+        path_rel = os.path.relpath(root, path_dir_src)
+        path_dir_target = os.path.normpath(os.path.join(path_dir_dst, path_rel))
+        if not os.path.exists(path_dir_target):
+            os.makedirs(path_dir_target)
+        for file in files:
+            path_file_src = os.path.join(root, file)
+            path_file_dst = os.path.join(path_dir_target, file)
+            size_total += os.path.getsize(path_file_src)
+            if files_copied is not None and path_rel == os.curdir and file in files_copied:
+                shutil.copy(path_file_src, path_file_dst)
+                continue
+            try:
+                os.link(path_file_src, path_file_dst)
+            except OSError:
+                shutil.copy(path_file_src, path_file_dst)
+    return size_total
+
+
+def lock_decode_cache(path_dir_cache, exclusive):
+    file = open(os.path.join(path_dir_cache, const_decode_cache_file_lock), 'a+')
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+    return file
+
+
+def unlock_decode_cache(file):
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    file.close()
+
+
+def create_decode_cache(path_dir_cache, size_limit_mb):
+    path_dir_cache = os.path.abspath(path_dir_cache)
+    for path in [path_dir_cache, os.path.join(path_dir_cache, const_decode_cache_dir_entries), os.path.join(path_dir_cache, const_decode_cache_dir_tmp)]:
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+    decode_cache = dict()
+    decode_cache['dir'] = path_dir_cache
+    decode_cache['size_limit'] = size_limit_mb * 1024 * 1024
+    return decode_cache
+
+
+def get_decode_cache_key(path_xapk, apk_file):
+    # the split is hashed straight from the xapk, so a cache hit never extracts it
+    with ZipFile(path_xapk, 'r') as xapk_zip_file:
+        apk_sha256 = get_zip_member_sha256(xapk_zip_file, apk_file)
+    digest = hashlib.sha256()
+    digest.update(apk_sha256.encode('utf-8'))
+    digest.update(b'\0d -s\0')
+    digest.update(get_apktool_identity().encode('utf-8'))
+    return digest.hexdigest()
+
+
+def decode_cache_lookup(decode_cache, key, path_apk_dir):
+    path_entry = os.path.join(decode_cache['dir'], const_decode_cache_dir_entries, key)
+    lock = lock_decode_cache(decode_cache['dir'], False)
+    try:
+        path_meta = os.path.join(path_entry, const_decode_cache_file_meta)
+        if not os.path.exists(path_meta):
+            return False
+        link_tree(os.path.join(path_entry, const_decode_cache_dir_tree), path_apk_dir, const_decode_cache_files_copied)
+        os.utime(path_meta, None)
+        return True
+    finally:
+        unlock_decode_cache(lock)
+
+
+def decode_cache_store(decode_cache, key, path_apk_dir):
+    path_entry_tmp = tempfile.mkdtemp(dir=os.path.join(decode_cache['dir'], const_decode_cache_dir_tmp))
+    try:
+        size = link_tree(path_apk_dir, os.path.join(path_entry_tmp, const_decode_cache_dir_tree), const_decode_cache_files_copied)
+        with open(os.path.join(path_entry_tmp, const_decode_cache_file_meta), 'w') as file:
+            json.dump({ 'size': size }, file)
+
+        path_entry = os.path.join(decode_cache['dir'], const_decode_cache_dir_entries, key)
+        lock = lock_decode_cache(decode_cache['dir'], True)
+        try:
+            if not os.path.exists(path_entry):
+                os.rename(path_entry_tmp, path_entry)
+            evict_decode_cache(decode_cache, key)
+        finally:
+            unlock_decode_cache(lock)
+    finally:
+        if os.path.exists(path_entry_tmp):
+            shutil.rmtree(path_entry_tmp, ignore_errors=True)
+
+
+def evict_decode_cache(decode_cache, key_keep):
+    path_dir_entries = os.path.join(decode_cache['dir'], const_decode_cache_dir_entries)
+    entries = list()
+    size_total = 0
+    for key in os.listdir(path_dir_entries):
+        path_meta = os.path.join(path_dir_entries, key, const_decode_cache_file_meta)
+        try:
+            with open(path_meta, 'r') as file:
+                size = json.load(file)['size']
+            last_used = os.path.getmtime(path_meta)
+        except (IOError, OSError, ValueError, KeyError):
+            shutil.rmtree(os.path.join(path_dir_entries, key), ignore_errors=True)
+            continue
+        size_total += size
+        entries.append((last_used, key, size))
+    entries.sort()
+    for last_used, key, size in entries:
+        if size_total <= decode_cache['size_limit']:
+            break
+        if key == key_keep:
+            continue
+        shutil.rmtree(os.path.join(path_dir_entries, key), ignore_errors=True)
+        size_total -= size
+
+
+def unpack_apk(path_dir_tmp, apk_file, number_current, number_total, decode_cache=None, report=None, lazy_extract=None):
+    print_synchronized('[*] unpacking %d of %d' % (number_current, number_total))
+    path_apk_file = os.path.join(path_dir_tmp, apk_file)
+    path_apk_dir = os.path.join(path_dir_tmp, os.path.splitext(apk_file)[0])
+    decode_cache_key = None
+    if decode_cache is not None:
+        with profile_stage(report, 'cache lookup', apk_file) as stage:
+            decode_cache_key = get_decode_cache_key(lazy_extract['path_xapk'], apk_file)
+            stage['cache_hit'] = decode_cache_lookup(decode_cache, decode_cache_key, path_apk_dir)
+            if stage['cache_hit']:
+                print_synchronized('[*] %s found in decode cache' % apk_file)
+                stage['files'] = count_files_in_dir(path_apk_dir)
+        if stage['cache_hit']:
+            return
+    if lazy_extract is not None:
+        # the split is only extracted right before its decode, and its apk is deleted right after it
+        apk = lazy_extract['apks'][apk_file]
+        if lazy_extract['check_free_space']:
+            check_free_space(path_dir_tmp, apk['apk_file_size'] + apk['apk_uncompressed_size'] * const_low_footprint_decode_factor, 'decode of %s' % apk_file)
+        with ZipFile(lazy_extract['path_xapk'], 'r') as xapk_zip_file:
+            extract_xapk_apks(xapk_zip_file, [apk], report)
+    with profile_stage(report, 'decode', apk_file) as stage:
+        rc = execute_apktool(['d', '-s', '-o', path_apk_dir, path_apk_file], cwd=path_dir_tmp)
+        if rc != 0:
+            raise Exception("failed to unpack %s" % apk_file)
+        if decode_cache is not None:
+            decode_cache_store(decode_cache, decode_cache_key, path_apk_dir)
+        os.remove(path_apk_file)
+        stage['files'] = count_files_in_dir(path_apk_dir)
+
+
+def unpack_apks(path_dir_tmp, apk_files, jobs, decode_cache=None, report=None, lazy_extract=None):
+    number_total = len(apk_files)
+    if jobs <= 1:
+        for index, apk_file in enumerate(apk_files):
+            unpack_apk(path_dir_tmp, apk_file, index + 1, number_total, decode_cache, report, lazy_extract)
+        return
+
+    failed_apk_files = list()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = list()
+        for index, apk_file in enumerate(apk_files):
+            futures.append((apk_file, executor.submit(unpack_apk, path_dir_tmp, apk_file, index + 1, number_total, decode_cache, report, lazy_extract)))
+        for apk_file, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print_synchronized('[!] %s' % e)
+                failed_apk_files.append(apk_file)
+    if len(failed_apk_files) > 0:
+        raise Exception("failed to unpack %d of %d parts: %s" % (len(failed_apk_files), number_total, ', '.join(failed_apk_files)))
+
+
+def iterate_unpacked_apks(path_dir_tmp, apk_files, apk_files_to_decode, jobs, decode_cache=None, report=None, lazy_extract=None, max_ahead=None):
+    # yields the apks in the given order, each one as soon as it and all apks before it are decoded,
+    # so the caller merges in priority order while the remaining splits are still decoding.
+    # with max_ahead, no more than max_ahead splits past the one the caller merges are decoding or decoded,
+    # the next decode starts when the caller asks for the next apk, so the previous one is merged and deleted by then
+    number_total = len(apk_files_to_decode)
+    apk_files_pending = [apk_file for apk_file in apk_files if apk_file in apk_files_to_decode]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = dict()
+
+        def submit_decodes(decodes_done):
+            while len(apk_files_pending) > 0 and (max_ahead is None or len(futures) - decodes_done < max_ahead):
+                apk_file_next = apk_files_pending.pop(0)
+                futures[apk_file_next] = executor.submit(unpack_apk, path_dir_tmp, apk_file_next, len(futures) + 1, number_total, decode_cache, report, lazy_extract)
+
+        has_failed = False
+        try:
+            decodes_done = 0
+            for apk_file in apk_files:
+                submit_decodes(decodes_done)
+                if apk_file in futures.keys():
+                    if futures[apk_file].exception() is not None:
+                        has_failed = True
+                        break
+                    decodes_done += 1
+                    submit_decodes(decodes_done)
+                yield apk_file
+        except BaseException:
+            # the caller failed or stopped iterating, the decodes that did not start yet are dropped
+            for future in futures.values():
+                future.cancel()
+            raise
+        if not has_failed:
+            return
+        # nothing can be merged past a failed split, but the running decodes are drained so every failure is reported at once
+        failed_apk_files = list()
+        for apk_file, future in futures.items():
+            if future.exception() is not None:
+                print_synchronized('[!] %s' % future.exception())
+                failed_apk_files.append(apk_file)
+    raise Exception("failed to unpack %d of %d parts: %s" % (len(failed_apk_files), number_total, ', '.join(failed_apk_files)))
 
 
 def pack_apk(path_dir_tmp, main_apk_dir):
-    print('[*] repack apk')
-    os.chdir(path_dir_tmp)
-    rc = execute_command_subprocess(['apktool', 'b', main_apk_dir])
+    print_synchronized('[*] repack apk')
+    rc = execute_apktool(['b', os.path.abspath(os.path.join(path_dir_tmp, main_apk_dir))], cwd=path_dir_tmp)
     if rc != 0:
         raise Exception("failed to pack apk")
 
     built_apk_file_path = os.path.join(path_dir_tmp, main_apk_dir, 'dist', '%s%s' % (os.path.basename(main_apk_dir), const_ext_apk))
     if not os.path.exists(built_apk_file_path):
         raise Exception("result apk not found")
+    return built_apk_file_path
 
-    build_apk_target_file = os.path.join(path_dir_tmp, '%s%s' % (const_file_target_file, const_ext_apk))
-    if os.path.exists(build_apk_target_file):
-        os.remove(build_apk_target_file)
 
-    shutil.copy(built_apk_file_path, build_apk_target_file)
-
-
-def zipalign_apk(path_dir_tmp):
-    print('[*] zipalign apk')
-    os.chdir(path_dir_tmp)
-
-    built_apk_file_path = os.path.join(path_dir_tmp, const_file_target_file + const_ext_apk)
-    if not os.path.exists(built_apk_file_path):
+def load_sign_key(sign_config):
+    # keystores are parsed once per process, batch workers and service workers reuse the key for every apk
+    if sign_config.get(const_sign_property_engine, const_sign_engine_apksigner).lower() != const_sign_engine_python:
+        return None
+    path_keystore = sign_config['sign.keystore.file']
+    cache_key = (os.path.abspath(path_keystore), os.path.getmtime(path_keystore), sign_config['sign.key.alias'])
+    with sign_keys_lock:
+        if cache_key not in sign_keys.keys():
+            sign_key = None
+            try:
+                if xapktoapk_signer is None:
+                    raise Exception("xapktoapk_signer.py not found next to the script")
+                with open(path_keystore, 'rb') as file:
+                    data = file.read()
+                sign_key = xapktoapk_signer.load_keystore(data, sign_config['sign.keystore.password'], sign_config['sign.key.alias'], sign_config['sign.key.password'])
+            except Exception as e:
+                print_synchronized('[!] cannot sign in process, falling back to apksigner: %s' % e)
+            sign_keys[cache_key] = sign_key
+        return sign_keys[cache_key]
+
+
+def get_plan_sign_engine(plan, sign_config):
+    sign_engine = sign_config.get(const_sign_property_engine, const_sign_engine_apksigner).lower()
+    if sign_engine == const_sign_engine_python and (plan['min_sdk_version'] is None or plan['min_sdk_version'] < const_sign_engine_python_min_sdk):
+        # the in-process signer writes only v2 and v3 signatures
+        return const_sign_engine_apksigner
+    return sign_engine
+
+
+def get_plan_sign_config(plan, sign_config):
+    if get_plan_sign_engine(plan, sign_config) == sign_config.get(const_sign_property_engine, const_sign_engine_apksigner).lower():
+        return sign_config
+    min_sdk_version = 'unknown' if plan['min_sdk_version'] is None else plan['min_sdk_version']
+    if not check_if_executable_exists_in_path('apksigner'):
+        raise Exception("minSdkVersion is %s, the apk needs a v1 signature and apksigner is not found in $PATH" % min_sdk_version)
+    print_synchronized('[!] minSdkVersion is %s, signing with apksigner for the v1 signature' % min_sdk_version)
+    sign_config = dict(sign_config)
+    sign_config[const_sign_property_engine] = const_sign_engine_apksigner
+    return sign_config
+
+
+def sign_apk_in_process(path_apk, sign_key):
+    # the apk is already aligned, the signing block is written in place between the entries and the central directory
+    with open(path_apk, 'r+b') as file:
+        eocd = zip_read_end_of_central_directory(file)
+        magic = xapktoapk_signer.const_sign_block_magic
+        if eocd['cd_offset'] >= len(magic):
+            file.seek(eocd['cd_offset'] - len(magic))
+            if file.read(len(magic)) == magic:
+                raise Exception("apk file is already signed")
+        content_digest = xapktoapk_signer.compute_apk_content_digest(file, eocd)
+        signing_block = xapktoapk_signer.create_apk_signing_block(content_digest, sign_key)
+        file.seek(eocd['cd_offset'])
+        tail = bytearray(file.read())
+        struct.pack_into('<I', tail, eocd['offset'] - eocd['cd_offset'] + 16, eocd['cd_offset'] + len(signing_block))
+        file.seek(eocd['cd_offset'])
+        file.write(signing_block)
+        file.write(tail)
+        file.truncate()
+
+
+def sign_apk(path_apk, sign_config):
+    if not os.path.exists(path_apk):
         raise Exception("result apk not found")
 
-    prefix_aligned = 'aligned_'
-    built_apk_file_aligned_path = os.path.join(path_dir_tmp, prefix_aligned + const_file_target_file + const_ext_apk)
-    if os.path.exists(built_apk_file_aligned_path):
-        os.remove(built_apk_file_aligned_path)
-
-    rc = execute_command_subprocess(['zipalign', '-p', '-f', '4', built_apk_file_path, built_apk_file_aligned_path])
-    if rc != 0:
-        raise Exception("failed to zipalign apk")
-    if not os.path.exists(built_apk_file_aligned_path):
-        raise Exception("failed to zipalign apk")
-
-    os.remove(built_apk_file_path)
-    shutil.move(built_apk_file_aligned_path, built_apk_file_path)
-
-
-def sign_apk(path_dir_tmp, sign_config):
-    build_apk_target_file = os.path.join(path_dir_tmp, '%s%s' % (const_file_target_file, const_ext_apk))
-    if not os.path.exists(build_apk_target_file):
-        raise Exception("result apk not found")
+    sign_key = load_sign_key(sign_config)
+    if sign_key is not None:
+        print('[*] resign apk in process')
+        with acquire_stage_slot('disk'):
+            sign_apk_in_process(path_apk, sign_key)
+        return
 
     print('[*] resign apk')
-    os.chdir(path_dir_tmp)
-    rc = execute_command_subprocess(['apksigner', 'sign', '--ks', sign_config['sign.keystore.file'], '--ks-pass', 'pass:%s' % sign_config['sign.keystore.password'], '--ks-key-alias', sign_config['sign.key.alias'], '--key-pass', 'pass:%s' % sign_config['sign.key.password'], build_apk_target_file])
+    with acquire_stage_slot('jvm'):
+        rc = execute_command_subprocess(['apksigner', 'sign', '--ks', sign_config['sign.keystore.file'], '--ks-pass', 'pass:%s' % sign_config['sign.keystore.password'], '--ks-key-alias', sign_config['sign.key.alias'], '--key-pass', 'pass:%s' % sign_config['sign.key.password'], path_apk], cwd=os.path.dirname(path_apk))
     if rc != 0:
         raise Exception("failed to sign apk file")
 
@@ -435,26 +2369,165 @@ def load_sign_properties():
     return properties
 
 
-def build_single_apk(path_to_tmp_dir, path_to_main_apk_dir, should_sign_apk, sign_config):
-    pack_apk(path_to_tmp_dir, path_to_main_apk_dir)
-    zipalign_apk(path_to_tmp_dir)
-    if should_sign_apk:
-        sign_apk(path_to_tmp_dir, sign_config)
+def apk_requires_resource_merge(apk):
+    for entry_name in apk['apk_entry_names']:
+        if entry_name == const_apk_file_resources_table or entry_name.startswith(const_apk_dir_res + '/'):
+            return True
+    return False
 
 
-def copy_single_apk_to_working_dir(path_to_tmp_dir, path_to_working_dir, target_name):
-    file_src = os.path.join(path_to_tmp_dir, const_file_target_file + const_ext_apk)
-    if not os.path.exists(file_src) or os.path.isdir(file_src):
-        raise Exception("result apk file not found")
+def find_raw_merge_blocker(plan):
+    for apk in plan['apks_dpi'] + plan['apks_locale']:
+        if apk_requires_resource_merge(apk):
+            return apk
+    return None
+
+
+def check_raw_merge_possible(plan):
+    apk = find_raw_merge_blocker(plan)
+    if apk is not None:
+        print('[*] raw merge is not possible, %s contains resources - using apktool' % apk['apk_file_name'])
+        return False
+    return True
+
+
+def is_native_lib_entry(entry_name):
+    return entry_name.startswith(const_apk_dir_lib + '/')
+
+
+def write_raw_apk(file_dst, path_xapk, plan, native_libs):
+    existing_entry_names = set()
+    cd_records = list()
+    with ZipFile(path_xapk, 'r') as xapk_zip_file:
+        for apk_zip_file, file_apk, zip_info in iterate_nested_apk_entries(xapk_zip_file, plan['apk_main'], None, existing_entry_names):
+            if zip_is_signature_file(zip_info.filename):
+                continue
+            if is_native_lib_entry(zip_info.filename):
+                if not is_native_lib_selected(native_libs, zip_info.filename[len(const_apk_dir_lib) + 1:]):
+                    record_native_lib_stripped(native_libs, zip_info.compress_size)
+                    continue
+                native_libs['entries'][zip_info.filename] = (zip_info.CRC, zip_info.file_size)
+            if zip_info.filename == 'AndroidManifest.xml':
+                data = patch_binary_manifest(apk_zip_file.read(zip_info))
+                cd_records.append(zip_write_entry_bytes(file_dst, zip_info, data))
+            else:
+                cd_records.append(zip_copy_entry_raw(file_apk, zip_info, file_dst))
+        write_arch_apk_entries(file_dst, xapk_zip_file, plan['apks_arch'] + plan['apks_arch_zip'], existing_entry_names, cd_records, native_libs)
+        for apk_locale in plan['apks_locale']:
+            for apk_zip_file, file_apk, zip_info in iterate_nested_apk_entries(xapk_zip_file, apk_locale, [const_apk_dir_asset_pack + '/'], existing_entry_names):
+                cd_records.append(zip_copy_entry_raw(file_apk, zip_info, file_dst))
+    zip_write_central_directory(file_dst, cd_records)
+
+
+def write_aligned_apk(file_dst, path_built_apk, path_xapk, apks_arch_zip, native_libs):
+    existing_entry_names = set()
+    cd_records = list()
+    with open(path_built_apk, 'rb') as file_built_apk:
+        with ZipFile(file_built_apk, 'r') as built_zip_file:
+            entries = [zip_info for zip_info in built_zip_file.infolist()]
+            entries.sort(key=lambda x: x.header_offset)
+            for zip_info in entries:
+                existing_entry_names.add(zip_info.filename)
+                if is_native_lib_entry(zip_info.filename):
+                    native_libs['entries'][zip_info.filename] = (zip_info.CRC, zip_info.file_size)
+                cd_records.append(zip_copy_entry_raw(file_built_apk, zip_info, file_dst))
+    if len(apks_arch_zip) > 0:
+        with ZipFile(path_xapk, 'r') as xapk_zip_file:
+            write_arch_apk_entries(file_dst, xapk_zip_file, apks_arch_zip, existing_entry_names, cd_records, native_libs)
+    zip_write_central_directory(file_dst, cd_records)
+
+
+def write_arch_apk_entries(file_dst, xapk_zip_file, apks_arch, existing_entry_names, cd_records, native_libs):
+    # entries of abis that were not selected are dropped, an entry that is already in the apk is only compared by crc and size
+    for apk_arch in apks_arch:
+        print_synchronized('[*] merging native libraries of %s' % apk_arch['apk_file_name'])
+        entries_skipped = list()
+        for apk_zip_file, file_apk, zip_info in iterate_nested_apk_entries(xapk_zip_file, apk_arch, [const_apk_dir_lib + '/'], existing_entry_names, entries_skipped):
+            if not is_native_lib_selected(native_libs, zip_info.filename[len(const_apk_dir_lib) + 1:]):
+                record_native_lib_stripped(native_libs, zip_info.compress_size)
+                continue
+            native_libs['entries'][zip_info.filename] = (zip_info.CRC, zip_info.file_size)
+            cd_records.append(zip_copy_entry_raw(file_apk, zip_info, file_dst))
+        for zip_info in entries_skipped:
+            if not is_native_lib_selected(native_libs, zip_info.filename[len(const_apk_dir_lib) + 1:]):
+                record_native_lib_stripped(native_libs, zip_info.compress_size)
+                continue
+            is_same_content = native_libs['entries'].get(zip_info.filename) == (zip_info.CRC, zip_info.file_size)
+            record_native_lib_duplicate(native_libs, zip_info.filename, is_same_content, zip_info.compress_size)
 
-    file_dst = os.path.join(path_to_working_dir, target_name + const_ext_apk)
-    if os.path.exists(file_dst):
-        if os.path.isdir(file_dst):
-            shutil.rmtree(file_dst)
-        else:
-            os.remove(file_dst)
 
-    shutil.copy(file_src, file_dst)
+def write_output_apk(path_output_apk, write_stage_name, write_function, should_sign_apk, sign_config, report):
+    # the apk is written once, already aligned, next to the output and renamed into place when complete
+    if os.path.isdir(path_output_apk):
+        shutil.rmtree(path_output_apk)
+    path_dir_output = os.path.dirname(os.path.abspath(path_output_apk))
+    file_descriptor, path_output_apk_tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path_output_apk) + '.', dir=path_dir_output)
+    try:
+        with profile_stage(report, write_stage_name) as stage:
+            with os.fdopen(file_descriptor, 'wb') as file_dst:
+                with acquire_stage_slot('disk'):
+                    write_function(file_dst)
+            with ZipFile(path_output_apk_tmp, 'r') as output_zip_file:
+                stage['files'] = len(output_zip_file.infolist())
+        add_bytes_written(report, write_stage_name, os.path.getsize(path_output_apk_tmp))
+        if should_sign_apk:
+            with profile_stage(report, 'sign') as stage:
+                sign_apk(path_output_apk_tmp, sign_config)
+                stage['files'] = 1
+            add_bytes_written(report, 'sign', os.path.getsize(path_output_apk_tmp))
+        set_default_file_mode(path_output_apk_tmp)
+        os.replace(path_output_apk_tmp, path_output_apk)
+    finally:
+        if os.path.exists(path_output_apk_tmp):
+            os.remove(path_output_apk_tmp)
+
+
+def build_single_apk(path_to_tmp_dir, path_to_main_apk_dir, should_sign_apk, sign_config, path_xapk, apks_arch_zip, native_libs, path_output_apk, report, low_footprint=False):
+    with profile_stage(report, 'apktool build') as stage:
+        built_apk_file_path = pack_apk(path_to_tmp_dir, path_to_main_apk_dir)
+        stage['files'] = 1
+    add_bytes_written(report, 'apktool build', os.path.getsize(built_apk_file_path))
+    if low_footprint:
+        check_output_free_space(path_output_apk, os.path.getsize(built_apk_file_path) + sum([apk['apk_file_size'] for apk in apks_arch_zip]), should_sign_apk)
+    print_synchronized('[*] write aligned apk')
+    write_output_apk(path_output_apk, 'aligned write', lambda file_dst: write_aligned_apk(file_dst, built_apk_file_path, path_xapk, apks_arch_zip, native_libs), should_sign_apk, sign_config, report)
+    add_native_libs_savings(report, native_libs)
+    return built_apk_file_path
+
+
+def check_output_free_space(path_output_apk, bytes_apk, should_sign_apk):
+    # apksigner writes the signed apk next to the unsigned one before it replaces it
+    check_free_space(os.path.dirname(os.path.abspath(path_output_apk)), bytes_apk * (2 if should_sign_apk else 1), 'result apk')
+
+
+def build_single_apk_raw(path_xapk, plan, should_sign_apk, sign_config, path_output_apk, report, low_footprint=False):
+    print('[*] raw merge apk')
+    if low_footprint:
+        check_output_free_space(path_output_apk, sum([apk['apk_file_size'] for apk in [plan['apk_main']] + plan['apks_arch_zip'] + plan['apks_locale']]), should_sign_apk)
+    native_libs = create_native_libs_merge(plan['abis'])
+    write_output_apk(path_output_apk, 'raw merge', lambda file_dst: write_raw_apk(file_dst, path_xapk, plan, native_libs), should_sign_apk, sign_config, report)
+    add_native_libs_savings(report, native_libs)
+
+
+def add_bytes_written(report, stage, bytes_count):
+    report['bytes_written'][stage] = report['bytes_written'].get(stage, 0) + bytes_count
+
+
+def print_bytes_written(report):
+    stages = ['%s %.1f MB' % (stage, report['bytes_written'][stage] / 1024.0 / 1024.0) for stage in report['bytes_written'].keys()]
+    print('[*] bytes written: %s' % ', '.join(stages))
+
+
+def add_native_libs_savings(report, native_libs):
+    for key in report['native_libs'].keys():
+        report['native_libs'][key] += native_libs[key]
+
+
+def print_native_libs_savings(report):
+    savings = report['native_libs']
+    if savings['stripped_files'] == 0 and savings['duplicate_files'] == 0 and savings['conflicts'] == 0:
+        return
+    print('[*] native libraries: %d files of other abis stripped (%.1f MB), %d duplicate files skipped (%.1f MB), %d conflicts' % (savings['stripped_files'], savings['stripped_bytes'] / 1024.0 / 1024.0, savings['duplicate_files'], savings['duplicate_bytes'] / 1024.0 / 1024.0, savings['conflicts']))
 
 
 def prioritize_dpi_apk_list_rev_sort(apks_dpi):
@@ -482,62 +2555,349 @@ def prioritize_dpi_apk_list(apks_dpi):
     return apks_dpi_prioritzed
 
 
-def main():
-    if not check_sys_args():
-        print_help()
-        exit(-1)
-
-    tested_binary = "apktool"
-    if not check_if_executable_exists_in_path(tested_binary):
-        print("executable %s not found in $PATH, please install it before running xapktoapk" % tested_binary)
-        exit(-2)
-
-    tested_binary = "zipalign"
-    if not check_if_executable_exists_in_path(tested_binary):
-        print("executable %s not found in $PATH, please install it before running xapktoapk" % tested_binary)
-        exit(-2)
-
-    sign_properties = load_sign_properties()
-    should_sign_apk = sign_properties is not None
-    if should_sign_apk:
-        tested_binary = "apksigner"
-        if not check_if_executable_exists_in_path(tested_binary):
-            print("executable %s not found in $PATH, please install it before running xapktoapk" % tested_binary)
-            exit(-2)
+def get_zip_member_sha256(zip_file, member_name):
+    digest = hashlib.sha256()
+    with zip_file.open(member_name, 'r') as file:
+        while True:
+            chunk = file.read(const_extract_chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_incremental_plan_key(options, plan):
+    # anything that changes the merged tree apart from the split contents
+    digest = hashlib.sha256()
+    for option in [const_option_dpi, const_option_abi, const_option_locale, const_option_decode_arch]:
+        digest.update(('%s=%s\0' % (option, options.get(option))).encode('utf-8'))
+    for apk in get_plan_apks(plan):
+        digest.update(('%s\0' % apk['apk_file_name']).encode('utf-8'))
+    digest.update(get_apktool_identity().encode('utf-8'))
+    digest.update(('version=%d\0' % const_incremental_state_version).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_incremental_merge_keys(plan_key, plan, hashes):
+    # one key per merge step, covering the plan and every split merged up to it, so a stored step stays valid as long as nothing before it changed
+    keys = list()
+    key = plan_key
+    for apk in get_plan_apks(plan):
+        key = hashlib.sha256(('%s\0%s\0%s' % (key, apk['apk_file_name'], hashes[apk['apk_file_name']])).encode('utf-8')).hexdigest()
+        keys.append(key)
+    return keys
+
+
+def read_incremental_merge_step(incremental_state, index):
+    try:
+        with open(os.path.join(incremental_state['dir'], const_incremental_dir_merged, str(index), const_decode_cache_file_meta), 'r') as file:
+            return json.load(file)
+    except (IOError, OSError, ValueError):
+        return None
 
-    xapk_file_name = get_param_xapk_file_name()
-    xapk_file_abs_path = get_param_xapk_abs_path()
-    original_file_name, original_file_extension = file_split_name_and_extension(xapk_file_name)
 
-    print('[*] start')
-    cwd = os.path.abspath(os.path.curdir)
+def write_incremental_state_file(incremental_state, hashes):
+    data = dict()
+    data['version'] = const_incremental_state_version
+    data['plan_key'] = incremental_state['plan_key']
+    data['splits'] = hashes
+    path_file_state = os.path.join(incremental_state['dir'], const_incremental_file_state)
+    path_file_state_tmp = path_file_state + '.tmp'
+    with open(path_file_state_tmp, 'w') as file:
+        json.dump(data, file, indent=2)
+    os.replace(path_file_state_tmp, path_file_state)
+
+
+def open_incremental_state(path_dir_incremental, package_name, options, plan, xapk_zip_file):
+    path_dir_state = os.path.join(os.path.abspath(path_dir_incremental), os.path.basename(package_name))
+    path_dir_splits = os.path.join(path_dir_state, const_incremental_dir_splits)
+    for path_dir in [path_dir_splits, os.path.join(path_dir_state, const_incremental_dir_merged)]:
+        if not os.path.exists(path_dir):
+            try:
+                os.makedirs(path_dir)
+            except OSError:
+                if not os.path.isdir(path_dir):
+                    raise
+    incremental_state = dict()
+    incremental_state['dir'] = path_dir_state
+    incremental_state['lock'] = lock_decode_cache(path_dir_state, True)
+    try:
+        incremental_state['plan_key'] = get_incremental_plan_key(options, plan)
+        incremental_state['hashes'] = dict([(apk['apk_file_name'], get_zip_member_sha256(xapk_zip_file, apk['apk_file_name'])) for apk in get_plan_apks(plan)])
+        incremental_state['merge_keys'] = get_incremental_merge_keys(incremental_state['plan_key'], plan, incremental_state['hashes'])
+
+        # the splits of the longest stored prefix of the merge order are neither decoded nor merged again
+        incremental_state['merged'] = list()
+        for index, apk in enumerate(get_plan_apks(plan)):
+            meta = read_incremental_merge_step(incremental_state, index)
+            if meta is None or meta.get('key') != incremental_state['merge_keys'][index]:
+                break
+            incremental_state['merged'].append(apk['apk_file_name'])
+
+        previous_hashes = dict()
+        try:
+            with open(os.path.join(path_dir_state, const_incremental_file_state), 'r') as file:
+                data = json.load(file)
+            if data['version'] == const_incremental_state_version and data['plan_key'] == incremental_state['plan_key']:
+                previous_hashes = data['splits']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        incremental_state['unchanged'] = set()
+        for apk in get_plan_apks(plan):
+            if previous_hashes.get(apk['apk_file_name']) != incremental_state['hashes'][apk['apk_file_name']]:
+                continue
+            if os.path.isdir(os.path.join(path_dir_splits, apk['apk_dir_name'])):
+                incremental_state['unchanged'].add(apk['apk_file_name'])
+        path_built_apk = os.path.join(path_dir_state, const_incremental_file_built_apk)
+        incremental_state['built_apk'] = None
+        if len(incremental_state['unchanged']) == len(get_plan_apks(plan)) and os.path.exists(path_built_apk):
+            incremental_state['built_apk'] = path_built_apk
+        else:
+            # the stored state is only trusted again once the new one is complete
+            write_incremental_state_file(incremental_state, dict([(name, incremental_state['hashes'][name]) for name in incremental_state['unchanged']]))
+            delete_file_if_exists(path_built_apk)
+    except:
+        close_incremental_state(incremental_state)
+        raise
+    return incremental_state
+
+
+def close_incremental_state(incremental_state):
+    if incremental_state is not None and incremental_state['lock'] is not None:
+        unlock_decode_cache(incremental_state['lock'])
+        incremental_state['lock'] = None
+
+
+def restore_incremental_splits(incremental_state, apks):
+    for apk in apks:
+        link_tree(os.path.join(incremental_state['dir'], const_incremental_dir_splits, apk['apk_dir_name']), apk['apk_dir_path'], const_decode_cache_files_copied)
+
+
+def restore_incremental_merged_tree(incremental_state, path_dir_main):
+    # rebuilds the main tree as it was after the last stored merge step and returns the meta data of that step
+    path_dir_merged = os.path.join(incremental_state['dir'], const_incremental_dir_merged)
+    link_tree(os.path.join(path_dir_merged, '0', const_decode_cache_dir_tree), path_dir_main, const_decode_cache_files_copied)
+    for index in range(1, len(incremental_state['merged'])):
+        path_dir_step = os.path.join(path_dir_merged, str(index), const_decode_cache_dir_tree)
+        for root, dirs, files in os.walk(path_dir_step):
+            path_dir_target = os.path.normpath(os.path.join(path_dir_main, os.path.relpath(root, path_dir_step)))
+            os.makedirs(path_dir_target, exist_ok=True)
+            for file in files:
+                # values xml files merged again by a later step replace the earlier ones, which may be hardlinked into the stored base tree
+                path_file_dst = os.path.join(path_dir_target, file)
+                delete_file_if_exists(path_file_dst)
+                copy_file_fast(os.path.join(root, file), path_file_dst)
+    return read_incremental_merge_step(incremental_state, len(incremental_state['merged']) - 1)
+
+
+def store_incremental_merge_step(incremental_state, index, path_dir_main, files_written, apktool_config, native_libs):
+    # step 0 keeps the whole main tree, every later step only the files its merge wrote, the meta data is written last
+    path_dir_step = os.path.join(incremental_state['dir'], const_incremental_dir_merged, str(index))
+    if os.path.exists(path_dir_step):
+        shutil.rmtree(path_dir_step)
+    path_dir_tree = os.path.join(path_dir_step, const_decode_cache_dir_tree)
+    if files_written is None:
+        link_tree(path_dir_main, path_dir_tree, const_decode_cache_files_copied)
+    else:
+        os.makedirs(path_dir_tree)
+        for path_rel in files_written:
+            path_file_dst = os.path.join(path_dir_tree, path_rel)
+            os.makedirs(os.path.dirname(path_file_dst), exist_ok=True)
+            copy_file_fast(os.path.join(path_dir_main, path_rel), path_file_dst)
+    meta = dict()
+    meta['key'] = incremental_state['merge_keys'][index]
+    meta['do_not_compress'] = sorted(apktool_config['do_not_compress'])
+    meta['apktool_config_changed'] = apktool_config['changed']
+    meta['native_libs'] = dict([(counter, native_libs[counter]) for counter in const_incremental_native_libs_counters])
+    with open(os.path.join(path_dir_step, const_decode_cache_file_meta), 'w') as file:
+        json.dump(meta, file)
+
+
+def store_incremental_splits(incremental_state, apks):
+    for apk in apks:
+        path_dir_split = os.path.join(incremental_state['dir'], const_incremental_dir_splits, apk['apk_dir_name'])
+        if os.path.exists(path_dir_split):
+            shutil.rmtree(path_dir_split)
+        link_tree(apk['apk_dir_path'], path_dir_split, const_decode_cache_files_copied)
+
+
+def save_incremental_state(incremental_state, plan, path_built_apk):
+    apk_dir_names = set([apk['apk_dir_name'] for apk in get_plan_apks(plan)])
+    path_dir_splits = os.path.join(incremental_state['dir'], const_incremental_dir_splits)
+    for apk_dir_name in os.listdir(path_dir_splits):
+        if apk_dir_name not in apk_dir_names:
+            shutil.rmtree(os.path.join(path_dir_splits, apk_dir_name), ignore_errors=True)
+    # steps past the end of the merge order are left over from a plan with more splits
+    path_dir_merged = os.path.join(incremental_state['dir'], const_incremental_dir_merged)
+    for step_name in os.listdir(path_dir_merged):
+        if not step_name.isdigit() or int(step_name) >= len(get_plan_apks(plan)):
+            shutil.rmtree(os.path.join(path_dir_merged, step_name), ignore_errors=True)
+    copy_file_fast(path_built_apk, os.path.join(incremental_state['dir'], const_incremental_file_built_apk))
+    write_incremental_state_file(incremental_state, incremental_state['hashes'])
+
+
+def merge_and_build_apk_with_apktool(options, path_dir_tmp, xapk_file_abs_path, plan, should_sign_apk, sign_properties, path_output_apk, report, incremental_state=None):
+    if incremental_state is not None and incremental_state['built_apk'] is not None:
+        report['skipped_stages'] += ['decode', 'merge', 'manifest', 'apktool build']
+        print('[*] incremental: nothing changed since the previous run, skipping %s' % ', '.join(report['skipped_stages']))
+        print_synchronized('[*] write aligned apk')
+        native_libs = create_native_libs_merge(plan['abis'])
+        write_output_apk(path_output_apk, 'aligned write', lambda file_dst: write_aligned_apk(file_dst, incremental_state['built_apk'], xapk_file_abs_path, plan['apks_arch_zip'], native_libs), should_sign_apk, sign_properties, report)
+        add_native_libs_savings(report, native_libs)
+        return
 
-    path_dir_tmp = create_tmp_dir(cwd)
-    path_target_file_xapk = os.path.join(path_dir_tmp, const_file_target_file + const_ext_xapk)
-    shutil.copy(xapk_file_abs_path, path_target_file_xapk)
-
-    target_file_name_zip = const_file_target_file + const_ext_zip
-    path_target_file_zip = os.path.join(path_dir_tmp, target_file_name_zip)
-    os.rename(path_target_file_xapk, path_target_file_zip)
-
-    print('[*] unpacking xapk')
-    with ZipFile(path_target_file_zip, 'r') as zip_file:
-        zip_file.extractall(path=path_dir_tmp)
-    os.remove(path_target_file_zip)
-
-    xapk_manifest_data = None
-    path_xapk_manifest = os.path.join(path_dir_tmp, const_file_xapk_manifest)
-    with open(path_xapk_manifest, 'r') as file:
-        xapk_manifest_data = json.load(file)
-    xapk_package_name = xapk_manifest_data[const_file_xapk_manifest_key_package_name]
-
-    target_apk_file_names = list()
-    for file in os.listdir(path_dir_tmp):
-        if file.endswith(const_ext_apk):
-            file_abspath = os.path.abspath(os.path.join(path_dir_tmp, file))
-            if not os.path.isdir(file_abspath):
-                target_apk_file_names.append(file)
+    apks_to_decode = get_plan_apks(plan)
+    apks_merged = list()
+    if incremental_state is not None:
+        apks_merged = [apk for apk in apks_to_decode if apk['apk_file_name'] in incremental_state['merged']]
+        apks_unchanged = [apk for apk in apks_to_decode if apk['apk_file_name'] in incremental_state['unchanged'] and apk not in apks_merged]
+        apks_to_decode = [apk for apk in apks_to_decode if apk['apk_file_name'] not in incremental_state['unchanged'] and apk not in apks_merged]
+        if len(apks_merged) > 0:
+            for stage_name in ['extract', 'decode', 'merge']:
+                report['skipped_stages'] += ['%s %s' % (stage_name, apk['apk_file_name']) for apk in apks_merged]
+            print('[*] incremental: the merged tree of the first %d of %d splits is unchanged, skipping their extract, decode and merge' % (len(apks_merged), len(get_plan_apks(plan))))
+        if len(apks_unchanged) > 0:
+            report['skipped_stages'] += ['extract %s' % apk['apk_file_name'] for apk in apks_unchanged]
+            report['skipped_stages'] += ['decode %s' % apk['apk_file_name'] for apk in apks_unchanged]
+            print('[*] incremental: %d more splits unchanged, skipping their extract and decode' % len(apks_unchanged))
+        with profile_stage(report, 'restore') as stage:
+            restore_incremental_splits(incremental_state, apks_unchanged)
+            stage['files'] = len(apks_unchanged)
+            if len(apks_merged) > 0:
+                merged_meta = restore_incremental_merged_tree(incremental_state, plan['apk_main']['apk_dir_path'])
+                stage['files'] += len(apks_merged)
+
+    decode_cache = None
+    if const_option_cache_dir in options.keys():
+        decode_cache = create_decode_cache(options[const_option_cache_dir], int(options.get(const_option_cache_size, const_decode_cache_size_default_mb)))
+    low_footprint = options.get(const_option_low_footprint, False)
+    lazy_extract = None
+    if low_footprint or decode_cache is not None:
+        # with a decode cache only the splits that miss it are extracted
+        lazy_extract = { 'path_xapk': xapk_file_abs_path, 'apks': dict([(apk['apk_file_name'], apk) for apk in apks_to_decode]), 'check_free_space': low_footprint }
+
+    if 'variants' in plan.keys():
+        unpack_apks(path_dir_tmp, [apk['apk_file_name'] for apk in apks_to_decode], get_param_jobs(options), decode_cache, report, lazy_extract)
+        merge_and_build_variants(options, path_dir_tmp, xapk_file_abs_path, plan, should_sign_apk, sign_properties, path_output_apk, report)
+        return
 
+    # every split is merged as soon as it and all splits with a higher priority are decoded
+    apk_main = plan['apk_main']
+    apks = dict([(apk['apk_file_name'], apk) for apk in get_plan_apks(plan)])
+    apk_files_to_decode = set([apk['apk_file_name'] for apk in apks_to_decode])
+    resources_merge = None
+    apktool_config = None
+    native_libs = create_native_libs_merge(plan['abis'])
+    if len(apks_merged) > 0:
+        # the main tree is already merged up to the stored step, the rest of the merge continues from there
+        resources_merge = create_resources_merge(apk_main['apk_dir_path'], get_param_jobs(options))
+        apktool_config = load_apktool_config(apk_main['apk_dir_path'])
+        apktool_config['do_not_compress'] = set(merged_meta['do_not_compress'])
+        apktool_config['changed'] = merged_meta['apktool_config_changed']
+        native_libs.update(merged_meta['native_libs'])
+    # with --low-footprint no more than --jobs decoded splits wait for the merge, so the temp directory does not fill up when the merge is slower than the decodes
+    max_ahead = get_param_jobs(options) if low_footprint else None
+    apk_files_to_merge = [apk['apk_file_name'] for apk in get_plan_apks(plan) if apk not in apks_merged]
+    for apk_file in iterate_unpacked_apks(path_dir_tmp, apk_files_to_merge, apk_files_to_decode, get_param_jobs(options), decode_cache, report, lazy_extract, max_ahead):
+        apk = apks[apk_file]
+        if incremental_state is not None and apk_file in apk_files_to_decode:
+            store_incremental_splits(incremental_state, [apk])
+        files_written = None
+        if apk is apk_main:
+            resources_merge = create_resources_merge(apk_main['apk_dir_path'], get_param_jobs(options))
+            apktool_config = load_apktool_config(apk_main['apk_dir_path'])
+            strip_native_libs(apk_main['apk_dir_path'], native_libs)
+        else:
+            files_written = list()
+            with acquire_stage_slot('disk'):
+                if apk in plan['apks_arch']:
+                    with profile_stage(report, 'merge arch', apk_file) as stage:
+                        stage['files'] = merge_apk_arch(apk_main['apk_dir_path'], apk['apk_dir_path'], apktool_config, native_libs, files_written)
+                else:
+                    with profile_stage(report, 'merge resources', apk_file) as stage:
+                        stage['files'] = merge_apk_resources_indexed(resources_merge, apk['apk_dir_path'], files_written)
+                if apk in plan['apks_locale']:
+                    with profile_stage(report, 'merge assets', apk_file) as stage:
+                        stage['files'] = merge_apk_assets(apk_main['apk_dir_path'], apk['apk_dir_path'], apktool_config, files_written)
+        if incremental_state is not None:
+            store_incremental_merge_step(incremental_state, get_plan_apks(plan).index(apk), apk_main['apk_dir_path'], files_written, apktool_config, native_libs)
+        if low_footprint and apk is not apk_main:
+            shutil.rmtree(apk['apk_dir_path'])
+
+    with profile_stage(report, 'manifest') as stage:
+        delete_signature_related_files(apk_main['apk_dir_path'])
+        update_main_manifest_file(apk_main['apk_dir_path'])
+        write_apktool_config(apktool_config)
+        stage['files'] = 1
+
+    if low_footprint:
+        check_free_space(path_dir_tmp, sum([apk['apk_uncompressed_size'] for apk in get_plan_apks(plan)]) * const_low_footprint_build_factor, 'apktool build')
+    built_apk_file_path = build_single_apk(path_dir_tmp, apk_main['apk_dir_path'], should_sign_apk, sign_properties, xapk_file_abs_path, plan['apks_arch_zip'], native_libs, path_output_apk, report, low_footprint)
+    if incremental_state is not None:
+        save_incremental_state(incremental_state, plan, built_apk_file_path)
+
+
+def merge_and_build_variants(options, path_dir_tmp, xapk_file_abs_path, plan, should_sign_apk, sign_properties, path_output_apk, report):
+    # the locale splits and the manifest are the same for every variant, so they are merged into the decoded main tree once.
+    # every variant then gets a hardlinked copy of it, files that are changed in place are copied, everything else is only ever replaced
+    apk_main = plan['apk_main']
+    apktool_config = load_apktool_config(apk_main['apk_dir_path'])
+    if len(plan['apks_locale']) > 0:
+        with profile_stage(report, 'merge resources') as stage:
+            files_copied = merge_apks_resources(apk_main['apk_dir_path'], [apk['apk_dir_path'] for apk in plan['apks_locale']], get_param_jobs(options))
+            stage['files'] = sum(files_copied.values())
+    for apk_locale in plan['apks_locale']:
+        with profile_stage(report, 'merge assets', apk_locale['apk_file_name']) as stage:
+            stage['files'] = merge_apk_assets(apk_main['apk_dir_path'], apk_locale['apk_dir_path'], apktool_config)
+    with profile_stage(report, 'manifest') as stage:
+        delete_signature_related_files(apk_main['apk_dir_path'])
+        update_main_manifest_file(apk_main['apk_dir_path'])
+        stage['files'] = 1
+
+    variants = plan['variants']
+    jobs = min(get_param_jobs(options), len(variants))
+    if jobs <= 1:
+        for variant, variant_plan in variants:
+            build_variant(options, path_dir_tmp, xapk_file_abs_path, variant, variant_plan, apktool_config, should_sign_apk, sign_properties, path_output_apk, report)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(build_variant, options, path_dir_tmp, xapk_file_abs_path, variant, variant_plan, apktool_config, should_sign_apk, sign_properties, path_output_apk, report) for variant, variant_plan in variants]
+        errors = list()
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+        if len(errors) > 0:
+            raise errors[0]
+
+
+def build_variant(options, path_dir_tmp, xapk_file_abs_path, variant, variant_plan, apktool_config, should_sign_apk, sign_properties, path_output_apk, report):
+    print_synchronized('[*] building variant %s' % variant['name'])
+    apk_main = variant_plan['apk_main']
+    # the variant tree keeps the name of the main apk dir, apktool names the built apk after it
+    path_dir_variant = os.path.join(path_dir_tmp, const_variant_dir, variant['name'], apk_main['apk_dir_name'])
+    with profile_stage(report, 'variant copy', variant['name']) as stage:
+        link_tree(apk_main['apk_dir_path'], path_dir_variant, const_decode_cache_files_copied)
+    # the config of the main tree is never written, every variant writes its own copy before its build
+    variant_apktool_config = copy_apktool_config(apktool_config, path_dir_variant)
+    variant_native_libs = create_native_libs_merge(variant_plan['abis'])
+    strip_native_libs(path_dir_variant, variant_native_libs)
+    for apk_arch in variant_plan['apks_arch']:
+        with profile_stage(report, 'merge arch', apk_arch['apk_file_name']) as stage:
+            stage['files'] = merge_apk_arch(path_dir_variant, apk_arch['apk_dir_path'], variant_apktool_config, variant_native_libs)
+    if len(variant_plan['apks_dpi']) > 0:
+        with profile_stage(report, 'merge resources', variant['name']) as stage:
+            files_copied = merge_apks_resources(path_dir_variant, [apk['apk_dir_path'] for apk in variant_plan['apks_dpi']])
+            stage['files'] = sum(files_copied.values())
+    write_apktool_config(variant_apktool_config)
+    path_output_apk_variant = '%s-%s%s' % (os.path.splitext(path_output_apk)[0], variant['name'], const_ext_apk)
+    build_single_apk(path_dir_tmp, path_dir_variant, should_sign_apk, sign_properties, xapk_file_abs_path, variant_plan['apks_arch_zip'], variant_native_libs, path_output_apk_variant, report)
+    print_synchronized('[*] variant %s written to %s' % (variant['name'], path_output_apk_variant))
+
+
+def list_target_apks(xapk_zip_file, xapk_package_name, target_apk_file_names, path_dir_tmp):
     target_apks = dict()
     for apk_file_name in target_apk_file_names:
         apk_type = determine_split_type_by_apk_file_name(apk_file_name, xapk_package_name)
@@ -549,38 +2909,598 @@ def main():
         properties['apk_dir_name'] = os.path.splitext(apk_file_name)[0]
         properties['apk_dir_path'] = os.path.abspath(os.path.join(path_dir_tmp, properties['apk_dir_name']))
         properties['apk_split_type'] = apk_type
+        apk_entries = list_nested_zip_entries(xapk_zip_file, apk_file_name)
+        properties['apk_entry_names'] = [zip_info.filename for zip_info in apk_entries]
+        properties['apk_file_size'] = xapk_zip_file.getinfo(apk_file_name).file_size
+        properties['apk_uncompressed_size'] = sum([zip_info.file_size for zip_info in apk_entries])
         target_apks[apk_file_name] = properties
+    return target_apks
 
-    print('[*] xapk file unpacked. %d parts discovered' % len(target_apk_file_names))
 
-    unpack_number_total = len(target_apks.keys())
-    for index, apk_file_key in enumerate(target_apks.keys()):
-        apk_entry = target_apks[apk_file_key]
-        apk_file = apk_entry['apk_file_name']
-        unpack_apk(path_dir_tmp, apk_file, index + 1, unpack_number_total)
+def convert_xapk(options, xapk_file_abs_path, cwd, original_file_name, should_sign_apk, sign_properties, report=None):
+    if report is None:
+        report = create_report(xapk_file_abs_path)
+    time_start = time.time()
+    path_dir_tmp = create_tmp_dir(cwd)
+    path_output_apk = os.path.join(cwd, original_file_name + const_ext_apk)
+    incremental_state = None
+
+    try:
+        print('[*] unpacking xapk')
+        with ZipFile(xapk_file_abs_path, 'r') as xapk_zip_file:
+            with profile_stage(report, 'plan') as stage:
+                xapk_manifest_data = read_xapk_manifest(xapk_zip_file)
+                xapk_package_name = xapk_manifest_data[const_file_xapk_manifest_key_package_name]
+                report['package_name'] = xapk_package_name
+
+                target_apk_file_names = list_xapk_apk_file_names(xapk_zip_file)
+                target_apks = list_target_apks(xapk_zip_file, xapk_package_name, target_apk_file_names, path_dir_tmp)
+
+                variants = get_param_variants(options)
+                if variants is None:
+                    plan = plan_merge(target_apks, options)
+                    raw_merge = options.get(const_option_raw_merge, False) and check_raw_merge_possible(plan)
+                else:
+                    plan = plan_variants(target_apks, options, variants)
+                    raw_merge = False
+                plan['min_sdk_version'] = read_min_sdk_version(xapk_zip_file, xapk_manifest_data, plan['apk_main'])
+                if should_sign_apk:
+                    sign_properties = get_plan_sign_config(plan, sign_properties)
+                stage['files'] = len(target_apk_file_names)
+            if not raw_merge and variants is None and const_option_incremental_dir in options.keys():
+                with profile_stage(report, 'hash') as stage:
+                    incremental_state = open_incremental_state(options[const_option_incremental_dir], xapk_package_name, options, plan, xapk_zip_file)
+                    stage['files'] = len(get_plan_apks(plan))
+            if options.get(const_option_low_footprint, False):
+                write_xapk_expansion_files(xapk_zip_file, xapk_manifest_data, os.path.dirname(path_output_apk), report)
+            if not raw_merge and not options.get(const_option_low_footprint, False) and const_option_cache_dir not in options.keys():
+                apks_to_extract = get_plan_apks(plan)
+                if incremental_state is not None:
+                    if incremental_state['built_apk'] is not None:
+                        apks_to_extract = list()
+                        report['skipped_stages'].append('extract')
+                    else:
+                        apks_to_extract = [apk for apk in apks_to_extract if apk['apk_file_name'] not in incremental_state['unchanged'] and apk['apk_file_name'] not in incremental_state['merged']]
+                extract_xapk_apks(xapk_zip_file, apks_to_extract, report)
+
+        print('[*] xapk file unpacked. %d parts discovered' % len(target_apk_file_names))
+        for apk in plan['apks_skipped']:
+            print('[*] skipping %s - not needed by the merge plan' % apk['apk_file_name'])
+
+        if raw_merge:
+            build_single_apk_raw(xapk_file_abs_path, plan, should_sign_apk, sign_properties, path_output_apk, report, options.get(const_option_low_footprint, False))
+        else:
+            merge_and_build_apk_with_apktool(options, path_dir_tmp, xapk_file_abs_path, plan, should_sign_apk, sign_properties, path_output_apk, report, incremental_state)
+        print_bytes_written(report)
+        print_native_libs_savings(report)
+        report['status'] = 'ok'
+    except Exception as e:
+        report['status'] = 'failed'
+        report['error'] = str(e)
+        raise
+    finally:
+        close_incremental_state(incremental_state)
+        report['wall_time'] = time.time() - time_start
+        shutil.rmtree(path_dir_tmp, ignore_errors=True)
+    return report
+
+
+def estimate_conversion_cost(options, plan, raw_merge, expansion_files_size, should_sign_apk, sign_engine):
+    megabyte = 1024.0 * 1024.0
+    apks = get_plan_apks(plan)
+    outputs_count = len(plan['variants']) if 'variants' in plan.keys() else 1
+    uncompressed_size = sum([apk['apk_uncompressed_size'] for apk in apks])
+    output_size = sum([apk['apk_file_size'] for apk in apks + plan['apks_arch_zip']])
+    stages = dict()
+    tmp_bytes = 0
+    if raw_merge:
+        stages['raw merge'] = output_size / megabyte / const_estimate_copy_rate_mb
+    else:
+        decode_times = [const_estimate_jvm_start_time + apk['apk_uncompressed_size'] / megabyte / const_estimate_decode_rate_mb for apk in apks]
+        stages['extract'] = sum([apk['apk_file_size'] for apk in apks]) / megabyte / const_estimate_copy_rate_mb
+        stages['decode'] = max(sum(decode_times) / min(get_param_jobs(options), len(apks)), max(decode_times))
+        stages['merge'] = (uncompressed_size - plan['apk_main']['apk_uncompressed_size']) / megabyte / const_estimate_copy_rate_mb
+        stages['apktool build'] = outputs_count * (const_estimate_jvm_start_time + uncompressed_size / megabyte / const_estimate_build_rate_mb)
+        stages['aligned write'] = outputs_count * output_size / megabyte / const_estimate_copy_rate_mb
+        if options.get(const_option_low_footprint, False):
+            tmp_bytes = uncompressed_size * const_low_footprint_build_factor
+        else:
+            tmp_bytes = sum([apk['apk_file_size'] + apk['apk_uncompressed_size'] * const_low_footprint_decode_factor for apk in apks]) + outputs_count * output_size
+    output_bytes = outputs_count * output_size
+    if should_sign_apk:
+        if sign_engine == const_sign_engine_python:
+            stages['sign'] = output_bytes / megabyte / const_estimate_hash_rate_mb
+        else:
+            # apksigner writes a signed copy next to every apk
+            stages['sign'] = outputs_count * const_estimate_jvm_start_time + output_bytes / megabyte / const_estimate_copy_rate_mb
+            tmp_bytes += output_size
+    if expansion_files_size > 0:
+        stages['obb'] = expansion_files_size / megabyte / const_estimate_copy_rate_mb
+    estimate = dict()
+    estimate['time'] = dict([(stage, round(seconds, 2)) for stage, seconds in stages.items()])
+    estimate['time']['total'] = round(sum(stages.values()), 2)
+    estimate['disk'] = { 'tmp_bytes': int(tmp_bytes), 'output_bytes': int(output_bytes + expansion_files_size), 'total_bytes': int(tmp_bytes + output_bytes + expansion_files_size) }
+    return estimate
+
+
+def inspect_xapk(options, xapk_file_abs_path, should_sign_apk, sign_properties):
+    # only the central directories of the xapk and of the nested splits are read, nothing is extracted
+    result = dict()
+    result['file'] = xapk_file_abs_path
+    result['status'] = 'ok'
+    result['error'] = None
+    try:
+        result['file_size'] = os.path.getsize(xapk_file_abs_path)
+        with ZipFile(xapk_file_abs_path, 'r') as xapk_zip_file:
+            xapk_manifest_data = read_xapk_manifest(xapk_zip_file)
+            xapk_package_name = xapk_manifest_data[const_file_xapk_manifest_key_package_name]
+            result['package_name'] = xapk_package_name
+            target_apk_file_names = list_xapk_apk_file_names(xapk_zip_file)
+            target_apks = list_target_apks(xapk_zip_file, xapk_package_name, target_apk_file_names, os.curdir)
+            variants = get_param_variants(options)
+            if variants is None:
+                plan = plan_merge(target_apks, options)
+                raw_merge = find_raw_merge_blocker(plan) is None
+            else:
+                plan = plan_variants(target_apks, options, variants)
+                raw_merge = False
+            plan['min_sdk_version'] = read_min_sdk_version(xapk_zip_file, xapk_manifest_data, plan['apk_main'])
+            expansion_files = list()
+            for entry_name, install_path in list_xapk_expansion_files(xapk_zip_file, xapk_manifest_data):
+                expansion_files.append({ 'file': entry_name, 'install_path': install_path, 'size': xapk_zip_file.getinfo(entry_name).file_size })
+            apks_compress_type = dict([(apk_file_name, xapk_zip_file.getinfo(apk_file_name).compress_type) for apk_file_name in target_apk_file_names])
+
+        use_raw_merge = raw_merge and options.get(const_option_raw_merge, False)
+        if use_raw_merge:
+            merge_order = [plan['apk_main']] + plan['apks_arch'] + plan['apks_arch_zip'] + plan['apks_locale']
+        else:
+            merge_order = get_plan_apks(plan) + plan['apks_arch_zip']
+        splits = list()
+        for apk_file_name in target_apk_file_names:
+            apk = target_apks[apk_file_name]
+            split = dict()
+            split['file'] = apk_file_name
+            split['type'] = apk['apk_split_type']
+            split['config'] = get_apk_config_name(apk)
+            split['file_size'] = apk['apk_file_size']
+            split['uncompressed_size'] = apk['apk_uncompressed_size']
+            split['entries'] = len(apk['apk_entry_names'])
+            split['entries_merged'] = len(apk['apk_entry_names']) if apk is plan['apk_main'] else len(plan['entries'].get(apk_file_name, list())) if apk in merge_order else 0
+            split['stored'] = apks_compress_type[apk_file_name] == const_zip_compression_stored
+            split['resources'] = apk_requires_resource_merge(apk)
+            if apk not in merge_order:
+                split['action'] = 'skip'
+            elif use_raw_merge:
+                split['action'] = 'raw'
+            elif apk in plan['apks_arch_zip']:
+                split['action'] = 'copy'
+            else:
+                split['action'] = 'decode'
+            split['merge_index'] = merge_order.index(apk) if apk in merge_order else None
+            splits.append(split)
+        result['splits'] = splits
+        result['merge_order'] = [apk['apk_file_name'] for apk in merge_order]
+        result['raw_merge_possible'] = raw_merge
+        result['raw_merge'] = use_raw_merge
+        result['variants'] = [variant['name'] for variant, variant_plan in plan['variants']] if 'variants' in plan.keys() else None
+        result['expansion_files'] = expansion_files
+        result['totals'] = dict()
+        result['totals']['splits'] = len(splits)
+        result['totals']['splits_used'] = len(merge_order)
+        result['totals']['entries'] = sum([split['entries'] for split in splits if split['action'] != 'skip'])
+        result['totals']['entries_merged'] = sum([split['entries_merged'] for split in splits])
+        result['totals']['uncompressed_size'] = sum([split['uncompressed_size'] for split in splits if split['action'] != 'skip'])
+        result['totals']['apktool_calls'] = 0 if use_raw_merge else len(get_plan_apks(plan)) + (len(plan['variants']) if 'variants' in plan.keys() else 1)
+        result['min_sdk_version'] = plan['min_sdk_version']
+        sign_engine = get_plan_sign_engine(plan, sign_properties) if should_sign_apk else None
+        result['sign_engine'] = sign_engine
+        # expansion files are only written next to the apk with --low-footprint
+        expansion_files_size = sum([expansion['size'] for expansion in expansion_files]) if options.get(const_option_low_footprint, False) else 0
+        result['estimate'] = estimate_conversion_cost(options, plan, use_raw_merge, expansion_files_size, should_sign_apk, sign_engine)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    return result
 
-    apk_main = get_main_apk(target_apks)
-    apks_arch = get_apks_of_type(target_apks, const_split_apk_type_arch)
-    apks_dpi = get_apks_of_type(target_apks, const_split_apk_type_dpi)
-    apks_locale = get_apks_of_type(target_apks, const_split_apk_type_locale)
 
-    for apk_arch in apks_arch:
-        merge_apk_arch(apk_main['apk_dir_path'], apk_arch['apk_dir_path'])
-    apks_dpi_prioritzed = prioritize_dpi_apk_list(apks_dpi)
-    for apk_dpi in apks_dpi_prioritzed:
-        merge_apk_resources(apk_main['apk_dir_path'], apk_dpi['apk_dir_path'])
-    for apk_locale in apks_locale:
-        merge_apk_resources(apk_main['apk_dir_path'], apk_locale['apk_dir_path'])
-        merge_apk_assets(apk_main['apk_dir_path'], apk_locale['apk_dir_path'])
+def run_inspect(options, xapk_files, should_sign_apk, sign_properties):
+    data = dict()
+    data['version'] = const_inspect_version
+    data['files'] = [inspect_xapk(options, xapk_file, should_sign_apk, sign_properties) for xapk_file in xapk_files]
+    data['estimate'] = dict()
+    data['estimate']['time'] = round(sum([result['estimate']['time']['total'] for result in data['files'] if result['status'] == 'ok']), 2)
+    data['estimate']['disk_bytes'] = sum([result['estimate']['disk']['total_bytes'] for result in data['files'] if result['status'] == 'ok'])
+    print(json.dumps(data, indent=2))
+    return len([result for result in data['files'] if result['status'] != 'ok']) == 0
+
+
+def init_batch_worker(options, slots):
+    set_stage_slots(slots)
+    if options.get(const_option_apktool_daemon, False):
+        if start_apktool_daemon_pool(get_param_jobs(options), options.get(const_option_apktool_jar)):
+            # worker processes leave with os._exit(), which skips atexit handlers but runs multiprocessing finalizers
+            multiprocessing.util.Finalize(None, stop_apktool_daemon_pool, exitpriority=10)
+
+
+def convert_xapk_batch_job(options, xapk_file_abs_path, cwd, should_sign_apk, sign_properties, path_dir_output=None):
+    original_file_name = os.path.splitext(xapk_file_abs_path)[0]
+    if path_dir_output is not None:
+        cwd = path_dir_output
+        original_file_name = os.path.splitext(os.path.basename(xapk_file_abs_path))[0]
+    result = dict()
+    result['file'] = xapk_file_abs_path
+    result['status'] = 'ok'
+    result['error'] = None
+    result['report'] = create_report(xapk_file_abs_path)
+    time_start = time.time()
+    apktool_time_start = apktool_stats['time']
+    try:
+        convert_xapk(options, xapk_file_abs_path, cwd, original_file_name, should_sign_apk, sign_properties, result['report'])
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    result['time'] = time.time() - time_start
+    result['apktool_time'] = apktool_stats['time'] - apktool_time_start
+    return result
 
-    delete_signature_related_files(apk_main['apk_dir_path'])
-    update_main_manifest_file(apk_main['apk_dir_path'])
 
-    build_single_apk(path_dir_tmp, apk_main['apk_dir_path'], should_sign_apk, sign_properties)
-    copy_single_apk_to_working_dir(path_dir_tmp, cwd, original_file_name)
+def convert_xapk_batch(options, xapk_files, cwd, should_sign_apk, sign_properties):
+    batch_jobs = get_param_batch_jobs(options, len(xapk_files))
+    print('[*] batch of %d xapk files, %d in parallel' % (len(xapk_files), batch_jobs))
+    time_start = time.time()
+    results = list()
+    with ProcessPoolExecutor(max_workers=batch_jobs, initializer=init_batch_worker, initargs=(options, create_stage_slots(options))) as executor:
+        futures = list()
+        for xapk_file in xapk_files:
+            futures.append((xapk_file, executor.submit(convert_xapk_batch_job, options, xapk_file, cwd, should_sign_apk, sign_properties)))
+        for xapk_file, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                report = create_report(xapk_file)
+                report['status'] = 'failed'
+                report['error'] = str(e)
+                results.append({ 'file': xapk_file, 'status': 'failed', 'error': str(e), 'time': 0.0, 'apktool_time': 0.0, 'report': report })
+
+    failed_count = len([result for result in results if result['status'] != 'ok'])
+    print('[*] batch summary: %d converted, %d failed, %.1f s total' % (len(results) - failed_count, failed_count, time.time() - time_start))
+    for result in results:
+        if result['status'] == 'ok':
+            print('[*]   ok      %7.1f s (apktool %.1f s)  %s' % (result['time'], result['apktool_time'], result['file']))
+        else:
+            print('[!]   failed  %7.1f s (apktool %.1f s)  %s: %s' % (result['time'], result['apktool_time'], result['file'], result['error']))
+    return results
+
+
+def parse_service_address(address):
+    if address.startswith(const_service_unix_prefix):
+        path = address[len(const_service_unix_prefix):]
+        return (None, os.path.abspath(path)) if path != '' else None
+    host, port = (address.rsplit(':', 1) if ':' in address else (const_service_default_host, address))
+    try:
+        port = int(port)
+    except ValueError:
+        return None
+    if port < 0 or port > 65535:
+        return None
+    return host or const_service_default_host, port
+
+
+def init_service_worker(options, slots):
+    # ctrl+c and SIGTERM stop the service, which then lets the running jobs finish.
+    # workers are forked after the SIGTERM handler of the service is installed, so it is replaced here as well
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    init_batch_worker(options, slots)
+
+
+def create_service(options, should_sign_apk, sign_properties):
+    # configuration, signing keys and worker processes (with their apktool jvms) are set up once and shared by all jobs
+    service = dict()
+    service['options'] = options
+    service['should_sign_apk'] = should_sign_apk
+    service['sign_properties'] = sign_properties
+    service['workers'] = get_param_batch_jobs(options, os.cpu_count() or 1)
+    service['queue_size'] = int(options.get(const_option_queue_size, const_service_queue_size_default))
+    service['executor'] = create_service_executor(service)
+    service['lock'] = threading.Lock()
+    service['jobs'] = dict()
+    service['job_ids'] = list()
+    service['next_job_id'] = 1
+    service['time_start'] = time.time()
+    service['metrics'] = { 'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0, 'conversion_time': 0.0, 'apktool_time': 0.0 }
+    return service
+
+
+def create_service_executor(service):
+    # the slots are created with the pool, a killed worker may never release the slot it held
+    return ProcessPoolExecutor(max_workers=service['workers'], initializer=init_service_worker, initargs=(service['options'], create_stage_slots(service['options'])))
+
+
+def submit_service_executor_job(service, job_options, path_xapk, path_dir_output):
+    # returns None if the job can not be submitted
+    for attempt in range(2):
+        try:
+            return service['executor'].submit(convert_xapk_batch_job, job_options, path_xapk, os.path.dirname(path_xapk), service['should_sign_apk'], service['sign_properties'], path_dir_output)
+        except BrokenProcessPool:
+            # a worker process died (for example, it was killed), the pool does not take jobs anymore and is replaced
+            print_synchronized('[!] worker pool is broken, starting a new one')
+            service['executor'].shutdown(wait=False)
+            service['executor'] = create_service_executor(service)
+    return None
+
+
+def get_service_job_status(job):
+    if job['result'] is not None:
+        return job['result']['status']
+    if job['future'].running():
+        return 'running'
+    return 'queued'
+
+
+def get_service_job_data(job, with_report):
+    data = dict()
+    data['id'] = job['id']
+    data['file'] = job['file']
+    data['output_dir'] = job['output_dir']
+    data['options'] = job['options']
+    data['status'] = get_service_job_status(job)
+    data['submitted'] = job['time_submitted']
+    if job['result'] is not None:
+        data['error'] = job['result']['error']
+        data['time'] = job['result']['time']
+        data['apktool_time'] = job['result']['apktool_time']
+        data['finished'] = job['time_finished']
+        if with_report:
+            data['report'] = job['result']['report']
+    return data
+
+
+def on_service_job_done(service, job, future):
+    try:
+        result = future.result()
+    except Exception as e:
+        report = create_report(job['file'])
+        report['status'] = 'failed'
+        report['error'] = str(e)
+        result = { 'file': job['file'], 'status': 'failed', 'error': str(e), 'time': 0.0, 'apktool_time': 0.0, 'report': report }
+    with service['lock']:
+        job['result'] = result
+        job['time_finished'] = time.time()
+        service['metrics']['completed' if result['status'] == 'ok' else 'failed'] += 1
+        service['metrics']['conversion_time'] += result['time']
+        service['metrics']['apktool_time'] += result['apktool_time']
+        finished_job_ids = [job_id for job_id in service['job_ids'] if service['jobs'][job_id]['result'] is not None]
+        for job_id in finished_job_ids[:max(0, len(finished_job_ids) - const_service_finished_jobs_kept)]:
+            service['job_ids'].remove(job_id)
+            del service['jobs'][job_id]
+    print_synchronized('[*] job %d %s: %s' % (job['id'], result['status'], job['file']))
+
+
+def submit_service_job(service, request):
+    # returns the http status and the response data
+    if not isinstance(request, dict) or not isinstance(request.get('file'), str):
+        return 400, { 'error': 'the request must be a json object with a "file" string' }
+    path_xapk = os.path.abspath(request['file'])
+    if not path_xapk.endswith(const_ext_xapk) or not os.path.isfile(path_xapk):
+        return 400, { 'error': 'xapk file %s not found' % path_xapk }
+    path_dir_output = request.get('output_dir')
+    if path_dir_output is not None:
+        path_dir_output = os.path.abspath(path_dir_output)
+        if not os.path.isdir(path_dir_output):
+            return 400, { 'error': 'output directory %s not found' % path_dir_output }
+    if 'options' in request.keys() and not isinstance(request['options'], dict):
+        return 400, { 'error': '"options" must be a json object' }
+    job_options = dict(service['options'])
+    for option_name, option_value in request.get('options', dict()).items():
+        if option_name not in const_service_job_options:
+            return 400, { 'error': 'option %s can not be set per job' % option_name }
+        if option_name in const_options_flags:
+            if option_value:
+                job_options[option_name] = True
+            else:
+                job_options.pop(option_name, None)
+        else:
+            job_options[option_name] = str(option_value)
+    option_invalid = find_invalid_option(job_options)
+    if option_invalid is not None:
+        return 400, { 'error': 'invalid value of option %s' % option_invalid }
+
+    with service['lock']:
+        jobs_pending = len([job_id for job_id in service['job_ids'] if get_service_job_status(service['jobs'][job_id]) == 'queued'])
+        if jobs_pending >= service['queue_size']:
+            service['metrics']['rejected'] += 1
+            return 503, { 'error': 'the job queue is full, %d jobs pending' % jobs_pending }
+        future = submit_service_executor_job(service, job_options, path_xapk, path_dir_output)
+        if future is None:
+            service['metrics']['rejected'] += 1
+            return 503, { 'error': 'the worker pool can not take jobs' }
+        job = dict()
+        job['id'] = service['next_job_id']
+        job['file'] = path_xapk
+        job['output_dir'] = path_dir_output
+        job['options'] = request.get('options', dict())
+        job['time_submitted'] = time.time()
+        job['time_finished'] = None
+        job['result'] = None
+        job['future'] = future
+        service['next_job_id'] += 1
+        service['jobs'][job['id']] = job
+        service['job_ids'].append(job['id'])
+        service['metrics']['submitted'] += 1
+    job['future'].add_done_callback(lambda future: on_service_job_done(service, job, future))
+    print_synchronized('[*] job %d queued: %s' % (job['id'], path_xapk))
+    return 202, { 'id': job['id'], 'status': 'queued' }
+
+
+def get_service_metrics(service):
+    with service['lock']:
+        jobs = [service['jobs'][job_id] for job_id in service['job_ids']]
+        statuses = [get_service_job_status(job) for job in jobs]
+        metrics = dict(service['metrics'])
+    uptime = time.time() - service['time_start']
+    metrics['queued'] = statuses.count('queued')
+    metrics['running'] = statuses.count('running')
+    metrics['workers'] = service['workers']
+    metrics['queue_size'] = service['queue_size']
+    metrics['uptime'] = uptime
+    metrics['jobs_per_minute'] = metrics['completed'] * 60.0 / uptime if uptime > 0 else 0.0
+    return metrics
+
+
+def handle_service_request(service, method, path, body):
+    # returns the http status and the response data
+    path = path.split('?', 1)[0].rstrip('/')
+    if method == 'GET' and path == '/status':
+        return 200, { 'status': 'ok', 'uptime': time.time() - service['time_start'] }
+    if method == 'GET' and path == '/metrics':
+        return 200, get_service_metrics(service)
+    if method == 'GET' and path == '/jobs':
+        with service['lock']:
+            return 200, { 'jobs': [get_service_job_data(service['jobs'][job_id], False) for job_id in service['job_ids']] }
+    if method == 'GET' and path.startswith('/jobs/'):
+        with service['lock']:
+            job = service['jobs'].get(int(path[len('/jobs/'):])) if path[len('/jobs/'):].isdigit() else None
+            if job is None:
+                return 404, { 'error': 'job not found' }
+            return 200, get_service_job_data(job, True)
+    if method == 'POST' and path == '/jobs':
+        try:
+            request = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return 400, { 'error': 'the request body is not valid json' }
+        return submit_service_job(service, request)
+    return 404, { 'error': 'not found' }
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        self.send_service_response(*handle_service_request(self.service, 'GET', self.path, b''))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.send_service_response(*handle_service_request(self.service, 'POST', self.path, body))
+
+    def send_service_response(self, status, data):
+        response = json.dumps(data, indent=2).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixThreadingHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def run_service(options, should_sign_apk, sign_properties):
+    host, port_or_path = parse_service_address(options[const_option_serve])
+    service = create_service(options, should_sign_apk, sign_properties)
+    ServiceRequestHandler.service = service
+    if host is None:
+        if os.path.exists(port_or_path):
+            os.remove(port_or_path)
+        server = UnixThreadingHTTPServer(port_or_path, ServiceRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port_or_path), ServiceRequestHandler)
+
+    def stop_service(signal_number, frame):
+        # shutdown() waits until serve_forever() returns, which runs in this thread, so it is called from another one
+        print_synchronized('[*] SIGTERM received, stopping the service')
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal_handler_previous = signal.signal(signal.SIGTERM, stop_service)
+    print('[*] serving on %s with %d workers, queue size %d' % (options[const_option_serve], service['workers'], service['queue_size']))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal_handler_previous)
+        server.server_close()
+        if host is None:
+            delete_file_if_exists(port_or_path)
+        print('[*] waiting for the running jobs')
+        service['executor'].shutdown(wait=True)
 
-    shutil.rmtree(path_dir_tmp)
 
+def write_reports(options, reports):
+    if options.get(const_option_profile, False):
+        print_profile_report(reports)
+    if const_option_report_json in options.keys():
+        write_report_json(options[const_option_report_json], reports)
+        print('[*] report written to %s' % options[const_option_report_json])
+
+
+def main():
+    if not check_sys_args():
+        print_help()
+        exit(-1)
+
+    options, positional_args = parse_sys_args()
+    if is_inspect_command(positional_args):
+        # inspection only reads the zip central directories, so neither apktool nor apksigner are needed
+        sign_properties = load_sign_properties()
+        if not run_inspect(options, collect_xapk_files(positional_args[1:]), sign_properties is not None, sign_properties):
+            exit(-3)
+        return
+
+    tested_binary = "apktool"
+    if not check_if_executable_exists_in_path(tested_binary):
+        print("executable %s not found in $PATH, please install it before running xapktoapk" % tested_binary)
+        exit(-2)
+
+    sign_properties = load_sign_properties()
+    should_sign_apk = sign_properties is not None
+    # the keystore is loaded before the worker processes are started, apksigner is only needed when it cannot be used in process
+    if should_sign_apk and load_sign_key(sign_properties) is None:
+        tested_binary = "apksigner"
+        if not check_if_executable_exists_in_path(tested_binary):
+            print("executable %s not found in $PATH, please install it before running xapktoapk" % tested_binary)
+            exit(-2)
+
+    cwd = os.path.abspath(os.path.curdir)
+
+    if const_option_serve in options.keys():
+        run_service(options, should_sign_apk, sign_properties)
+        return
+
+    if is_batch_mode(positional_args):
+        xapk_files = collect_xapk_files(positional_args)
+        if len(xapk_files) == 0:
+            print_help()
+            exit(-1)
+        print('[*] start')
+        results = convert_xapk_batch(options, xapk_files, cwd, should_sign_apk, sign_properties)
+        write_reports(options, [result['report'] for result in results])
+        if len([result for result in results if result['status'] != 'ok']) > 0:
+            exit(-3)
+        print('[*] complete')
+        return
+
+    xapk_file_name = get_param_xapk_file_name()
+    xapk_file_abs_path = get_param_xapk_abs_path()
+    original_file_name, original_file_extension = file_split_name_and_extension(xapk_file_name)
+
+    print('[*] start')
+
+    set_stage_slots(create_stage_slots(options))
+    if options.get(const_option_apktool_daemon, False):
+        start_apktool_daemon_pool(get_param_jobs(options), options.get(const_option_apktool_jar))
+    report = create_report(xapk_file_abs_path)
+    try:
+        convert_xapk(options, xapk_file_abs_path, cwd, original_file_name, should_sign_apk, sign_properties, report)
+    finally:
+        stop_apktool_daemon_pool()
+        write_reports(options, [report])
+
+    print('[*] apktool time: %.1f s in %d calls (%d in daemon)' % (apktool_stats['time'], apktool_stats['calls'], apktool_stats['daemon_calls']))
     print('[*] complete')
 
 
@@ -0,0 +1,648 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from subprocess import Popen, DEVNULL
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+import xapktoapk
+
+
+const_option_prefix = "--"
+const_option_output = "output"
+const_option_work_dir = "work-dir"
+const_option_scenarios = "scenarios"
+const_option_repeat = "repeat"
+const_option_tools = "tools"
+const_option_compare = "compare"
+const_option_package = "package"
+const_option_dpi_splits = "dpi-splits"
+const_option_locale_splits = "locale-splits"
+const_option_arch_splits = "arch-splits"
+const_option_resources = "resources"
+const_option_resource_size = "resource-size"
+const_option_so_count = "so-count"
+const_option_so_size = "so-size"
+const_option_asset_pack_size = "asset-pack-size"
+const_option_seed = "seed"
+const_option_no_strace = "no-strace"
+const_options_with_value = [ const_option_output, const_option_work_dir, const_option_scenarios, const_option_repeat, const_option_tools,
+                             const_option_compare, const_option_package, const_option_dpi_splits, const_option_locale_splits,
+                             const_option_arch_splits, const_option_resources, const_option_resource_size, const_option_so_count,
+                             const_option_so_size, const_option_asset_pack_size, const_option_seed ]
+const_options_flags = [ const_option_no_strace ]
+
+const_bench_version = 1
+const_bench_defaults = {
+    const_option_output: "xapktoapk.bench.json",
+    const_option_repeat: "3",
+    const_option_tools: "stub",
+    const_option_package: "com.example.bench",
+    const_option_dpi_splits: "4",
+    const_option_locale_splits: "8",
+    const_option_arch_splits: "2",
+    const_option_resources: "2000",
+    const_option_resource_size: "4",
+    const_option_so_count: "4",
+    const_option_so_size: "8",
+    const_option_asset_pack_size: "64",
+    const_option_seed: "1",
+}
+const_bench_tools_stub = "stub"
+const_bench_tools_real = "real"
+const_bench_bundle_full = "full"
+const_bench_bundle_raw = "raw"
+const_bench_file_strace = "strace.txt"
+const_bench_dir_bin = "bin"
+const_bench_dir_bundles = "bundles"
+const_bench_dir_runs = "runs"
+const_bench_strace_top_count = 10
+const_bench_asset_pack_file_size = 4 * 1024 * 1024
+const_bench_bytes_in_mb = 1024 * 1024
+
+const_bench_dpi_names = [ "xxhdpi", "xhdpi", "hdpi", "mdpi", "xxxhdpi", "ldpi", "tvdpi" ]
+const_bench_locale_names = [ "en", "de", "fr", "es", "it", "pt", "ru", "ja", "ko", "zh", "ar", "nl", "pl", "sv", "tr", "uk", "cs",
+                             "da", "fi", "el", "he", "hi", "hu", "id", "ms", "nb", "ro", "sk", "th", "vi" ]
+const_bench_abi_lib_dirs = { "arm64_v8a": "arm64-v8a", "armeabi_v7a": "armeabi-v7a", "x86_64": "x86_64", "x86": "x86" }
+const_bench_abi_names = [ "arm64_v8a", "armeabi_v7a", "x86_64", "x86" ]
+const_bench_asset_pack_name = "asset_pack"
+
+# name -> (bundle, extra xapktoapk options), {jobs} is replaced by the cpu count
+const_bench_scenarios = {
+    "default": (const_bench_bundle_full, []),
+    "jobs": (const_bench_bundle_full, ["--jobs", "{jobs}"]),
+    "decode-arch": (const_bench_bundle_full, ["--jobs", "{jobs}", "--decode-arch"]),
+    "low-footprint": (const_bench_bundle_full, ["--jobs", "{jobs}", "--low-footprint"]),
+    "raw-merge": (const_bench_bundle_raw, ["--raw-merge"]),
+}
+const_bench_scenarios_default = [ "default", "jobs", "decode-arch", "low-footprint", "raw-merge" ]
+
+# the stubs unpack and repack the zip entries instead of decoding and building resources, so the numbers measure the script itself
+const_bench_stub_apktool = r"""#!/usr/bin/env python3
+import os, sys, zipfile
+MANIFEST = '''<?xml version="1.0" encoding="utf-8" standalone="no"?><manifest xmlns:android="http://schemas.android.com/apk/res/android" package="bench">
+    <application android:isSplitRequired="true">
+        <meta-data android:name="com.android.vending.splits.required" android:value="true"/>
+        <meta-data android:name="com.android.vending.splits" android:resource="@xml/splits0"/>
+        <meta-data android:name="com.android.stamp.type" android:value="STAMP_TYPE_DISTRIBUTION_APK"/>
+    </application>
+</manifest>
+'''
+args = sys.argv[1:]
+if args[0] in ('--version', '-version'):
+    print('2.9.3-bench-stub')
+    sys.exit(0)
+if args[0] == 'd':
+    out = None
+    rest = list()
+    i = 1
+    while i < len(args):
+        if args[i] == '-o':
+            out = args[i + 1]
+            i += 2
+            continue
+        if args[i] in ('-s', '-f'):
+            i += 1
+            continue
+        rest.append(args[i])
+        i += 1
+    apk = rest[0]
+    if out is None:
+        out = os.path.splitext(os.path.basename(apk))[0]
+    os.makedirs(out)
+    with zipfile.ZipFile(apk) as z:
+        for info in z.infolist():
+            if info.filename.endswith('/'):
+                continue
+            name = ('original/' + info.filename) if info.filename.startswith('META-INF/') else info.filename
+            dst = os.path.join(out, name)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if name == 'AndroidManifest.xml':
+                with open(dst, 'w') as f:
+                    f.write(MANIFEST)
+                continue
+            with z.open(info) as src, open(dst, 'wb') as f:
+                while True:
+                    chunk = src.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        extensions = sorted(set(os.path.splitext(i.filename)[1][1:] for i in z.infolist() if i.compress_type == 0 and '.' in i.filename))
+    with open(os.path.join(out, 'apktool.yml'), 'w') as f:
+        f.write('!!brut.androlib.meta.MetaInfo\napkFileName: %s\ndoNotCompress:\n' % os.path.basename(apk))
+        for extension in extensions:
+            f.write('- %s\n' % extension)
+        f.write('isFrameworkApk: false\nversion: 2.9.3\n')
+elif args[0] == 'b':
+    d = args[-1].rstrip('/')
+    dist = os.path.join(d, 'dist')
+    os.makedirs(dist, exist_ok=True)
+    out = os.path.join(dist, os.path.basename(d) + '.apk')
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as z:
+        for root, dirs, files in os.walk(d):
+            if os.path.relpath(root, d).split(os.sep)[0] in ('dist', 'build', 'original'):
+                continue
+            for name in files:
+                if name == 'apktool.yml':
+                    continue
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, d)
+                stored = rel.endswith('.so') or rel == 'resources.arsc'
+                z.write(path, rel, compress_type=zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+else:
+    sys.exit(2)
+"""
+const_bench_stub_apksigner = '''#!/bin/sh
+exit 0
+'''
+
+
+def print_help():
+    print("")
+    print("Benchmark harness of xapktoapk")
+    print("Generates synthetic xapk bundles, converts them with xapktoapk and records the measurements in a results file")
+    print("Usage: python xapktoapk_bench.py [OPTIONS]")
+    print("")
+    print("Options:")
+    print("  --output PATH         results file (default: %s)" % const_bench_defaults[const_option_output])
+    print("  --compare PATH        print the difference to an older results file")
+    print("  --work-dir DIR        directory for the generated bundles and the runs, kept after the run (default: temp directory)")
+    print("  --scenarios NAME,...  scenarios to run: %s (default: all)" % ", ".join(const_bench_scenarios_default))
+    print("  --repeat N            runs of every scenario, the median is reported (default: %s)" % const_bench_defaults[const_option_repeat])
+    print("  --tools stub|real     convert with stub apktool and apksigner or with the ones in $PATH (default: %s)" % const_bench_defaults[const_option_tools])
+    print("  --no-strace           do not count the syscalls of every scenario with strace")
+    print("")
+    print("Bundle options:")
+    print("  --package NAME        package name (default: %s)" % const_bench_defaults[const_option_package])
+    print("  --dpi-splits N        number of dpi splits, up to %d (default: %s)" % (len(const_bench_dpi_names), const_bench_defaults[const_option_dpi_splits]))
+    print("  --locale-splits N     number of language splits, up to %d (default: %s)" % (len(const_bench_locale_names), const_bench_defaults[const_option_locale_splits]))
+    print("  --arch-splits N       number of abi splits, up to %d (default: %s)" % (len(const_bench_abi_names), const_bench_defaults[const_option_arch_splits]))
+    print("  --resources N         number of drawables in the base apk and in every dpi split (default: %s)" % const_bench_defaults[const_option_resources])
+    print("  --resource-size KB    size of every drawable (default: %s)" % const_bench_defaults[const_option_resource_size])
+    print("  --so-count N          number of native libraries in every abi split (default: %s)" % const_bench_defaults[const_option_so_count])
+    print("  --so-size MB          size of every native library (default: %s)" % const_bench_defaults[const_option_so_size])
+    print("  --asset-pack-size MB  size of the asset pack, 0 for none (default: %s)" % const_bench_defaults[const_option_asset_pack_size])
+    print("  --seed N              seed of the generated payloads (default: %s)" % const_bench_defaults[const_option_seed])
+    print("")
+
+
+def parse_sys_args():
+    options = dict(const_bench_defaults)
+    args = sys.argv[1:]
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        index += 1
+        if not arg.startswith(const_option_prefix):
+            return None
+        option_name = arg[len(const_option_prefix):]
+        option_value = None
+        if '=' in option_name:
+            option_name, option_value = option_name.split('=', 1)
+        if option_name in const_options_flags and option_value is None:
+            options[option_name] = True
+        elif option_name in const_options_with_value:
+            if option_value is None:
+                if index >= len(args):
+                    return None
+                option_value = args[index]
+                index += 1
+            options[option_name] = option_value
+        else:
+            return None
+    return options
+
+
+def get_param_int(options, option_name):
+    return int(options[option_name])
+
+
+def get_param_scenarios(options):
+    if const_option_scenarios not in options.keys():
+        return list(const_bench_scenarios_default)
+    scenarios = [name.strip() for name in options[const_option_scenarios].split(',') if name.strip() != '']
+    for name in scenarios:
+        if name not in const_bench_scenarios.keys():
+            raise Exception("unknown scenario %s" % name)
+    return scenarios
+
+
+def get_bundle_params(options):
+    params = dict()
+    params['package'] = options[const_option_package]
+    params['dpi_splits'] = min(get_param_int(options, const_option_dpi_splits), len(const_bench_dpi_names))
+    params['locale_splits'] = min(get_param_int(options, const_option_locale_splits), len(const_bench_locale_names))
+    params['arch_splits'] = min(get_param_int(options, const_option_arch_splits), len(const_bench_abi_names))
+    params['resources'] = get_param_int(options, const_option_resources)
+    params['resource_size'] = get_param_int(options, const_option_resource_size) * 1024
+    params['so_count'] = get_param_int(options, const_option_so_count)
+    params['so_size'] = get_param_int(options, const_option_so_size) * const_bench_bytes_in_mb
+    params['asset_pack_size'] = get_param_int(options, const_option_asset_pack_size) * const_bench_bytes_in_mb
+    params['seed'] = get_param_int(options, const_option_seed)
+    return params
+
+
+# synthetic bundle
+
+
+def generate_random_bytes(rng, size):
+    if size == 0:
+        return b''
+    return rng.getrandbits(8 * size).to_bytes(size, 'little')
+
+
+def generate_values_xml(entries):
+    lines = [ '<?xml version="1.0" encoding="utf-8"?>', '<resources>' ]
+    for name, value in entries:
+        lines.append('    <string name="%s">%s</string>' % (name, value))
+    lines.append('</resources>')
+    return '\n'.join(lines) + '\n'
+
+
+def write_synthetic_apk(path_apk, entries):
+    # entries are (name, bytes or callable producing bytes, stored)
+    with ZipFile(path_apk, 'w', ZIP_DEFLATED) as apk:
+        for name, data, stored in entries:
+            if callable(data):
+                data = data()
+            apk.writestr(name, data, compress_type=ZIP_STORED if stored else ZIP_DEFLATED)
+    return os.path.getsize(path_apk)
+
+
+def generate_base_apk_entries(rng, params, with_resources):
+    entries = list()
+    entries.append(('AndroidManifest.xml', xapktoapk.generate_binary_manifest(params['package'], True), False))
+    entries.append(('classes.dex', generate_random_bytes(rng, 256 * 1024), False))
+    if not with_resources:
+        return entries
+    entries.append(('resources.arsc', generate_random_bytes(rng, 64 * 1024), True))
+    strings = [ ('string_%d' % index, 'value %d' % index) for index in range(max(1, params['resources'] // 10)) ]
+    entries.append(('res/values/strings.xml', generate_values_xml(strings).encode('utf-8'), False))
+    for index in range(params['resources']):
+        entries.append(('res/drawable/image_%d.png' % index, generate_random_bytes(rng, params['resource_size']), True))
+    return entries
+
+
+def generate_split_apk_entries(rng, params, split_type, split_name):
+    entries = [ ('AndroidManifest.xml', xapktoapk.generate_binary_manifest(params['package'], False), False) ]
+    if split_type == xapktoapk.const_split_apk_type_dpi:
+        for index in range(params['resources']):
+            size = params['resource_size']
+            entries.append(('res/drawable-%s-v4/image_%d.png' % (split_name, index), lambda size=size: generate_random_bytes(rng, size), True))
+    elif split_type == xapktoapk.const_split_apk_type_locale:
+        strings = [ ('string_%d' % index, '%s %d' % (split_name, index)) for index in range(max(1, params['resources'] // 10)) ]
+        entries.append(('res/values-%s/strings.xml' % split_name, generate_values_xml(strings).encode('utf-8'), False))
+    elif split_type == xapktoapk.const_split_apk_type_arch:
+        lib_dir = const_bench_abi_lib_dirs[split_name]
+        for index in range(params['so_count']):
+            size = params['so_size']
+            entries.append(('lib/%s/libbench%d.so' % (lib_dir, index), lambda size=size: generate_random_bytes(rng, size), True))
+    else:
+        remaining = params['asset_pack_size']
+        index = 0
+        while remaining > 0:
+            size = min(remaining, const_bench_asset_pack_file_size)
+            entries.append(('%s/payload_%d.bin' % (xapktoapk.const_apk_dir_asset_pack, index), lambda size=size: generate_random_bytes(rng, size), True))
+            remaining -= size
+            index += 1
+    return entries
+
+
+def generate_xapk(path_xapk, params, bundle):
+    # the same seed always gives the same bundle, so results files of different runs stay comparable
+    rng = random.Random('%d-%s' % (params['seed'], bundle))
+    with_resources = bundle == const_bench_bundle_full
+    splits = list()
+    if with_resources:
+        splits += [ (xapktoapk.const_split_apk_type_dpi, name) for name in const_bench_dpi_names[:params['dpi_splits']] ]
+        splits += [ (xapktoapk.const_split_apk_type_locale, name) for name in const_bench_locale_names[:params['locale_splits']] ]
+    splits += [ (xapktoapk.const_split_apk_type_arch, name) for name in const_bench_abi_names[:params['arch_splits']] ]
+    if params['asset_pack_size'] > 0:
+        splits.append((None, const_bench_asset_pack_name))
+
+    path_dir_tmp = tempfile.mkdtemp(dir=os.path.dirname(path_xapk))
+    try:
+        apk_files = list()
+        path_apk = os.path.join(path_dir_tmp, params['package'] + xapktoapk.const_ext_apk)
+        write_synthetic_apk(path_apk, generate_base_apk_entries(rng, params, with_resources))
+        apk_files.append(path_apk)
+        for split_type, split_name in splits:
+            if split_type is None:
+                apk_name = split_name + xapktoapk.const_ext_apk
+            else:
+                apk_name = '%s.%s%s' % (xapktoapk.const_prefix_apk_split_type_config, split_name, xapktoapk.const_ext_apk)
+            path_apk = os.path.join(path_dir_tmp, apk_name)
+            write_synthetic_apk(path_apk, generate_split_apk_entries(rng, params, split_type, split_name))
+            apk_files.append(path_apk)
+
+        manifest = dict()
+        manifest[xapktoapk.const_file_xapk_manifest_key_package_name] = params['package']
+        manifest['split_apks'] = [ { 'file': os.path.basename(path_apk), 'id': os.path.splitext(os.path.basename(path_apk))[0] } for path_apk in apk_files ]
+        with ZipFile(path_xapk, 'w', ZIP_STORED) as xapk:
+            xapk.writestr(xapktoapk.const_file_xapk_manifest, json.dumps(manifest, indent=2))
+            for path_apk in apk_files:
+                xapk.write(path_apk, os.path.basename(path_apk))
+    finally:
+        shutil.rmtree(path_dir_tmp, ignore_errors=True)
+
+    bundle_info = dict()
+    bundle_info['file'] = os.path.basename(path_xapk)
+    bundle_info['size'] = os.path.getsize(path_xapk)
+    bundle_info['splits'] = len(splits)
+    with ZipFile(path_xapk) as xapk:
+        bundle_info['apk_files'] = len([name for name in xapk.namelist() if name.endswith(xapktoapk.const_ext_apk)])
+    return bundle_info
+
+
+# tools
+
+
+def write_stub_tools(path_dir_bin):
+    os.makedirs(path_dir_bin, exist_ok=True)
+    for name, content in [ ('apktool', const_bench_stub_apktool), ('apksigner', const_bench_stub_apksigner) ]:
+        path_tool = os.path.join(path_dir_bin, name)
+        with open(path_tool, 'w') as file:
+            file.write(content)
+        os.chmod(path_tool, 0o755)
+
+
+def get_tools_env(tools, path_dir_bin):
+    env = dict(os.environ)
+    if tools == const_bench_tools_stub:
+        env['PATH'] = path_dir_bin + os.pathsep + env.get('PATH', '')
+    return env
+
+
+# runs
+
+
+def get_scenario_args(scenario):
+    jobs = str(os.cpu_count() or 1)
+    return [ arg.replace('{jobs}', jobs) for arg in const_bench_scenarios[scenario][1] ]
+
+
+def get_run_command(scenario, path_xapk, path_report):
+    path_script = os.path.abspath(xapktoapk.__file__)
+    return [ sys.executable, path_script, '--report-json', path_report ] + get_scenario_args(scenario) + [ path_xapk ]
+
+
+def run_command(command, cwd, env, path_log):
+    start = time.time()
+    with open(path_log, 'w') as log:
+        process = Popen(command, cwd=cwd, env=env, stdin=DEVNULL, stdout=log, stderr=log)
+        _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.time() - start
+    returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return returncode, wall_time, rusage
+
+
+def prepare_run_dir(path_dir_run, path_xapk):
+    # every run converts its own hardlink of the bundle, the result apk is written next to it
+    shutil.rmtree(path_dir_run, ignore_errors=True)
+    os.makedirs(path_dir_run)
+    path_xapk_run = os.path.join(path_dir_run, os.path.basename(path_xapk))
+    try:
+        os.link(path_xapk, path_xapk_run)
+    except OSError:
+        shutil.copyfile(path_xapk, path_xapk_run)
+    return path_xapk_run
+
+
+def summarize_report_stages(path_report):
+    stages = dict()
+    with open(path_report, 'r') as file:
+        data = json.load(file)
+    for job in data['jobs']:
+        for stage in job['stages']:
+            summary = stages.setdefault(stage['name'], { 'wall_time': 0.0, 'cpu_time': 0.0, 'read_bytes': 0, 'write_bytes': 0, 'files': 0, 'peak_rss_kb': 0 })
+            summary['wall_time'] += stage['wall_time']
+            summary['cpu_time'] += stage['cpu_time']
+            summary['read_bytes'] += stage['read_bytes'] or 0
+            summary['write_bytes'] += stage['write_bytes'] or 0
+            summary['files'] += stage['files'] or 0
+            summary['peak_rss_kb'] = max(summary['peak_rss_kb'], stage['peak_rss_kb'] or 0)
+    return stages
+
+
+def run_scenario_once(scenario, path_xapk, path_dir_run, env):
+    path_xapk_run = prepare_run_dir(path_dir_run, path_xapk)
+    path_report = os.path.join(path_dir_run, 'report.json')
+    command = get_run_command(scenario, path_xapk_run, path_report)
+    returncode, wall_time, rusage = run_command(command, path_dir_run, env, os.path.join(path_dir_run, 'log.txt'))
+    if returncode != 0:
+        raise Exception("scenario %s failed with exit code %d, see %s" % (scenario, returncode, os.path.join(path_dir_run, 'log.txt')))
+
+    run = dict()
+    run['wall_time'] = wall_time
+    run['cpu_time'] = rusage.ru_utime + rusage.ru_stime
+    # ru_maxrss of a waited child is the peak of the script itself, the tool processes are in the stage reports
+    run['peak_rss_kb'] = rusage.ru_maxrss
+    run['stages'] = summarize_report_stages(path_report)
+    run['peak_rss_kb_tools'] = max([stage['peak_rss_kb'] for stage in run['stages'].values()] + [0])
+    output_apks = [ name for name in os.listdir(path_dir_run) if name.endswith(xapktoapk.const_ext_apk) ]
+    run['output_size'] = sum(os.path.getsize(os.path.join(path_dir_run, name)) for name in output_apks)
+    shutil.rmtree(path_dir_run, ignore_errors=True)
+    return run
+
+
+def parse_strace_summary(path_strace):
+    syscalls = dict()
+    with open(path_strace, 'r') as file:
+        for line in file:
+            columns = line.split()
+            # % time, seconds, usecs/call, calls, [errors,] syscall, the total line has no usecs/call in newer versions
+            if len(columns) < 5 or columns[-1] == 'total' or not re.match(r'^[\d.]+$', columns[0]) or not columns[3].isdigit():
+                continue
+            syscalls[columns[-1]] = syscalls.get(columns[-1], 0) + int(columns[3])
+    return sum(syscalls.values()), syscalls
+
+
+def run_scenario_strace(scenario, path_xapk, path_dir_run, env):
+    # counted in a separate run, strace slows every syscall down and would distort the timed runs
+    path_xapk_run = prepare_run_dir(path_dir_run, path_xapk)
+    path_strace = os.path.join(path_dir_run, const_bench_file_strace)
+    command = [ 'strace', '-f', '-c', '-o', path_strace ] + get_run_command(scenario, path_xapk_run, os.path.join(path_dir_run, 'report.json'))
+    returncode, _, _ = run_command(command, path_dir_run, env, os.path.join(path_dir_run, 'log.txt'))
+    if returncode != 0 or not os.path.isfile(path_strace):
+        shutil.rmtree(path_dir_run, ignore_errors=True)
+        return None
+    total, syscalls = parse_strace_summary(path_strace)
+    shutil.rmtree(path_dir_run, ignore_errors=True)
+    result = dict()
+    result['total'] = total
+    result['top'] = dict(sorted(syscalls.items(), key=lambda item: -item[1])[:const_bench_strace_top_count])
+    return result
+
+
+def get_median(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarize_scenario(runs, bundle_info):
+    summary = dict()
+    summary['wall_time'] = get_median([run['wall_time'] for run in runs])
+    summary['wall_time_min'] = min(run['wall_time'] for run in runs)
+    summary['cpu_time'] = get_median([run['cpu_time'] for run in runs])
+    summary['throughput_mb_s'] = bundle_info['size'] / const_bench_bytes_in_mb / summary['wall_time'] if summary['wall_time'] > 0 else 0.0
+    summary['peak_rss_kb'] = max(run['peak_rss_kb'] for run in runs)
+    summary['peak_rss_kb_tools'] = max(run['peak_rss_kb_tools'] for run in runs)
+    summary['output_size'] = runs[-1]['output_size']
+    stages = dict()
+    for name in runs[-1]['stages'].keys():
+        stage = dict(runs[-1]['stages'][name])
+        stage['wall_time'] = get_median([run['stages'].get(name, {}).get('wall_time', 0.0) for run in runs])
+        stage['cpu_time'] = get_median([run['stages'].get(name, {}).get('cpu_time', 0.0) for run in runs])
+        stages[name] = stage
+    summary['stages'] = stages
+    return summary
+
+
+def run_benchmark(options):
+    scenarios = get_param_scenarios(options)
+    repeat = max(1, get_param_int(options, const_option_repeat))
+    tools = options[const_option_tools]
+    if tools not in [const_bench_tools_stub, const_bench_tools_real]:
+        raise Exception("unknown tools %s" % tools)
+    use_strace = not options.get(const_option_no_strace, False) and shutil.which('strace') is not None
+    params = get_bundle_params(options)
+
+    if const_option_work_dir in options.keys():
+        path_dir_work = os.path.abspath(options[const_option_work_dir])
+        os.makedirs(path_dir_work, exist_ok=True)
+        remove_work_dir = False
+    else:
+        path_dir_work = tempfile.mkdtemp(prefix='xapktoapk-bench-')
+        remove_work_dir = True
+
+    try:
+        path_dir_bin = os.path.join(path_dir_work, const_bench_dir_bin)
+        if tools == const_bench_tools_stub:
+            write_stub_tools(path_dir_bin)
+        env = get_tools_env(tools, path_dir_bin)
+
+        bundles = dict()
+        path_dir_bundles = os.path.join(path_dir_work, const_bench_dir_bundles)
+        os.makedirs(path_dir_bundles, exist_ok=True)
+        for bundle in sorted(set(const_bench_scenarios[scenario][0] for scenario in scenarios)):
+            path_xapk = os.path.join(path_dir_bundles, bundle + xapktoapk.const_ext_xapk)
+            start = time.time()
+            bundles[bundle] = generate_xapk(path_xapk, params, bundle)
+            bundles[bundle]['generate_time'] = time.time() - start
+            print('[*] generated %s bundle: %.1f MB, %d splits in %.1f s' % (bundle, bundles[bundle]['size'] / const_bench_bytes_in_mb,
+                                                                            bundles[bundle]['splits'], bundles[bundle]['generate_time']))
+
+        results = dict()
+        for scenario in scenarios:
+            bundle = const_bench_scenarios[scenario][0]
+            path_xapk = os.path.join(path_dir_bundles, bundle + xapktoapk.const_ext_xapk)
+            path_dir_run = os.path.join(path_dir_work, const_bench_dir_runs, scenario)
+            runs = list()
+            for index in range(repeat):
+                runs.append(run_scenario_once(scenario, path_xapk, path_dir_run, env))
+                print('[*] %s run %d/%d: %.2f s' % (scenario, index + 1, repeat, runs[-1]['wall_time']))
+            result = summarize_scenario(runs, bundles[bundle])
+            result['bundle'] = bundle
+            result['args'] = get_scenario_args(scenario)
+            result['runs'] = runs
+            result['syscalls'] = run_scenario_strace(scenario, path_xapk, path_dir_run, env) if use_strace else None
+            results[scenario] = result
+    finally:
+        if remove_work_dir:
+            shutil.rmtree(path_dir_work, ignore_errors=True)
+
+    data = dict()
+    data['version'] = const_bench_version
+    data['created'] = time.time()
+    data['host'] = platform.node()
+    data['platform'] = platform.platform()
+    data['python'] = platform.python_version()
+    data['cpu_count'] = os.cpu_count()
+    data['tools'] = tools
+    data['script_sha256'] = xapktoapk.get_file_sha256(os.path.abspath(xapktoapk.__file__))
+    data['params'] = params
+    data['bundles'] = bundles
+    data['scenarios'] = results
+    data['peak_rss_kb_children'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return data
+
+
+# output
+
+
+def format_delta(old, new):
+    if old is None or new is None:
+        return '-'
+    if old == 0:
+        return '0.0%' if new == 0 else '+inf'
+    return '%+.1f%%' % (100.0 * (new - old) / old)
+
+
+def print_results(data, data_old=None):
+    scenarios_old = data_old['scenarios'] if data_old is not None else dict()
+    print('')
+    print('%-16s %10s %10s %10s %12s %12s %10s' % ('scenario', 'wall s', 'cpu s', 'MB/s', 'peak rss kb', 'syscalls', 'wall diff'))
+    for scenario, result in data['scenarios'].items():
+        syscalls = result['syscalls']['total'] if result['syscalls'] is not None else None
+        old = scenarios_old.get(scenario)
+        print('%-16s %10.2f %10.2f %10.1f %12d %12s %10s' % (scenario, result['wall_time'], result['cpu_time'], result['throughput_mb_s'],
+                                                            result['peak_rss_kb'], '-' if syscalls is None else str(syscalls),
+                                                            format_delta(old['wall_time'] if old else None, result['wall_time'])))
+    if data_old is None:
+        return
+
+    print('')
+    print('%-16s %-24s %10s %10s %10s' % ('scenario', 'stage', 'old s', 'new s', 'diff'))
+    for scenario, result in data['scenarios'].items():
+        old = scenarios_old.get(scenario)
+        if old is None:
+            continue
+        for name, stage in result['stages'].items():
+            old_stage = old['stages'].get(name)
+            old_wall_time = old_stage['wall_time'] if old_stage else None
+            print('%-16s %-24s %10s %10.2f %10s' % (scenario, name, '-' if old_wall_time is None else '%.2f' % old_wall_time,
+                                                    stage['wall_time'], format_delta(old_wall_time, stage['wall_time'])))
+        old_syscalls = old['syscalls']['total'] if old.get('syscalls') else None
+        new_syscalls = result['syscalls']['total'] if result['syscalls'] else None
+        if old_syscalls is not None and new_syscalls is not None:
+            print('%-16s %-24s %10d %10d %10s' % (scenario, 'syscalls', old_syscalls, new_syscalls, format_delta(old_syscalls, new_syscalls)))
+    if data_old.get('params') != data.get('params') or data_old.get('tools') != data.get('tools'):
+        print('[!] the bundle parameters or tools of the compared results differ')
+
+
+def main():
+    options = parse_sys_args()
+    if options is None:
+        print_help()
+        exit(-1)
+
+    data_old = None
+    if const_option_compare in options.keys():
+        with open(options[const_option_compare], 'r') as file:
+            data_old = json.load(file)
+
+    print('[*] start')
+    data = run_benchmark(options)
+    with open(options[const_option_output], 'w') as file:
+        json.dump(data, file, indent=2)
+    print_results(data, data_old)
+    print('[*] results written to %s' % options[const_option_output])
+    print('[*] complete')
+
+
+if __name__ == '__main__':
+    main()